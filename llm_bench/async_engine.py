@@ -0,0 +1,594 @@
+"""
+Asyncio load engine, an alternative to the Locust (gevent) path in `load_test.py`.
+
+Every in-flight stream is a coroutine on a single event loop reading the response with aiohttp, so one process can
+sustain thousands of concurrent SSE streams per core. It reuses the providers, workload options and the summary format
+of `load_test.py`, e.g.:
+
+    python async_engine.py -H http://localhost:8000 -p 512 -o 128 --chat --qps 10 -t 60 --summary-file results.csv
+"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import random
+import sys
+import time
+import traceback
+from functools import partial
+from uuid import uuid4
+
+import aiohttp
+import configargparse
+import orjson
+
+from convergence import ConvergenceMonitor
+from exporter import start_exporter, stop_exporter
+from metrics import MetricsRegistry
+from options import add_arguments, parse_timespan
+from providers import PROVIDER_CLASS_MAP, default_model_name, guess_provider_from_host, pick_model, request_headers
+from records import close_sinks, open_sink, request_record
+from response import ResponseAccumulator, evaluate_slo
+from schedule import FixedQPSPacer, apply_trace_qps
+from sse import SSEParser
+from summary import (
+    append_summary,
+    append_throughput_series,
+    build_summary,
+    make_logging_params,
+    print_summary,
+)
+from token_counter import TokenCounter
+from tracer import Lanes, close_tracers, open_tracer
+from workload import ChatSession, LengthSampler, PromptSource, load_tokenizer
+
+
+# (host, model, provider) -> resolved (model, provider), so that runs in one process query /v1/models once
+_resolved_models = {}
+# index of the user running the current task in fixed concurrency mode, its track in the trace
+_user_index = contextvars.ContextVar("user_index", default=None)
+
+
+def connection_trace_config():
+    """
+    Records when requests wait for a free connection, open a new one and are written, as `perf_counter` times in the
+    dict they pass as `trace_request_ctx` (DNS, TCP connect and TLS handshake are all part of the connect)
+    """
+
+    def phase(name):
+        async def callback(session, context, params):
+            if context.trace_request_ctx is not None:
+                context.trace_request_ctx[name] = time.perf_counter()
+
+        return callback
+
+    config = aiohttp.TraceConfig()
+    config.on_connection_queued_start.append(phase("queued_start"))
+    config.on_connection_queued_end.append(phase("queued_end"))
+    config.on_connection_create_start.append(phase("connect_start"))
+    config.on_connection_create_end.append(phase("connect_end"))
+    # the body follows the headers, the last write is when the request is sent
+    config.on_request_headers_sent.append(phase("request_sent"))
+    config.on_request_chunk_sent.append(phase("request_sent"))
+    return config
+
+
+def session_key(parsed_options):
+    """
+    Options of `create_session`, runs with the same key can share a session
+    """
+    if parsed_options is None:
+        return ("keep-alive", None)
+    return (parsed_options.connection_policy, parsed_options.max_connections)
+
+
+def create_session(parsed_options=None):
+    """
+    Session with the connection pool set by --connection-policy and --max-connections of `parsed_options`
+    """
+    policy, max_connections = session_key(parsed_options)
+    connector = aiohttp.TCPConnector(limit=max_connections or 0, force_close=policy == "fresh")
+    timeout = aiohttp.ClientTimeout(total=120)
+    return aiohttp.ClientSession(
+        connector=connector, timeout=timeout, read_bufsize=2**20, trace_configs=[connection_trace_config()]
+    )
+
+
+class AsyncEngine:
+    def __init__(self, parsed_options):
+        self.parsed_options = parsed_options
+        self.host = parsed_options.host.rstrip("/")
+        self.headers = request_headers(parsed_options)
+        self.stream = parsed_options.stream
+        self.stats = MetricsRegistry()
+        self.requests = {}  # {request_id: 'initiated'/'first_received'/'last_received'}
+        self.num_failures = 0
+        self.first_request_done = 0
+        # set by the steady state reset, requests completed before it are warm-up
+        self.warmed_up = False
+        self.tasks = set()
+        self.convergence = None
+        self.stopped = None
+
+    async def _resolve_model(self, session):
+        key = (self.host, self.parsed_options.model, self.parsed_options.provider)
+        if key not in _resolved_models:
+            _resolved_models[key] = await self._query_model(session)
+        return _resolved_models[key]
+
+    async def _query_model(self, session):
+        model = self.parsed_options.model
+        provider = self.parsed_options.provider
+        # guess based on URL
+        if provider is None:
+            provider = guess_provider_from_host(self.host)
+        if model is None:
+            model = default_model_name(provider)
+        if model and provider:
+            return model, provider
+
+        # vllm doesn't support /model/<name> endpoint, so iterate over all models
+        try:
+            async with session.get(self.host + "/v1/models", headers=self.headers) as resp:
+                resp.raise_for_status()
+                resp = await resp.json()
+        except Exception as e:
+            raise ValueError("Argument --model or --provider was not specified and /v1/models failed") from e
+        return pick_model(resp["data"], model, provider)
+
+    async def _setup(self, session):
+        self.model, self.provider = await self._resolve_model(session)
+        print(f" Provider {self.provider} using model {self.model} ".center(80, "*"))
+        self.provider_formatter = PROVIDER_CLASS_MAP[self.provider](self.model, self.parsed_options)
+        self.url = self.host + self.provider_formatter.get_url()
+        self.tokenizer = load_tokenizer(self.parsed_options.tokenizer)
+        self.prompt_source = PromptSource(self.parsed_options, self.tokenizer)
+        self.max_tokens_sampler = LengthSampler.from_options(self.parsed_options)
+        self.logging_params = make_logging_params(
+            self.provider, self.model, self.parsed_options, self.max_tokens_sampler
+        )
+        if self.parsed_options.qps is not None:
+            self.concurrency = f"{self.parsed_options.qps}"
+        else:
+            self.concurrency = self.parsed_options.users
+        if self.parsed_options.records_file:
+            self.records = open_sink(self.parsed_options.records_file)
+            self.record_fields = {
+                "run_label": self.parsed_options.run_label,
+                "provider": self.provider,
+                "model": self.model,
+                "concurrency": str(self.concurrency),
+            }
+        else:
+            self.records = None
+        self.live_metrics = start_exporter(
+            self.parsed_options,
+            {"provider": self.provider, "model": self.model, "run_label": self.parsed_options.run_label},
+        )
+        if self.parsed_options.trace_file:
+            self.tracer = open_tracer(
+                self.parsed_options.trace_file,
+                self.parsed_options.trace_sample_rate,
+                self.parsed_options.trace_max_events,
+            )
+            self.trace_pid = self.tracer.process(
+                self.parsed_options.run_label or f"{self.provider} {self.model} @ {self.concurrency}"
+            )
+            self.trace_lanes = Lanes()
+        else:
+            self.tracer = None
+        if self.tokenizer:
+            self.prompt_tokenizer_tokens = len(self.tokenizer.encode(self.prompt_source.peek()))
+            self.executor = concurrent.futures.ThreadPoolExecutor(1)
+            self.token_counter = TokenCounter(
+                self.tokenizer, partial(asyncio.get_running_loop().run_in_executor, self.executor)
+            )
+        else:
+            self.prompt_tokenizer_tokens = None
+            self.token_counter = None
+
+    async def _send_request(self, session, scheduled_time):
+        # an overloaded event loop sends requests late, latency has to count from when the request was due
+        schedule_lag = None if scheduled_time is None else max(0.0, time.time() - scheduled_time)
+        if not self.parsed_options.session_turns:
+            prompt, images, reused_prefix_tokens = self.prompt_source.get()
+            await self._send_turn(session, prompt, images, reused_prefix_tokens, schedule_lag=schedule_lag)
+            return
+
+        # a whole conversation, only its first turn follows the schedule
+        chat_session = ChatSession(self.prompt_source, self.parsed_options.chat, self.parsed_options.turn_tokens)
+        for turn in range(self.parsed_options.session_turns):
+            if turn > 0:
+                await asyncio.sleep(self.parsed_options.think_time)
+            prompt, images, reused_prefix_tokens, history = chat_session.next_turn(turn)
+            text = await self._send_turn(
+                session, prompt, images, reused_prefix_tokens, history, turn, schedule_lag if turn == 0 else None
+            )
+            chat_session.add_response(text)
+
+    async def _send_turn(
+        self, session, prompt, images, reused_prefix_tokens, history=None, turn=None, schedule_lag=None
+    ):
+        """
+        Returns the text of the response (empty unless it's collected)
+        """
+        max_tokens = self.max_tokens_sampler.sample()
+        data = self.provider_formatter.format_payload(prompt, max_tokens, images, history)
+        t_start = time.perf_counter()
+        acc = None
+
+        request_id = str(uuid4())
+        if self.live_metrics:
+            self.live_metrics.request_started()
+        # filled by the connection trace config and below
+        phases = {"pool_limit": True} if self.parsed_options.max_connections else {}
+        traced = self.tracer is not None and self.tracer.sample()
+        if traced:
+            user = _user_index.get()
+            if user is not None:
+                track, track_name = user, f"user {user}"
+            else:
+                # QPS mode, the request holds a lane while in flight
+                track = self.trace_lanes.acquire()
+                track_name = f"lane {track}"
+        t_end = None
+        error = None
+        try:
+            async with session.post(
+                self.url, data=orjson.dumps(data), headers=self.headers, trace_request_ctx=phases
+            ) as response:
+                phases["headers"] = time.perf_counter()
+                self.requests[request_id] = "initiated"
+                if response.status >= 400:
+                    raise RuntimeError(f"Error in response: {await response.text()}")
+                acc = ResponseAccumulator(
+                    self.provider_formatter,
+                    prompt,
+                    self.stream,
+                    # only the first turn of a session has the prompt the tokenizer counted
+                    self.prompt_tokenizer_tokens if not turn else None,
+                    collect_text=self.tokenizer is not None
+                    or self.parsed_options.show_response
+                    or bool(self.parsed_options.session_turns),
+                    reused_prefix_tokens=reused_prefix_tokens,
+                    turn=turn,
+                    verbose=not self.parsed_options.quiet,
+                )
+                if self.stream:
+                    parser = SSEParser()
+                    async for chunk in response.content.iter_any():
+                        self._add_payloads(acc, request_id, parser.feed(chunk))
+                    self._add_payloads(acc, request_id, parser.close())
+                else:
+                    self._add_payloads(acc, request_id, [await response.read()])
+                assert acc.t_first_token is not None, "empty response received"
+                self.requests[request_id] = "last_received"
+            t_end = time.perf_counter()
+        except Exception as e:
+            error = e
+            if self.records:
+                self.records.add(
+                    request_record(
+                        request_id,
+                        t_start,
+                        max_tokens,
+                        schedule_lag,
+                        acc,
+                        error=e,
+                        phases=phases,
+                        turn=turn,
+                        **self.record_fields,
+                    )
+                )
+            raise
+        finally:
+            if self.live_metrics:
+                self.live_metrics.request_finished(error is not None)
+            if traced:
+                if user is None:
+                    self.trace_lanes.release(track)
+                if error is None and t_end is None:
+                    # cancelled at the end of the run
+                    error = asyncio.CancelledError()
+                self.tracer.add_request(
+                    self.trace_pid,
+                    track,
+                    track_name,
+                    t_start,
+                    t_end,
+                    acc,
+                    schedule_lag,
+                    phases,
+                    error,
+                    request_id=request_id,
+                    turn=turn,
+                    max_tokens=max_tokens,
+                )
+        if self.parsed_options.show_response:
+            print("---")
+            print(acc.combined_text)
+            print("---")
+        record = partial(
+            self._record_metrics,
+            acc,
+            request_id,
+            turn,
+            t_start,
+            t_end,
+            max_tokens,
+            schedule_lag,
+            phases,
+            self.stats.start_time,
+        )
+        if self.token_counter:
+            self.token_counter.count(acc.combined_text, record)
+        else:
+            record(None)
+        return acc.combined_text
+
+    def _record_metrics(
+        self,
+        acc,
+        request_id,
+        turn,
+        t_start,
+        t_end,
+        max_tokens,
+        schedule_lag,
+        phases,
+        stats_start_time,
+        num_tokenizer_tokens,
+    ):
+        # stats may have been reset while the response was waiting for the tokenizer
+        measured = self.stats.start_time == stats_start_time
+        if not measured and not self.records:
+            return
+        num_tokens = acc.count_tokens(self.provider, num_tokenizer_tokens)
+        prompt_tokens = acc.count_prompt_tokens(self.provider)
+        if self.records:
+            record = request_record(
+                request_id,
+                t_start,
+                max_tokens,
+                schedule_lag,
+                acc,
+                t_end,
+                phases=phases,
+                turn=turn,
+                **self.record_fields,
+            )
+            # the request resetting the stats completes before the reset, so the stats start time alone isn't enough
+            record.update(prompt_tokens=prompt_tokens, output_tokens=num_tokens, measured=measured and self.warmed_up)
+            self.records.add(record)
+            if not measured:
+                return
+        metrics = acc.metrics(t_start, t_end, num_tokens, max_tokens, prompt_tokens, schedule_lag, phases)
+        evaluate_slo(metrics, self.parsed_options.slo_ttft, self.parsed_options.slo_tpot)
+        for name, (value, _) in metrics.items():
+            self.stats.record(name, value)
+        if self.live_metrics:
+            self.live_metrics.observe(metrics)
+        for name, samples in acc.chunk_samples(num_tokens).items():
+            for value, count in samples:
+                self.stats.record(name, value, count)
+        clock_offset = time.time() - time.perf_counter()
+        for name, samples in acc.throughput_samples(num_tokens, prompt_tokens).items():
+            for t, tokens in samples:
+                self.stats.record_series(name, t + clock_offset, tokens)
+        if self.convergence and self.convergence.observe(time.time(), metrics["total_latency"][0]):
+            self._reset_stats()
+
+    def _add_payloads(self, acc, request_id, payloads):
+        # all events of a network read arrived together, so they share the timestamp
+        now = time.perf_counter()
+        for payload in payloads:
+            if acc.add_chunk(payload, now):
+                self.requests[request_id] = "first_received"
+
+    async def _request(self, session, scheduled_time=None, first_of_user=False):
+        try:
+            await self._send_request(session, scheduled_time)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.num_failures += 1
+            print(f"Request failed: {repr(e)}", flush=True)
+            return
+        if self.convergence:
+            # the warm-up is detected from the latencies instead
+            return
+        if self.parsed_options.qps is not None:
+            # if in QPS mode, reset after first successful request comes back
+            if self.first_request_done == 0:
+                self._reset_stats()
+            self.first_request_done += 1
+        elif first_of_user:
+            self.first_request_done += 1
+            if self.first_request_done == self.parsed_options.users:
+                # if in fixed load mode, reset after all users issued one request (we're in a steady state)
+                self._reset_stats()
+
+    def _reset_stats(self):
+        print("Resetting stats after traffic reach a steady state")
+        self.stats.reset()
+        self.num_failures = 0
+        self.warmed_up = True
+
+    async def _wait(self, timeout):
+        """
+        Sleeps for `timeout` seconds, returns True if the run was stopped in the meantime
+        """
+        try:
+            await asyncio.wait_for(self.stopped.wait(), max(0, timeout))
+        except asyncio.TimeoutError:
+            pass
+        return self.stopped.is_set()
+
+    async def _watch_convergence(self):
+        metrics = ["time_to_first_token", "total_latency"] if self.stream else ["total_latency"]
+        while not await self._wait(1):
+            if self.convergence.converged(self.stats, metrics):
+                intervals = ", ".join(
+                    f"P{p} {name} [{low:.1f}, {high:.1f}]"
+                    for (name, p), (low, high) in self.convergence.intervals.items()
+                )
+                print(f"Percentiles converged: {intervals}", flush=True)
+                self.stopped.set()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run_qps(self, session, deadline):
+        # open loop: requests are issued on schedule no matter how many are still in flight
+        pacer = FixedQPSPacer.from_options(self.parsed_options)
+        while True:
+            scheduled_time = pacer.next_arrival()
+            if scheduled_time is None or scheduled_time >= deadline:
+                return
+            if await self._wait(pacer.wait_time_till(scheduled_time)):
+                return
+            self._spawn(self._request(session, scheduled_time))
+
+    async def _user_loop(self, session, index):
+        _user_index.set(index)
+        burst = self.parsed_options.burst
+        if not burst:
+            # introduce initial delay to avoid all users hitting the service at the same time
+            await asyncio.sleep(random.random())
+        first = True
+        while True:
+            t_iteration = time.monotonic()
+            await self._request(session, first_of_user=first)
+            first = False
+            if burst:
+                await asyncio.sleep(max(0, burst - (time.monotonic() - t_iteration)))
+
+    async def _run_users(self, session, deadline):
+        spawn_rate = self.parsed_options.spawn_rate
+        for index in range(self.parsed_options.users):
+            self._spawn(self._user_loop(session, index))
+            if await self._wait(1 / spawn_rate):
+                return
+        print(f"All users spawned: {self.parsed_options.users}")
+        await self._wait(deadline - time.time())
+
+    async def run(self, session=None):
+        """
+        Runs the benchmark and returns the summary entries or None if the run failed. `session` is an aiohttp session
+        from `create_session` to reuse the connections of previous runs
+        """
+        apply_trace_qps(self.parsed_options)
+        if self.parsed_options.qps is not None and self.parsed_options.burst:
+            raise ValueError("Burst and QPS modes are mutually exclusive")
+        if session is None:
+            async with create_session(self.parsed_options) as session:
+                return await self.run(session)
+
+        await self._setup(session)
+        self.stats.reset()
+        self.stopped = asyncio.Event()
+        if self.parsed_options.adaptive_duration:
+            # -t is the upper bound then
+            self.convergence = ConvergenceMonitor.from_options(self.parsed_options)
+            self._spawn(self._watch_convergence())
+        deadline = time.time() + self.parsed_options.run_time
+        if self.parsed_options.qps is not None:
+            await self._run_qps(session, deadline)
+            await self._wait(deadline - time.time())
+        else:
+            await self._run_users(session, deadline)
+        # unfinished requests stay in the tracker and are reported as incomplete
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.token_counter:
+            # token counts of the last responses may still be computed
+            while not self.token_counter.idle:
+                await asyncio.sleep(0.01)
+            self.executor.shutdown()
+
+        if self.num_failures > 0 or self.stats.num_requests("total_latency") == 0:
+            print("Test failed due to failed requests")
+            return None
+
+        concurrency = self.concurrency
+        if self.parsed_options.throughput_series_file:
+            append_throughput_series(
+                self.parsed_options.throughput_series_file, self.logging_params, concurrency, self.stats
+            )
+        states = list(self.requests.values())
+        return build_summary(
+            self.logging_params,
+            concurrency,
+            self.stats,
+            (len(states), states.count("initiated"), states.count("first_received")),
+            self.stream,
+            self.parsed_options.qps is not None,
+            self.convergence,
+        )
+
+
+def create_parser():
+    parser = configargparse.ArgumentParser(description=__doc__, formatter_class=configargparse.RawTextHelpFormatter)
+    parser.add_argument(
+        "-H",
+        "--host",
+        env_var="HOST",
+        type=str,
+        default="http://localhost:80",
+        help="Target endpoint URL (preceding /v1/...)",
+    )
+    parser.add_argument(
+        "-u",
+        "--users",
+        type=int,
+        default=1,
+        help="Number of concurrent users in fixed concurrency mode. Ignored with --qps which doesn't cap concurrency",
+    )
+    parser.add_argument(
+        "-r",
+        "--spawn-rate",
+        type=float,
+        default=1,
+        help="Rate of spawning users per second in fixed concurrency mode",
+    )
+    parser.add_argument(
+        "-t",
+        "--run-time",
+        type=parse_timespan,
+        default="60",
+        help="Duration of the test, e.g. 60, 90s, 5min. Defaults to 60 seconds",
+    )
+    add_arguments(parser)
+    return parser
+
+
+def main():
+    parsed_options = create_parser().parse_args()
+    try:
+        import uvloop
+
+        uvloop.install()
+    except ImportError:
+        pass
+    try:
+        entries = asyncio.run(AsyncEngine(parsed_options).run())
+    except Exception as e:
+        print(f"Failed to run: {repr(e)}")
+        print(traceback.format_exc())
+        sys.exit(1)
+    finally:
+        close_sinks()
+        stop_exporter()
+        close_tracers()
+    if entries is None:
+        sys.exit(1)
+    print_summary(entries)
+    if parsed_options.summary_file:
+        append_summary(parsed_options.summary_file, entries)
+
+
+if __name__ == "__main__":
+    main()
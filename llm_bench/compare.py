@@ -0,0 +1,393 @@
+"""
+Statistical comparison of benchmark results between versions, e.g. of the nightly run against the previous one.
+
+The points (prompt length and QPS/users) of every candidate result set are aligned with the ones of the baseline and
+for every point the time to first token, time per output token and total latency are tested for a regression:
+
+- with the per request records (`--records-file`) of both sides, a one-sided Mann-Whitney U test of the candidate's
+  latencies being larger and a bootstrap confidence interval of the relative change of the P90;
+- with only the summaries, whether the confidence intervals of the P90 overlap (time per output token has none, its
+  change is reported untested).
+
+The incomplete ratio is tested with a one-sided two-proportion z-test. A change is a regression if it's significant
+and larger than the minimal change that matters. The verdict is written as JSON, e.g.:
+
+    python compare.py --input-files previous.csv current.csv --records-files previous.parquet current.parquet \\
+        --verdict-file verdict.json --fail-on-regression
+"""
+
+import argparse
+import json
+import math
+import os
+import statistics
+import sys
+
+import numpy as np
+import pandas as pd
+
+from records import read_records
+
+
+# (name in the verdict, summary column of its P90, whether the summary has the confidence interval of the P90)
+LATENCY_METRICS = [
+    ("ttft", "P90 Time To First Token", True),
+    ("tpot", "P90 Latency Per Token", False),
+    ("total_latency", "P90 Total Latency", True),
+]
+# fewer samples than this on either side aren't tested
+MIN_SAMPLES = 20
+
+
+def _records_points(records):
+    """
+    One point per run (label and concurrency) of the records with the latencies (ms) of its measured requests
+    """
+    records = records.assign(
+        run_label=records["run_label"].fillna(""), concurrency=pd.to_numeric(records["concurrency"], errors="coerce")
+    )
+    points = []
+    for (_, concurrency), group in records.groupby(["run_label", "concurrency"], sort=False):
+        ok = group[group["status"] == "ok"]
+        measured = ok[ok["measured"].fillna(False).astype(bool)]
+        output_tokens = measured["output_tokens"].where(measured["output_tokens"] > 0)
+        samples = {
+            "ttft": (measured["first_token_time"] - measured["sent_time"]) * 1000,
+            "tpot": (measured["last_token_time"] - measured["first_token_time"]) * 1000 / output_tokens,
+            "total_latency": (measured["last_token_time"] - measured["sent_time"]) * 1000,
+        }
+        errors = int((group["status"] == "error").sum())
+        points.append(
+            {
+                "prompt_tokens": measured["prompt_tokens"].mean(),
+                "concurrency": concurrency,
+                "samples": {name: values.dropna().to_numpy() for name, values in samples.items()},
+                # requests still in flight at the end aren't recorded, only the failed ones count as incomplete
+                "total": len(measured) + errors,
+                "incomplete": errors,
+            }
+        )
+    return points
+
+
+def _summary_points(summary):
+    points = []
+    for entries in summary.to_dict("records"):
+        points.append(
+            {
+                "prompt_tokens": entries["Prompt Tokens"],
+                "concurrency": entries["Concurrency"],
+                "summary": entries,
+                "total": entries.get("Total Requests"),
+                "incomplete": entries.get("Incomplete Requests"),
+            }
+        )
+    return points
+
+
+def _match(point, points, tolerance):
+    """
+    The point with the same concurrency and the closest prompt length, within `tolerance` relative to it. The
+    summary has the prompt length measured by the server which differs a little between versions and providers
+    """
+    matches = [
+        other
+        for other in points
+        if math.isclose(other["concurrency"], point["concurrency"])
+        and abs(other["prompt_tokens"] - point["prompt_tokens"]) <= tolerance * max(point["prompt_tokens"], 1)
+    ]
+    return min(matches, key=lambda other: abs(other["prompt_tokens"] - point["prompt_tokens"]), default=None)
+
+
+def load_result_set(summary_file=None, records_file=None, label=None, tolerance=0.25):
+    """
+    Points of a result set from its summary file and/or its per request records, aligned with each other
+    """
+    points = _summary_points(pd.read_csv(summary_file)) if summary_file else None
+    if records_file:
+        record_points = _records_points(read_records(records_file))
+        if points is None:
+            points = record_points
+        else:
+            for point in points:
+                match = _match(point, record_points, tolerance)
+                if match is not None:
+                    point["samples"] = match["samples"]
+    return {"label": label or os.path.basename(summary_file or records_file), "points": points or []}
+
+
+def mann_whitney(baseline, candidate):
+    """
+    One-sided p-value of the candidate's values being stochastically larger than the baseline's, normal
+    approximation with tie and continuity corrections
+    """
+    n1, n2 = len(baseline), len(candidate)
+    values = np.concatenate([baseline, candidate])
+    order = values.argsort(kind="mergesort")
+    _, first, counts = np.unique(values[order], return_index=True, return_counts=True)
+    ranks = np.empty(len(values))
+    # ties get the average of their (1-based) ranks
+    ranks[order] = np.repeat(first + (counts + 1) / 2, counts)
+    u = ranks[n1:].sum() - n2 * (n2 + 1) / 2
+    n = n1 + n2
+    ties = (counts.astype(float) ** 3 - counts).sum() / (n * (n - 1))
+    sigma = math.sqrt(n1 * n2 / 12 * (n + 1 - ties))
+    if sigma == 0:
+        return 1.0
+    return 1 - statistics.NormalDist().cdf((u - n1 * n2 / 2 - 0.5) / sigma)
+
+
+def _quantile(sorted_values, fraction):
+    # nearest rank, the same definition as the bootstrap below
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def _bootstrap_quantiles(sorted_values, fraction, resamples, rng):
+    # the k-th smallest of n values resampled with replacement is the value at the k-th order statistic of n
+    # uniforms, which is Beta(k, n - k + 1) distributed: no need to resample the values themselves
+    n = len(sorted_values)
+    k = max(1, math.ceil(fraction * n))
+    indices = np.minimum((rng.beta(k, n - k + 1, resamples) * n).astype(int), n - 1)
+    return sorted_values[indices]
+
+
+def bootstrap_change(baseline, candidate, fraction=0.9, confidence=0.95, resamples=2000, seed=0):
+    """
+    Relative change of the percentile from the baseline to the candidate and its bootstrap confidence interval
+    """
+    rng = np.random.default_rng(seed)
+    baseline, candidate = np.sort(baseline), np.sort(candidate)
+    base = _quantile(baseline, fraction)
+    if base <= 0:
+        return None, (None, None)
+    changes = (
+        _bootstrap_quantiles(candidate, fraction, resamples, rng)
+        / np.maximum(_bootstrap_quantiles(baseline, fraction, resamples, rng), np.finfo(float).tiny)
+        - 1
+    )
+    low, high = np.quantile(changes, [(1 - confidence) / 2, (1 + confidence) / 2])
+    return _quantile(candidate, fraction) / base - 1, (float(low), float(high))
+
+
+def proportion_test(baseline_count, baseline_total, candidate_count, candidate_total):
+    """
+    One-sided p-value of the candidate's proportion being larger (two-proportion z-test)
+    """
+    pooled = (baseline_count + candidate_count) / (baseline_total + candidate_total)
+    se = math.sqrt(pooled * (1 - pooled) * (1 / baseline_total + 1 / candidate_total))
+    if se == 0:
+        return 1.0
+    z = (candidate_count / candidate_total - baseline_count / baseline_total) / se
+    return 1 - statistics.NormalDist().cdf(z)
+
+
+def _number(value):
+    value = pd.to_numeric(value, errors="coerce")
+    return None if pd.isna(value) else float(value)
+
+
+def _compare_latency(base, cand, metric, column, has_ci, alpha, min_change):
+    result = {"metric": metric, "baseline_p90": None, "candidate_p90": None, "change": None}
+    base_samples = base.get("samples", {}).get(metric)
+    cand_samples = cand.get("samples", {}).get(metric)
+    if (
+        base_samples is not None
+        and cand_samples is not None
+        and min(len(base_samples), len(cand_samples)) >= MIN_SAMPLES
+    ):
+        change, (low, high) = bootstrap_change(base_samples, cand_samples)
+        p_larger = mann_whitney(base_samples, cand_samples)
+        result.update(
+            method="mann-whitney+bootstrap",
+            baseline_p90=_quantile(np.sort(base_samples), 0.9),
+            candidate_p90=_quantile(np.sort(cand_samples), 0.9),
+            change=change,
+            ci=[low, high],
+            p_value=p_larger,
+        )
+        if change is None:
+            result["verdict"] = "untested"
+        elif p_larger < alpha and low > 0 and change > min_change:
+            result["verdict"] = "regression"
+        elif 1 - p_larger < alpha and high < 0 and change < -min_change:
+            result["verdict"] = "improvement"
+        else:
+            result["verdict"] = "unchanged"
+        return result
+
+    if "summary" not in base or "summary" not in cand:
+        result.update(method=None, verdict="untested")
+        return result
+    base_p90, cand_p90 = _number(base["summary"].get(column)), _number(cand["summary"].get(column))
+    result.update(baseline_p90=base_p90, candidate_p90=cand_p90)
+    if base_p90 is None or cand_p90 is None or base_p90 <= 0:
+        result.update(method=None, verdict="untested")
+        return result
+    change = cand_p90 / base_p90 - 1
+    result["change"] = change
+    bounds = [
+        _number(side["summary"].get(f"{column} Ci {bound}")) for side in (base, cand) for bound in ("Low", "High")
+    ]
+    if not has_ci or None in bounds:
+        result.update(method=None, verdict="untested")
+        return result
+    base_low, base_high, cand_low, cand_high = bounds
+    result["method"] = "ci-overlap"
+    if cand_low > base_high and change > min_change:
+        result["verdict"] = "regression"
+    elif cand_high < base_low and change < -min_change:
+        result["verdict"] = "improvement"
+    else:
+        result["verdict"] = "unchanged"
+    return result
+
+
+def _compare_incomplete(base, cand, alpha, min_change):
+    result = {"metric": "incomplete_ratio", "method": "proportion-z-test"}
+    counts = [_number(side.get(key)) for side in (base, cand) for key in ("incomplete", "total")]
+    if None in counts or not counts[1] or not counts[3]:
+        result.update(method=None, verdict="untested")
+        return result
+    base_count, base_total, cand_count, cand_total = counts
+    base_ratio, cand_ratio = base_count / base_total, cand_count / cand_total
+    p_larger = proportion_test(base_count, base_total, cand_count, cand_total)
+    p_smaller = proportion_test(cand_count, cand_total, base_count, base_total)
+    # absolute change, a ratio near 0 makes the relative one meaningless
+    result.update(
+        baseline_ratio=base_ratio, candidate_ratio=cand_ratio, change=cand_ratio - base_ratio, p_value=p_larger
+    )
+    if p_larger < alpha and cand_ratio - base_ratio > min_change:
+        result["verdict"] = "regression"
+    elif p_smaller < alpha and base_ratio - cand_ratio > min_change:
+        result["verdict"] = "improvement"
+    else:
+        result["verdict"] = "unchanged"
+    return result
+
+
+def compare(baseline, candidates, alpha=0.01, min_change=0.1, min_incomplete_change=0.01, tolerance=0.25):
+    """
+    Compares every candidate result set (see `load_result_set`) with the baseline. `alpha` is the significance level
+    of every test, `min_change` the smallest relative change of a P90 latency and `min_incomplete_change` the
+    smallest absolute change of the incomplete ratio reported as a regression. Returns the verdict as a dict
+    """
+    comparisons, unmatched = [], []
+    for candidate in candidates:
+        for cand in candidate["points"]:
+            base = _match(cand, baseline["points"], tolerance)
+            point = {
+                "candidate": candidate["label"],
+                "prompt_tokens": _number(cand["prompt_tokens"]),
+                "concurrency": _number(cand["concurrency"]),
+            }
+            if base is None:
+                unmatched.append(point)
+                continue
+            for metric, column, has_ci in LATENCY_METRICS:
+                comparisons.append({**point, **_compare_latency(base, cand, metric, column, has_ci, alpha, min_change)})
+            comparisons.append({**point, **_compare_incomplete(base, cand, alpha, min_incomplete_change)})
+    regressions = [c for c in comparisons if c["verdict"] == "regression"]
+    return {
+        "baseline": baseline["label"],
+        "candidates": [candidate["label"] for candidate in candidates],
+        "alpha": alpha,
+        "min_change": min_change,
+        "min_incomplete_change": min_incomplete_change,
+        "regression": bool(regressions),
+        "regressions": regressions,
+        "improvements": [c for c in comparisons if c["verdict"] == "improvement"],
+        "comparisons": comparisons,
+        "unmatched": unmatched,
+    }
+
+
+def print_verdict(verdict):
+    print("=" * 80)
+    print(f"Baseline: {verdict['baseline']}, candidates: {', '.join(verdict['candidates'])}")
+    tested = [c for c in verdict["comparisons"] if c["verdict"] != "untested"]
+    print(f"{len(tested)} of {len(verdict['comparisons'])} comparisons tested, {len(verdict['unmatched'])} unmatched")
+    for kind in ("regressions", "improvements"):
+        print(f"{kind.capitalize()}: {len(verdict[kind])}")
+        for c in verdict[kind]:
+            change = f"{c['change']:+.3f}" if c["metric"] == "incomplete_ratio" else f"{c['change']:+.1%}"
+            print(
+                f"  {c['candidate']} prompt_tokens={c['prompt_tokens']:g} concurrency={c['concurrency']:g} "
+                f"{c['metric']}: {change} ({c['method']})"
+            )
+    print("=" * 80)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detects performance regressions between benchmark result sets")
+    parser.add_argument(
+        "--input-files",
+        nargs="+",
+        required=True,
+        help="Summary files of the result sets, the first one is the baseline the others are compared with",
+    )
+    parser.add_argument(
+        "--records-files",
+        nargs="+",
+        help="Per request records (--records-file) of the result sets, one per input file. Missing files fall back "
+        "to the summary",
+    )
+    parser.add_argument("--labels", nargs="+", help="Names of the result sets in the verdict, one per input file")
+    parser.add_argument("--alpha", type=float, default=0.01, help="Significance level of every test")
+    parser.add_argument(
+        "--min-change",
+        type=float,
+        default=0.1,
+        help="Smallest relative change of a P90 latency reported as a regression",
+    )
+    parser.add_argument(
+        "--min-incomplete-change",
+        type=float,
+        default=0.01,
+        help="Smallest absolute change of the incomplete requests ratio reported as a regression",
+    )
+    parser.add_argument(
+        "--prompt-tolerance",
+        type=float,
+        default=0.25,
+        help="Points are aligned by concurrency and the closest prompt length within this fraction",
+    )
+    parser.add_argument("--verdict-file", type=str, help="Write the verdict as JSON to the specified file")
+    parser.add_argument(
+        "--fail-on-regression",
+        action="store_true",
+        default=False,
+        help="Exit with status 1 if a regression is found",
+    )
+    args = parser.parse_args()
+    assert len(args.input_files) >= 2, "Pass a baseline and at least one candidate"
+    for name in ("records_files", "labels"):
+        values = getattr(args, name)
+        assert values is None or len(values) == len(args.input_files), f"Pass one of --{name} per input file"
+
+    result_sets = []
+    for idx, summary_file in enumerate(args.input_files):
+        records_file = args.records_files[idx] if args.records_files else None
+        if records_file and not os.path.exists(records_file):
+            print(f"{records_file} not found, comparing {summary_file} by its summary")
+            records_file = None
+        label = args.labels[idx] if args.labels else None
+        result_sets.append(load_result_set(summary_file, records_file, label, args.prompt_tolerance))
+
+    verdict = compare(
+        result_sets[0],
+        result_sets[1:],
+        alpha=args.alpha,
+        min_change=args.min_change,
+        min_incomplete_change=args.min_incomplete_change,
+        tolerance=args.prompt_tolerance,
+    )
+    print_verdict(verdict)
+    if args.verdict_file:
+        with open(args.verdict_file, "w") as f:
+            json.dump(verdict, f, indent=2, default=float)
+    if args.fail_on_regression and verdict["regression"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
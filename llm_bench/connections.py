@@ -0,0 +1,78 @@
+"""
+Connection pool of the Locust engine (requests on top of urllib3) timing the phases of every request: the connect
+(DNS and TCP) and the TLS handshake when the request opens a connection, and when the request is written.
+"""
+
+import time
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+class _TimedConnection:
+    """
+    Keeps the `perf_counter` times of its last connect in `phases` and when its last request was written in
+    `request_sent`
+    """
+
+    phases = None
+    request_sent = None
+
+    def _new_conn(self):
+        # DNS resolution and TCP connect, the connect of both HTTP and HTTPS starts with it
+        self.phases = {"connect_start": time.perf_counter()}
+        sock = super()._new_conn()
+        if isinstance(self, HTTPSConnection):
+            self.phases["tls_start"] = time.perf_counter()
+        return sock
+
+    def connect(self):
+        super().connect()
+        self.phases["connect_end"] = time.perf_counter()
+
+    def request(self, *args, **kwargs):
+        result = super().request(*args, **kwargs)
+        self.request_sent = time.perf_counter()
+        return result
+
+
+class TimedHTTPConnection(_TimedConnection, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(_TimedConnection, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedAdapter(HTTPAdapter):
+    """
+    Adapter to mount on a requests session so that its connections are timed, see `request_phases`
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
+
+
+def request_phases(response, t_start):
+    """
+    Phases of the request of a streamed `response` (its connection is still attached) sent at `t_start` through a
+    `TimedAdapter`: `request_sent` and, if the request opened its connection, `connect_start`, `tls_start` (HTTPS) and
+    `connect_end`. Empty for other connections
+    """
+    connection = getattr(response.raw, "_connection", None)
+    if getattr(connection, "request_sent", None) is None:
+        return {}
+    phases = {"request_sent": connection.request_sent}
+    if connection.phases and connection.phases["connect_start"] >= t_start:
+        phases.update(connection.phases)
+    return phases
@@ -0,0 +1,123 @@
+import math
+import statistics
+import time
+
+
+def confidence_interval(stats, name, fraction, confidence=0.95):
+    """
+    Distribution-free confidence interval of a percentile: the order statistics whose ranks bound the binomial
+    number of samples below the true percentile. `stats` is the registry the summary is computed from
+    """
+    n = stats.num_requests(name)
+    if n == 0:
+        return 0, 0
+    z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+    half_width = z * math.sqrt(n * fraction * (1 - fraction)) + 1
+    low = stats.percentile(name, max(0.0, n * fraction - half_width) / n)
+    high = stats.percentile(name, min(float(n), n * fraction + half_width) / n)
+    return low, high
+
+
+class ConvergenceMonitor:
+    """
+    Decides when a run reached a steady state and when it has enough samples, so that the duration adapts to the
+    load instead of being fixed.
+
+    Warm-up: completed requests are grouped into consecutive windows of at least `window` seconds and
+    `MIN_WINDOW_REQUESTS` requests. The warm-up is over once the median latency and the throughput of the last
+    `STABLE_WINDOWS` windows are within `tolerance` of their mean, widened by the sampling noise of small windows.
+
+    Convergence: after the warm-up, the confidence interval of every percentile in `percentiles` of every metric has
+    to be narrower than `ci_target` relative to the percentile itself
+    """
+
+    MIN_WINDOW_REQUESTS = 5
+    STABLE_WINDOWS = 3
+
+    def __init__(self, window=10.0, tolerance=0.1, ci_target=0.05, min_requests=50, percentiles=(50, 90)):
+        self.window = window
+        self.tolerance = tolerance
+        self.ci_target = ci_target
+        self.min_requests = min_requests
+        self.percentiles = percentiles
+        self.start_time = time.time()
+        self.window_start = None
+        self.current = []  # latencies of the window being filled
+        self.windows = []  # [(throughput, median latency, number of requests)]
+        self.warmup_end = None
+        self.converged_at = None
+        self.intervals = {}  # {(metric, percentile): (low, high)} of the last convergence check
+
+    @classmethod
+    def from_options(cls, parsed_options):
+        return cls(
+            window=parsed_options.warmup_window,
+            ci_target=parsed_options.ci_target,
+            min_requests=parsed_options.ci_min_requests,
+        )
+
+    @property
+    def warmed_up(self):
+        return self.warmup_end is not None
+
+    def mark_warmed_up(self, now=None):
+        """
+        For when the warm-up is decided elsewhere, e.g. by the master in distributed mode
+        """
+        if self.warmup_end is None:
+            self.warmup_end = time.time() if now is None else now
+
+    def observe(self, now, latency):
+        """
+        Adds a completed request, returns True if it ends the warm-up, the stats should be reset then
+        """
+        if self.warmup_end is not None:
+            return False
+        if self.window_start is None:
+            self.window_start = now
+        self.current.append(latency)
+        elapsed = now - self.window_start
+        if elapsed < self.window or len(self.current) < self.MIN_WINDOW_REQUESTS:
+            return False
+        self.windows.append((len(self.current) / elapsed, statistics.median(self.current), len(self.current)))
+        self.window_start = now
+        self.current = []
+        if not self._stable(self.windows[-self.STABLE_WINDOWS :]):
+            return False
+        self.warmup_end = now
+        return True
+
+    def _stable(self, windows):
+        if len(windows) < self.STABLE_WINDOWS:
+            return False
+        # relative noise of a rate or a median estimated from n samples is roughly 1 / sqrt(n)
+        allowed = self.tolerance + 2 / math.sqrt(min(count for _, _, count in windows))
+        for values in ([w[0] for w in windows], [w[1] for w in windows]):
+            mean = sum(values) / len(values)
+            if mean > 0 and (max(values) - min(values)) / mean > allowed:
+                return False
+        return True
+
+    def converged(self, stats, metrics):
+        """
+        Whether the percentiles of `metrics` recorded in `stats` since the warm-up are known precisely enough
+        """
+        if self.warmup_end is None:
+            return False
+        result = True
+        for name in metrics:
+            if stats.num_requests(name) < self.min_requests:
+                return False
+            for percentile in self.percentiles:
+                low, high = confidence_interval(stats, name, percentile / 100)
+                self.intervals[(name, percentile)] = (low, high)
+                value = stats.percentile(name, percentile / 100)
+                if value > 0 and (high - low) / 2 > self.ci_target * value:
+                    result = False
+        if result and self.converged_at is None:
+            self.converged_at = time.time()
+        return result
+
+    @property
+    def warmup_time(self):
+        return self.warmup_end - self.start_time if self.warmup_end is not None else None
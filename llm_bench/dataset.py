@@ -0,0 +1,148 @@
+import functools
+import json
+import mmap
+import os
+import random
+import tempfile
+
+import numpy as np
+import orjson
+
+
+INDEX_VERSION = 1
+
+
+class JsonlDataset:
+    """
+    A JSONL file of `{"prompt": ..., "images": [...]}` records, memory-mapped and decoded lazily when a record is
+    sampled, so memory doesn't depend on the size of the dataset and all users of a process share the same pages.
+
+    Line offsets and per record metadata (byte size, number of images, prompt length in tokens if a tokenizer is
+    given) are computed once and stored next to the file in a sidecar `<file>.idx.npz`, which is reused as long as
+    the file doesn't change
+    """
+
+    def __init__(self, path, tokenizer=None):
+        self.path = path
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ValueError(f"Dataset {path} is empty")
+            # the mapping stays valid after the file is closed
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.key = self._key(tokenizer)
+        index = self._load_index()
+        if index is None:
+            index = self._build_index(tokenizer)
+            self._save_index(index)
+        self.starts = index["starts"]
+        self.ends = index["ends"]
+        self.num_images = index["num_images"]
+        self.prompt_tokens = index["prompt_tokens"]
+        if len(self.starts) == 0:
+            raise ValueError(f"Dataset {path} has no records")
+
+    def _key(self, tokenizer):
+        stat = os.stat(self.path)
+        return {
+            "version": INDEX_VERSION,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "tokenizer": tokenizer.name_or_path if tokenizer is not None else None,
+        }
+
+    @property
+    def index_path(self):
+        return self.path + ".idx.npz"
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return None
+        try:
+            with np.load(self.index_path) as index:
+                key = json.loads(str(index["key"]))
+                # an index with token counts serves runs without a tokenizer too
+                if self.key["tokenizer"] is None:
+                    key["tokenizer"] = None
+                if key != self.key:
+                    return None
+                return {name: index[name] for name in ("starts", "ends", "num_images", "prompt_tokens")}
+        except Exception as e:
+            print(f"WARNING: ignoring broken dataset index {self.index_path}: {repr(e)}")
+            return None
+
+    def _build_index(self, tokenizer):
+        print(f"Indexing dataset {self.path}")
+        data = self.data
+        starts, ends = [], []
+        pos = 0
+        while pos < len(data):
+            end = data.find(b"\n", pos)
+            if end == -1:
+                end = len(data)
+            if data[pos:end].strip():
+                starts.append(pos)
+                ends.append(end)
+            pos = end + 1
+        num_images = np.zeros(len(starts), dtype=np.int32)
+        prompt_tokens = np.full(len(starts), -1, dtype=np.int64)
+        batch = []
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            record = orjson.loads(data[start:end])
+            assert "prompt" in record, f"Record {i} of {self.path} has no prompt"
+            num_images[i] = len(record.get("images") or [])
+            if tokenizer is not None:
+                batch.append(record["prompt"])
+                if len(batch) == 256 or i == len(starts) - 1:
+                    counts = [len(ids) for ids in tokenizer(batch)["input_ids"]]
+                    prompt_tokens[i - len(batch) + 1 : i + 1] = counts
+                    batch = []
+        return {
+            "starts": np.array(starts, dtype=np.int64),
+            "ends": np.array(ends, dtype=np.int64),
+            "num_images": num_images,
+            "prompt_tokens": prompt_tokens,
+        }
+
+    def _save_index(self, index):
+        # the dataset directory may be read-only, the index is then rebuilt by every process
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.index_path) or ".", suffix=".tmp.npz")
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, key=json.dumps(self.key), **index)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print(f"WARNING: failed to save dataset index {self.index_path}: {repr(e)}")
+        finally:
+            # gone once replaced, left behind if writing failed
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except FileNotFoundError:
+                    pass
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        return orjson.loads(self.data[self.starts[i] : self.ends[i]])
+
+    def sample(self):
+        return self[random.randrange(len(self.starts))]
+
+    def describe(self):
+        sizes = self.ends - self.starts
+        s = f"{len(self)} records, {sizes.mean() / 1024:.1f} KiB and {self.num_images.mean():.2f} images on average"
+        if self.prompt_tokens[0] >= 0:
+            s += f", prompts of {self.prompt_tokens.mean():.0f} tokens on average"
+        return s
+
+
+@functools.lru_cache(maxsize=None)
+def load_dataset(path, tokenizer=None):
+    """
+    One dataset per process no matter how many users sample from it
+    """
+    dataset = JsonlDataset(path, tokenizer)
+    print(f"Dataset {path}: {dataset.describe()}")
+    return dataset
@@ -26,10 +26,14 @@ mkdir -p $OUTPUT_DIR/perfectcache
 mkdir -p $OUTPUT_DIR/reports
 
 echo "adaptive - 100% cache hit rate"
-./launch_all.sh -s $OUTPUT_DIR/perfectcache/$PREFIX-adaptive.csv -u $ADAPTIVE_ENDPOINT -p adaptive -m test -k $ADAPTIVE_API_KEY
+./launch_all.sh -s $OUTPUT_DIR/perfectcache/$PREFIX-adaptive.csv -u $ADAPTIVE_ENDPOINT -p adaptive -m test -k $ADAPTIVE_API_KEY -w
 
 echo "adaptive - 0% cache hit rate (randomized beginning tokens for each prompt)"
-./launch_all.sh -s $OUTPUT_DIR/nocache/$PREFIX-adaptive.csv -u $ADAPTIVE_ENDPOINT -p adaptive -m test -k $ADAPTIVE_API_KEY -r
+./launch_all.sh -s $OUTPUT_DIR/nocache/$PREFIX-adaptive.csv -u $ADAPTIVE_ENDPOINT -p adaptive -m test -k $ADAPTIVE_API_KEY -r -w
+
+#echo "adaptive - 50% cache hit rate (half of the requests share a system prompt of half of the prompt)"
+#mkdir -p $OUTPUT_DIR/halfcache
+#./launch_all.sh -s $OUTPUT_DIR/halfcache/$PREFIX-adaptive.csv -u $ADAPTIVE_ENDPOINT -p adaptive -m test -k $ADAPTIVE_API_KEY -c 0.5
 
 #echo "vllm - 100% cache hit rate"
 #./launch_all.sh -s $OUTPUT_DIR/perfectcache/$PREFIX-vllm.csv -u $VLLM_ENDPOINT
@@ -42,8 +46,19 @@ echo "adaptive - 0% cache hit rate (randomized beginning tokens for each prompt)
 # python plotting.py --model Llama-3.1-8b --output-tokens 128 --input-files $OUTPUT_DIR/perfectcache/$PREFIX-adaptive.csv $OUTPUT_DIR/perfectcache/$VLLM_REF-vllm.csv --output-file $OUTPUT_DIR/reports/$PREFIX-vllm-adaptive-perfectcache.html --extra-header "Adaptive $ADAPTIVE_VERSION vs. vllm 0.7.1 (randomized prompts)"
 
 echo "Generate plots (current adaptive [$ADAPTIVE_VERSION] vs previous adaptive [$ADAPTIVE_REF_LATEST_VERSION] vs vllm)"
-python plotting.py --model Llama-3.1-8b --output-tokens 128 --input-files $OUTPUT_DIR/nocache/$PREFIX-adaptive.csv $OUTPUT_DIR/nocache/$ADAPTIVE_REF-adaptive.csv $OUTPUT_DIR/nocache/$VLLM_REF-vllm.csv --output-file $OUTPUT_DIR/reports/$PREFIX-adaptive-$ADAPTIVE_VERSION-vs-$ADAPTIVE_REF_LATEST_VERSION-nocache.html --extra-header "Adaptive $ADAPTIVE_VERSION vs. $ADAPTIVE_REF_LATEST_VERSION vs vllm (randomized prompts)" --provider-suffixes $ADAPTIVE_VERSION $ADAPTIVE_REF_LATEST_VERSION "0.7"
-python plotting.py --model Llama-3.1-8b --output-tokens 128 --input-files $OUTPUT_DIR/perfectcache/$PREFIX-adaptive.csv $OUTPUT_DIR/perfectcache/$ADAPTIVE_REF-adaptive.csv $OUTPUT_DIR/perfectcache/$VLLM_REF-vllm.csv --output-file $OUTPUT_DIR/reports/$PREFIX-adaptive-$ADAPTIVE_VERSION-vs-$ADAPTIVE_REF_LATEST_VERSION-perfectcache.html --extra-header "Adaptive $ADAPTIVE_VERSION vs. $ADAPTIVE_REF_LATEST_VERSION vs vllm (randomized prompts)" --provider-suffixes $ADAPTIVE_VERSION $ADAPTIVE_REF_LATEST_VERSION "0.7"
+python plotting.py --model Llama-3.1-8b --output-tokens 128 --input-files $OUTPUT_DIR/nocache/$PREFIX-adaptive.csv $OUTPUT_DIR/nocache/$ADAPTIVE_REF-adaptive.csv $OUTPUT_DIR/nocache/$VLLM_REF-vllm.csv --output-file $OUTPUT_DIR/reports/$PREFIX-adaptive-$ADAPTIVE_VERSION-vs-$ADAPTIVE_REF_LATEST_VERSION-nocache.html --results-db $OUTPUT_DIR/results.db --workload nocache --extra-header "Adaptive $ADAPTIVE_VERSION vs. $ADAPTIVE_REF_LATEST_VERSION vs vllm (randomized prompts)" --provider-suffixes $ADAPTIVE_VERSION $ADAPTIVE_REF_LATEST_VERSION "0.7"
+python plotting.py --model Llama-3.1-8b --output-tokens 128 --input-files $OUTPUT_DIR/perfectcache/$PREFIX-adaptive.csv $OUTPUT_DIR/perfectcache/$ADAPTIVE_REF-adaptive.csv $OUTPUT_DIR/perfectcache/$VLLM_REF-vllm.csv --output-file $OUTPUT_DIR/reports/$PREFIX-adaptive-$ADAPTIVE_VERSION-vs-$ADAPTIVE_REF_LATEST_VERSION-perfectcache.html --results-db $OUTPUT_DIR/results.db --workload perfectcache --extra-header "Adaptive $ADAPTIVE_VERSION vs. $ADAPTIVE_REF_LATEST_VERSION vs vllm (randomized prompts)" --provider-suffixes $ADAPTIVE_VERSION $ADAPTIVE_REF_LATEST_VERSION "0.7"
+
+echo "Detect regressions (current adaptive [$ADAPTIVE_VERSION] vs previous adaptive [$ADAPTIVE_REF_LATEST_VERSION])"
+REGRESSIONS=""
+for CACHE in nocache perfectcache; do
+  VERDICT_FILE=$PREFIX-adaptive-$ADAPTIVE_VERSION-vs-$ADAPTIVE_REF_LATEST_VERSION-$CACHE-verdict.json
+  # the previous run may predate the per request records, its summary is compared then
+  python compare.py --input-files $OUTPUT_DIR/$CACHE/$ADAPTIVE_REF-adaptive.csv $OUTPUT_DIR/$CACHE/$PREFIX-adaptive.csv --records-files $OUTPUT_DIR/$CACHE/$ADAPTIVE_REF-adaptive-records.parquet $OUTPUT_DIR/$CACHE/$PREFIX-adaptive-records.parquet --labels $ADAPTIVE_REF_LATEST_VERSION $ADAPTIVE_VERSION --verdict-file $OUTPUT_DIR/reports/$VERDICT_FILE || echo "comparison failed ($CACHE)"
+  if [ "$(jq -r '.regression' $OUTPUT_DIR/reports/$VERDICT_FILE 2>/dev/null)" = "true" ]; then
+    REGRESSIONS+="  ⚠️ <${BENCHMARKS_PAGE}/${VERDICT_FILE}|Performance regressions ($CACHE)>\n"
+  fi
+done
 
 echo "mark Reference version for next benchmark runs"
 echo $PREFIX > $OUTPUT_DIR/latest.txt
@@ -56,6 +71,11 @@ echo "publish slack message"
 curl -X POST -H 'Content-type: application/json' --data "{
   \"text\": \"*Latest Inference Benchmark Reports Available: Adaptive [$ADAPTIVE_VERSION] vs [$ADAPTIVE_REF_LATEST_VERSION]*\n
   🔗 <${PERFECT_CACHE_REPORT_URL}|Perfect Cache>\n
-  🔗 <${NO_CACHE_REPORT_URL}|No Cache>\"
+  🔗 <${NO_CACHE_REPORT_URL}|No Cache>\n
+$REGRESSIONS\"
 }" "$SLACK_WEBHOOK_URL"
 
+if [ -n "$REGRESSIONS" ]; then
+  echo "Performance regressions detected"
+  exit 1
+fi
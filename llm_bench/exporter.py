@@ -0,0 +1,308 @@
+import atexit
+import http.server
+import math
+import os
+import threading
+import time
+
+from metrics import DEFAULT_SCALE, METRIC_SCALES, HdrHistogram
+
+
+PREFIX = "llm_bench_"
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+# (metric recorded by the engines, exported name, help), all in ms
+LATENCY_METRICS = [
+    ("time_to_first_token", "time_to_first_token_milliseconds", "Time to first token"),
+    ("latency_per_token", "time_per_output_token_milliseconds", "Time per output token"),
+    ("total_latency", "total_latency_milliseconds", "Total latency of a request"),
+    ("schedule_lag", "schedule_lag_milliseconds", "How late requests were sent compared to the fixed QPS schedule"),
+]
+TOKEN_METRICS = [
+    ("prompt_tokens", "prompt_tokens", "Prompt tokens of completed requests"),
+    ("num_tokens", "output_tokens", "Output tokens of completed requests"),
+]
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class _Ring:
+    """
+    `slots` buckets each covering `window / slots` seconds of wall clock time, a bucket is replaced by a new one once
+    it's older than the window
+    """
+
+    def __init__(self, window, slots, factory):
+        self.slot_duration = window / slots
+        self.factory = factory
+        self.slots = [None] * slots  # (slot index, bucket)
+
+    def bucket(self, now):
+        index = int(now // self.slot_duration)
+        position = index % len(self.slots)
+        slot = self.slots[position]
+        if slot is None or slot[0] != index:
+            slot = self.slots[position] = (index, self.factory())
+        return slot[1]
+
+    def covered(self, now):
+        """
+        Seconds covered by the live buckets: the whole older ones and the current one so far
+        """
+        return now - (int(now // self.slot_duration) - len(self.slots) + 1) * self.slot_duration
+
+    def live(self, now):
+        current = int(now // self.slot_duration)
+        return [slot[1] for slot in self.slots if slot is not None and current - slot[0] < len(self.slots)]
+
+
+class RollingHistogram:
+    """
+    Histogram of the values recorded in the last `window` seconds. Recording and reading cost the same whatever the
+    number of values: a value goes to the histogram of its slot and reading merges the live slots
+    """
+
+    def __init__(self, scale=DEFAULT_SCALE, window=60.0, slots=6):
+        self.scale = scale
+        self.ring = _Ring(window, slots, lambda: HdrHistogram(scale))
+
+    def record(self, value, now):
+        self.ring.bucket(now).record(value)
+
+    def merged(self, now):
+        hist = HdrHistogram(self.scale)
+        for slot in self.ring.live(now):
+            hist.merge(slot)
+        return hist
+
+
+class RollingSum:
+    """
+    Sum of the values added in the last `window` seconds
+    """
+
+    def __init__(self, window=60.0, slots=6):
+        self.ring = _Ring(window, slots, lambda: [0])
+
+    def add(self, value, now):
+        self.ring.bucket(now)[0] += value
+
+    def total(self, now):
+        return sum(slot[0] for slot in self.ring.live(now))
+
+    def rate(self, now, start_time):
+        """
+        Per second over the live buckets, or since `start_time` if it's more recent
+        """
+        return self.total(now) / max(min(self.ring.covered(now), now - start_time), 1e-9)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return "NaN"
+    # shortest exact representation, counters must not lose precision
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class LiveMetrics:
+    """
+    Live view of a run in the OpenMetrics text format: quantiles of the latencies over a rolling window, cumulative
+    counters of requests and tokens, the requests in flight and the tokens/s over the window. Rendering cost depends
+    on the number of metrics and the dynamic range of the values, not on the QPS, so long runs can be scraped (or
+    snapshotted to a file) as often as needed
+    """
+
+    def __init__(self, window=60.0, labels=None):
+        self.lock = threading.Lock()
+        self.window = window
+        self.labels = labels or {}
+        self.start_time = time.time()
+        self.latencies = {
+            name: RollingHistogram(METRIC_SCALES.get(name, DEFAULT_SCALE), window) for name, _, _ in LATENCY_METRICS
+        }
+        # cumulative [count, sum] of the latencies, OpenMetrics summaries have them over the whole run
+        self.latency_totals = {name: [0, 0.0] for name, _, _ in LATENCY_METRICS}
+        self.tokens = {name: RollingSum(window) for name, _, _ in TOKEN_METRICS}
+        self.token_totals = {name: 0 for name, _, _ in TOKEN_METRICS}
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+
+    def request_started(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def request_finished(self, error=False):
+        with self.lock:
+            self.in_flight -= 1
+            self.requests += 1
+            self.errors += bool(error)
+
+    def observe(self, metrics):
+        """
+        Records a completed request, `metrics` is the output of `ResponseAccumulator.metrics`
+        """
+        now = time.time()
+        with self.lock:
+            for name, hist in self.latencies.items():
+                if name in metrics:
+                    value = metrics[name][0]
+                    hist.record(value, now)
+                    totals = self.latency_totals[name]
+                    totals[0] += 1
+                    totals[1] += value
+            for name, tokens in self.tokens.items():
+                if name in metrics:
+                    tokens.add(metrics[name][0], now)
+                    self.token_totals[name] += metrics[name][0]
+
+    def _labels(self, **extra):
+        labels = {**{k: v for k, v in self.labels.items() if v is not None}, **extra}
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+    def render(self):
+        now = time.time()
+        labels = self._labels()
+        lines = []
+        with self.lock:
+            for name, exported, description in LATENCY_METRICS:
+                full_name = PREFIX + exported
+                hist = self.latencies[name].merged(now)
+                lines += [
+                    f"# TYPE {full_name} summary",
+                    f"# UNIT {full_name} milliseconds",
+                    f"# HELP {full_name} {description}, quantiles over the last {self.window:g}s",
+                ]
+                for quantile in QUANTILES:
+                    value = hist.percentile(quantile) if hist.count else None
+                    lines.append(f"{full_name}{self._labels(quantile=quantile)} {_format(value)}")
+                count, total = self.latency_totals[name]
+                lines += [f"{full_name}_sum{labels} {_format(total)}", f"{full_name}_count{labels} {count}"]
+            for name, exported, description in TOKEN_METRICS:
+                full_name = PREFIX + exported
+                lines += [
+                    f"# TYPE {full_name} counter",
+                    f"# HELP {full_name} {description}",
+                    f"{full_name}_total{labels} {_format(self.token_totals[name])}",
+                    f"# TYPE {full_name}_per_second gauge",
+                    f"# HELP {full_name}_per_second {description} per second over the last {self.window:g}s",
+                    f"{full_name}_per_second{labels} {_format(self.tokens[name].rate(now, self.start_time))}",
+                ]
+            lines += [
+                f"# TYPE {PREFIX}requests counter",
+                f"# HELP {PREFIX}requests Finished requests, failed or not",
+                f"{PREFIX}requests_total{labels} {self.requests}",
+                f"# TYPE {PREFIX}request_errors counter",
+                f"# HELP {PREFIX}request_errors Failed requests",
+                f"{PREFIX}request_errors_total{labels} {self.errors}",
+                f"# TYPE {PREFIX}in_flight_requests gauge",
+                f"# HELP {PREFIX}in_flight_requests Requests sent and not finished yet",
+                f"{PREFIX}in_flight_requests{labels} {self.in_flight}",
+            ]
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write_snapshot(self, path):
+        """
+        Replaces `path` atomically, e.g. for the textfile collector of the Prometheus node exporter
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.live_metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Exporter:
+    """
+    Serves `LiveMetrics` on `http://<host>:<port>/metrics` and/or writes them to `snapshot_file` every
+    `snapshot_interval` seconds, both from daemon threads
+    """
+
+    def __init__(self, live_metrics, port=None, snapshot_file=None, snapshot_interval=10.0):
+        self.live_metrics = live_metrics
+        self.snapshot_file = snapshot_file
+        self.snapshot_interval = snapshot_interval
+        self.stopped = threading.Event()
+        self.server = None
+        if port is not None:
+            try:
+                self.server = http.server.ThreadingHTTPServer(("", port), _Handler)
+            except OSError as e:
+                # e.g. several workers of a distributed run on the same machine
+                print(f"Can't serve live metrics on port {port} ({e}), using a free port instead")
+                self.server = http.server.ThreadingHTTPServer(("", 0), _Handler)
+            self.server.live_metrics = live_metrics
+            print(f"Serving live metrics on http://localhost:{self.server.server_address[1]}/metrics")
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        if snapshot_file:
+            os.makedirs(os.path.dirname(os.path.abspath(snapshot_file)), exist_ok=True)
+            threading.Thread(target=self._write_snapshots, daemon=True).start()
+
+    def _write_snapshots(self):
+        while not self.stopped.wait(self.snapshot_interval):
+            try:
+                self.live_metrics.write_snapshot(self.snapshot_file)
+            except OSError as e:
+                print(f"WARNING: failed to write the live metrics snapshot: {repr(e)}", flush=True)
+
+    def close(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        if self.snapshot_file:
+            self.live_metrics.write_snapshot(self.snapshot_file)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+# one exporter per process, the runs of a sweep share it (and its port)
+_exporter = None
+
+
+def start_exporter(parsed_options, labels=None, snapshot_file=None):
+    """
+    Returns the `LiveMetrics` of the process if `--metrics-port` or `--metrics-snapshot-file` is set, None otherwise.
+    `labels` replace the ones of a previous run. `snapshot_file` overrides `--metrics-snapshot-file`
+    """
+    global _exporter
+    snapshot_file = snapshot_file or parsed_options.metrics_snapshot_file
+    if parsed_options.metrics_port is None and not snapshot_file:
+        return None
+    if _exporter is None:
+        _exporter = Exporter(
+            LiveMetrics(parsed_options.metrics_window, labels),
+            parsed_options.metrics_port,
+            snapshot_file,
+            parsed_options.metrics_snapshot_interval,
+        )
+    _exporter.live_metrics.labels = labels or {}
+    return _exporter.live_metrics
+
+
+@atexit.register
+def stop_exporter():
+    global _exporter
+    if _exporter is not None:
+        _exporter.close()
+        _exporter = None
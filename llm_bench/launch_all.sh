@@ -5,9 +5,13 @@ summary_file="vllm.csv"
 model="meta-llama/Llama-3.1-8B-Instruct"
 api_key="not-relevant-for-vllm"
 randomize=false
+prefix_hit_ratio=""
 duration=60
+search_capacity=false
+adaptive_duration=false
+write_records=false
 
-while getopts "p:s:u:m:k:r:d:" opt; do
+while getopts "p:s:u:m:k:rc:d:aew" opt; do
   case $opt in
     p) provider="$OPTARG"
     ;;
@@ -21,8 +25,16 @@ while getopts "p:s:u:m:k:r:d:" opt; do
     ;;
     r) randomize=true
     ;;
+    c) prefix_hit_ratio="$OPTARG"
+    ;;
     d) duration="$OPTARG"
     ;;
+    a) search_capacity=true
+    ;;
+    e) adaptive_duration=true
+    ;;
+    w) write_records=true
+    ;;
     \?) echo "Invalid option -$OPTARG" >&2
     ;;
   esac
@@ -31,39 +43,49 @@ done
 lengths_str="${LENGTHS:-128,256,512,1024,2048,4096}" 
 qps_str="${QPS:-0.125,0.5,1,2,4,6,8,10,12,14,16,18,20}"
 
-IFS=',' read -ra lengths <<< "$lengths_str"
-IFS=',' read -ra qps <<< "$qps_str"
-
 echo $duration
 echo $lengths_str
 echo $qps_str
 
-for length in "${lengths[@]}"; do
-    for q in "${qps[@]}"; do
-        echo "Running load test with $length input token size and $q qps"
-        echo ""
-        locust_command="locust \
-            -H $url \
-            -m $model \
-            --tokenizer meta-llama/Llama-3.1-8B-Instruct \
-            --provider $provider \
-            --qps $q \
-            -u 500 \
-            -r 500 \
-            -p $length \
-            -o 128 \
-            --chat \
-            --stream \
-            --summary-file $summary_file \
-            -t $duration \
-            -k $api_key"
-          
-        if [ "$randomize" = true ]; then
-            locust_command+=" --prompt-randomize"
-        fi
+# the whole grid runs in one process, the tokenizer, prompt pools and connections are reused across points
+sweep_command="python sweep.py \
+    -H $url \
+    -m $model \
+    --tokenizer meta-llama/Llama-3.1-8B-Instruct \
+    --provider $provider \
+    -o 128 \
+    --chat \
+    --stream \
+    --summary-file $summary_file \
+    -t $duration \
+    -k $api_key \
+    --grid prompt_tokens=$lengths_str \
+    --cooldown 5"
 
-        eval $locust_command
+if [ "$search_capacity" = true ]; then
+    # highest QPS meeting the SLOs per prompt length instead of the whole QPS list
+    sweep_command+=" --search-capacity \
+        --max-p90-ttft ${SLO_P90_TTFT:-2000} \
+        --max-p90-tpot ${SLO_P90_TPOT:-100} \
+        --max-incomplete-ratio ${SLO_INCOMPLETE_RATIO:-0.05} \
+        --capacity-file ${summary_file%.csv}-capacity.csv"
+else
+    sweep_command+=" --grid qps=$qps_str"
+fi
 
-        sleep 5
-    done
-done
+if [ "$randomize" = true ]; then
+    sweep_command+=" --prompt-randomize"
+fi
+if [ -n "$prefix_hit_ratio" ]; then
+    sweep_command+=" --prefix-hit-ratio $prefix_hit_ratio"
+fi
+if [ "$adaptive_duration" = true ]; then
+    # -d is the maximum duration of a point then
+    sweep_command+=" --adaptive-duration"
+fi
+if [ "$write_records" = true ]; then
+    # per request latencies next to the summary, compare.py tests them for regressions
+    sweep_command+=" --records-file ${summary_file%.csv}-records.parquet --quiet"
+fi
+
+eval $sweep_command
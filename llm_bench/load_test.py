@@ -1,21 +1,45 @@
-import abc
-import argparse
-import csv
-from dataclasses import dataclass
-from functools import partial
-import os
-import random
 import sys
 import traceback
-from typing import Optional
+from functools import partial
 from locust import HttpUser, task, events, constant_pacing
-import copy
+from locust.exception import StopUser
+from locust.runners import MasterRunner, WorkerRunner
 import json
+import os
+import random
 import time
-import orjson
 import threading
 from uuid import uuid4
-from sseclient import SSEClient
+
+import gevent
+import gevent.threadpool
+
+from connections import TimedAdapter, request_phases
+from convergence import ConvergenceMonitor
+from exporter import start_exporter, stop_exporter
+from metrics import MetricsRegistry
+from options import add_arguments
+from providers import (
+    PROVIDER_CLASS_MAP,
+    default_model_name,
+    guess_provider_from_host,
+    pick_model,
+    request_headers,
+)
+from records import close_sinks, open_sink, request_record
+from response import ResponseAccumulator, evaluate_slo
+from schedule import FixedQPSPacer, apply_trace_qps
+from sse import iter_sse_data
+from summary import (
+    append_summary,
+    append_throughput_series,
+    build_summary,
+    make_logging_params,
+    print_summary,
+)
+from token_counter import TokenCounter
+from tracer import close_tracers, open_tracer
+from workload import ChatSession, LengthSampler, PromptSource, load_tokenizer
 
 try:
     import locust_plugins
@@ -23,6 +47,10 @@ except ImportError:
     print("locust-plugins is not installed, Grafana won't work")
 
 
+# histograms of the custom metrics the summary is computed from
+metrics_registry = MetricsRegistry()
+
+
 def add_custom_metric(name, value, length_value=0):
     events.request.fire(
         request_type="METRIC",
@@ -37,6 +65,7 @@ def add_custom_metric(name, value, length_value=0):
 class RequestTracker:
     lock = threading.Lock()
     requests = {}  # {request_id: 'initiated'/'first_received'/'last_received'}
+    worker_counts = {}  # {client_id: (total, initiated, first_only)}, only populated on the master
 
     @classmethod
     def add_request(cls, request_id):
@@ -62,118 +91,57 @@ class RequestTracker:
             first_only = sum(1 for s in cls.requests.values() if s == "first_received")
             return initiated, first_only
 
+    @classmethod
+    def get_totals(cls):
+        """
+        Returns `(total, initiated, first_only)` including the latest counts reported by workers
+        """
+        initiated, first_only = cls.get_counts()
+        totals = [len(cls.requests), initiated, first_only]
+        with cls.lock:
+            for counts in cls.worker_counts.values():
+                totals = [a + b for a, b in zip(totals, counts)]
+        return tuple(totals)
 
-PROMPT_PREFIX_TOKEN = "Pad "  # exactly one token
-# "Lengthy" prompt borrowed from nat.dev
-PROMPT_SUFFIX = """Generate a Django application with Authentication, JWT, Tests, DB support. Show docker-compose for python and postgres. Show the complete code for every file!"""
-PROMPT_SUFFIX_TOKENS = 35  # from Llama tokenizer tool (so we don't import it here)
-
-
-class FixedQPSPacer:
-    _instance = None
-    _lock = threading.Lock()
-
-    def __init__(self, qps, distribution):
-        self.qps = qps
-        self.distribution = distribution
-
-        # It's kind of thread safe thanks to GIL as the only state is `t` - good enough for a loadtest
-        def gen():
-            t = time.time()
-            mean_wait = 1 / self.qps
-            while True:
-                if self.distribution == "exponential":
-                    wait = random.expovariate(1 / mean_wait)
-                elif self.distribution == "uniform":
-                    wait = random.uniform(0, 2 * mean_wait)
-                elif self.distribution == "constant":
-                    wait = mean_wait
-                else:
-                    print("Unknown distribution {self.distribution}")
-                    os._exit(1)
-                t += wait
-                yield t
-
-        self.iterator = gen()
+    @classmethod
+    def on_report_to_master(cls, client_id, data):
+        data["llm_bench_requests"] = cls.get_totals()
+        data["llm_bench_metrics"] = metrics_registry.serialize()
 
     @classmethod
-    def instance(cls, qps, distribution):
-        with cls._lock:
-            if cls._instance is None:
-                cls._instance = cls(qps, distribution)
-            else:
-                assert cls._instance.qps == qps
-                assert cls._instance.distribution == distribution
-            return cls._instance
-
-    def wait_time_till_next(self):
-        with self._lock:
-            t = next(self.iterator)
-        now = time.time()
-        if now > t:
-            print(
-                f"WARNING: not enough locust users to keep up with the desired QPS. Either the number of locust users is too low or the server is overloaded. Delay: {now-t:.3f}s"
-            )
-            return 0
-        return t - now
-
-
-class LengthSampler:
-    def __init__(self, distribution: str, mean: int, cap: Optional[int], alpha: float):
-        self.distribution = distribution
-        self.mean = mean
-        self.cap = cap
-        self.alpha = alpha
-
-        if self.distribution == "exponential":
-            self.sample_func = lambda: int(random.expovariate(1 / self.mean))
-        elif self.distribution == "uniform":
-            mx = self.mean + int(self.alpha * self.mean)
-            if self.cap is not None:
-                mx = min(mx, self.cap)
-            self.sample_func = lambda: random.randint(max(1, self.mean - int(self.alpha * self.mean)), mx)
-        elif self.distribution == "constant":
-            self.sample_func = lambda: self.mean
-        elif self.distribution == "normal":
-            self.sample_func = lambda: int(random.gauss(self.mean, self.mean * self.alpha))
-        else:
-            raise ValueError(f"Unknown distribution {self.distribution}")
-
-    def sample(self) -> int:
-        for _ in range(1000):
-            sample = self.sample_func()
-            if sample <= 0:
-                continue
-            if self.cap is not None and sample > self.cap:
-                continue
-            return sample
-        else:
-            raise ValueError("Can't sample a value after 1000 attempts, check distribution parameters")
-
-    def __str__(self):
-        r = int(self.mean * self.alpha)
-        if self.distribution == "constant":
-            s = str(self.mean)
-        elif self.distribution == "uniform":
-            s = f"uniform({self.mean} +/- {r})"
-        elif self.distribution == "normal":
-            s = f"normal({self.mean}, {r})"
-        elif self.distribution == "exponential":
-            s = f"exponential({self.mean})"
-        else:
-            assert False
-        if self.cap is not None:
-            s += f" capped at {self.cap}"
-        return s
+    def on_worker_report(cls, client_id, data):
+        if "llm_bench_requests" in data:
+            with cls.lock:
+                cls.worker_counts[client_id] = tuple(data["llm_bench_requests"])
+        if "llm_bench_metrics" in data:
+            # workers report everything since the last reset, so the latest snapshot replaces the previous one
+            metrics_registry.update_remote(client_id, data["llm_bench_metrics"])
 
 
 class InitTracker:
     lock = threading.Lock()
     users = None
     first_request_done = 0
+    # set by the steady state reset, requests completed before it are warm-up
+    warmed_up = False
     logging_params = None
     environment = None
     tokenizer = None
+    token_counter = None
+    init_reported = False
+    # sink of the per request records with --records-file
+    records = None
+    # with --metrics-port/--metrics-snapshot-file, on the processes sending requests
+    live_metrics = None
+    # with --trace-file, on the processes sending requests: the tracer, the id of this run in it and the next track
+    tracer = None
+    trace_pid = None
+    num_tracks = 0
+    # with --adaptive-duration, lives on the process writing the summary
+    convergence = None
+    # whether the warm-up is detected from the latencies of this process rather than from the first requests, the
+    # master of a distributed run doesn't see individual requests so it keeps the first request rule
+    detect_warmup = False
 
     @classmethod
     def notify_init(cls, environment, logging_params):
@@ -186,19 +154,25 @@ class InitTracker:
                 assert (
                     cls.logging_params == logging_params
                 ), f"Inconsistent settings between workers: {cls.logging_params} != {logging_params}"
+            if isinstance(environment.runner, WorkerRunner) and not cls.init_reported:
+                # the master has no users of its own, it needs the settings for the summary
+                cls.init_reported = True
+                environment.runner.send_message("llm_bench_init", logging_params)
 
     @classmethod
     def notify_first_request(cls):
+        if isinstance(cls.environment.runner, WorkerRunner):
+            # steady state is decided on the master based on all users
+            cls.environment.runner.send_message("llm_bench_first_request")
+            return
         with cls.lock:
+            if cls.detect_warmup:
+                return
             if cls.environment.parsed_options.qps is not None and cls.first_request_done == 0:
                 # if in QPS mode, reset after first successful request comes back
                 cls.reset_stats()
             cls.first_request_done += 1
-            if (
-                cls.environment.parsed_options.qps is not None
-                and cls.first_request_done == 0
-                and cls.users == cls.first_request_done
-            ):
+            if cls.environment.parsed_options.qps is None and cls.users == cls.first_request_done:
                 # if in fixed load mode, reset after all users issued one request (we're in a steady state)
                 cls.reset_stats()
 
@@ -206,15 +180,42 @@ class InitTracker:
     def notify_spawning_complete(cls, user_count):
         with cls.lock:
             cls.users = user_count
-            if cls.users == cls.first_request_done:
+            if cls.users == cls.first_request_done and not cls.detect_warmup:
                 cls.reset_stats()
 
+    @classmethod
+    def observe_request(cls, latency):
+        if cls.detect_warmup and cls.convergence.observe(time.time(), latency):
+            cls.reset_stats()
+
     @classmethod
     def reset_stats(cls):
-        assert cls.environment.runner, "only local mode is supported"
+        assert cls.environment.runner, "runner is not initialized"
         print("Resetting stats after traffic reach a steady state")
+        if cls.convergence is not None:
+            cls.convergence.mark_warmed_up()
         cls.environment.events.reset_stats.fire()
         cls.environment.runner.stats.reset_all()
+        metrics_registry.reset()
+        cls.warmed_up = True
+        if isinstance(cls.environment.runner, MasterRunner):
+            # drop the samples workers collected but haven't reported yet
+            cls.environment.runner.send_message("llm_bench_reset_stats")
+
+    @classmethod
+    def on_worker_init(cls, environment, msg, **kw):
+        cls.notify_init(environment, msg.data)
+
+    @classmethod
+    def on_worker_first_request(cls, environment, msg, **kw):
+        cls.notify_first_request()
+
+    @classmethod
+    def on_master_reset_stats(cls, environment, msg, **kw):
+        environment.events.reset_stats.fire()
+        environment.runner.stats.reset_all()
+        metrics_registry.reset()
+        cls.warmed_up = True
 
     @classmethod
     def load_tokenizer(cls, dir):
@@ -223,335 +224,101 @@ class InitTracker:
         with cls.lock:
             if cls.tokenizer:
                 return cls.tokenizer
-            import transformers
-
-            cls.tokenizer = transformers.AutoTokenizer.from_pretrained(dir)
-            cls.tokenizer.add_bos_token = False
-            cls.tokenizer.add_eos_token = False
+            cls.tokenizer = load_tokenizer(dir)
+            # native threads even though threading is monkey-patched, so encoding doesn't block the greenlets
+            cls.token_counter = TokenCounter(cls.tokenizer, gevent.threadpool.ThreadPoolExecutor(1).submit)
             return cls.tokenizer
 
+    @classmethod
+    def drain_token_counter(cls):
+        if cls.token_counter is None:
+            return
+        while not cls.token_counter.idle:
+            time.sleep(0.01)
 
-events.spawning_complete.add_listener(InitTracker.notify_spawning_complete)
-
-
-@dataclass
-class ChunkMetadata:
-    text: str
-    logprob_tokens: Optional[int]
-    usage_tokens: Optional[int]
-    prompt_usage_tokens: Optional[int]
-
-
-class BaseProvider(abc.ABC):
-    DEFAULT_MODEL_NAME = None
-
-    def __init__(self, model, parsed_options):
-        self.model = model
-        self.parsed_options = parsed_options
-
-    @abc.abstractmethod
-    def get_url(self) -> str: ...
-
-    @abc.abstractmethod
-    def format_payload(self, prompt, max_tokens, images) -> dict: ...
-
-    @abc.abstractmethod
-    def parse_output_json(self, json, prompt): ...
-
-
-class OpenAIProvider(BaseProvider):
-    def get_url(self) -> str:
-        if self.parsed_options.chat:
-            return "/v1/chat/completions"
-        else:
-            return "/v1/completions"
-
-    def format_payload(self, prompt, max_tokens, images):
-        data = {
-            "model": self.model,
-            "max_tokens": max_tokens,
-            "stream": self.parsed_options.stream,
-            "temperature": self.parsed_options.temperature,
-            "n": self.parsed_options.n,
-        }
-        if self.parsed_options.chat:
-            if images is None:
-                data["messages"] = [{"role": "user", "content": prompt}]
-            else:
-                image_urls = []
-                for image in images:
-                    image_urls.append({"type": "image_url", "image_url": {"url": image}})
-                data["messages"] = [
-                    {
-                        "role": "user",
-                        "content": [{"type": "text", "text": prompt}, *image_urls],
-                    }
-                ]
-        else:
-            data["prompt"] = prompt
-            if images is not None:
-                data["images"] = images
-        if self.parsed_options.logprobs is not None:
-            data["logprobs"] = self.parsed_options.logprobs
-        return data
-
-    def parse_output_json(self, data, prompt):
-        usage = data.get("usage", None)
-
-        assert len(data["choices"]) == 1 or len(data["choices"]) == 0, f"Too many choices {len(data['choices'])}"
-
-        if len(data["choices"]) == 1:
-            choice = data["choices"][0]
-            if self.parsed_options.chat:
-                if self.parsed_options.stream:
-                    text = choice["delta"].get("content", "")
-                else:
-                    text = choice["message"]["content"]
-            else:
-                text = choice["text"]
-
-            logprobs = choice.get("logprobs", None)
-        else:
-            text = ""
-            logprobs = None
-
-        return ChunkMetadata(
-            text=text,
-            logprob_tokens=len(logprobs["tokens"]) if logprobs else None,
-            usage_tokens=usage["completion_tokens"] if usage else None,
-            prompt_usage_tokens=usage.get("prompt_tokens", None) if usage else None,
-        )
-
-
-class FireworksProvider(OpenAIProvider):
-    def format_payload(self, prompt, max_tokens, images):
-        data = super().format_payload(prompt, max_tokens, images)
-        data["min_tokens"] = max_tokens
-        data["prompt_cache_max_len"] = self.parsed_options.prompt_cache_max_len
-        return data
 
+@events.init.add_listener
+def _(environment, **kw):
+    apply_trace_qps(environment.parsed_options)
+    if environment.parsed_options.records_file and not isinstance(environment.runner, MasterRunner):
+        path = environment.parsed_options.records_file
+        if isinstance(environment.runner, WorkerRunner):
+            # workers may share a file system
+            root, ext = os.path.splitext(path)
+            path = f"{root}-{environment.runner.client_id}{ext}"
+        InitTracker.records = open_sink(path, gevent.threadpool.ThreadPoolExecutor(1).submit)
+    if not isinstance(environment.runner, MasterRunner):
+        snapshot_file = environment.parsed_options.metrics_snapshot_file
+        if snapshot_file and isinstance(environment.runner, WorkerRunner):
+            root, ext = os.path.splitext(snapshot_file)
+            snapshot_file = f"{root}-{environment.runner.client_id}{ext}"
+        InitTracker.live_metrics = start_exporter(environment.parsed_options, snapshot_file=snapshot_file)
+        trace_file = environment.parsed_options.trace_file
+        if trace_file:
+            if isinstance(environment.runner, WorkerRunner):
+                root, ext = os.path.splitext(trace_file)
+                trace_file = f"{root}-{environment.runner.client_id}{ext}"
+            InitTracker.tracer = open_tracer(
+                trace_file, environment.parsed_options.trace_sample_rate, environment.parsed_options.trace_max_events
+            )
+            InitTracker.trace_pid = InitTracker.tracer.process(environment.parsed_options.run_label or "llm_bench")
+    if isinstance(environment.runner, WorkerRunner):
+        environment.runner.register_message("llm_bench_schedule", _on_schedule_partition)
+        environment.runner.register_message("llm_bench_reset_stats", InitTracker.on_master_reset_stats)
+        events.report_to_master.add_listener(RequestTracker.on_report_to_master)
+        return
+    events.spawning_complete.add_listener(InitTracker.notify_spawning_complete)
+    if isinstance(environment.runner, MasterRunner):
+        environment.runner.register_message("llm_bench_init", InitTracker.on_worker_init)
+        environment.runner.register_message("llm_bench_first_request", InitTracker.on_worker_first_request)
+        events.worker_report.add_listener(RequestTracker.on_worker_report)
 
-class VllmProvider(OpenAIProvider):
-    def format_payload(self, prompt, max_tokens, images):
-        data = super().format_payload(prompt, max_tokens, images)
-        data["ignore_eos"] = True
-        return data
 
+@events.test_start.add_listener
+def _(environment, **kw):
+    if isinstance(environment.runner, WorkerRunner) or not environment.parsed_options.adaptive_duration:
+        return
+    # -t is the upper bound, the run is stopped as soon as the percentiles converge
+    InitTracker.convergence = ConvergenceMonitor.from_options(environment.parsed_options)
+    InitTracker.detect_warmup = not isinstance(environment.runner, MasterRunner)
+    gevent.spawn(_watch_convergence, environment, InitTracker.convergence)
+
+
+def _watch_convergence(environment, convergence):
+    metrics = ["time_to_first_token", "total_latency"] if environment.parsed_options.stream else ["total_latency"]
+    while True:
+        gevent.sleep(1)
+        if convergence.converged(metrics_registry, metrics):
+            intervals = ", ".join(
+                f"P{p} {name} [{low:.1f}, {high:.1f}]" for (name, p), (low, high) in convergence.intervals.items()
+            )
+            print(f"Percentiles converged: {intervals}", flush=True)
+            environment.runner.quit()
+            return
 
-class AdaptiveProvider(OpenAIProvider):
 
-    def get_url(self):
-        if self.parsed_options.chat:
-            return "/api/v1/chat/completions"
-        else:
-            return "/api/v1/completions"
-
-    def format_payload(self, prompt, max_tokens, images):
-        data = super().format_payload(prompt, max_tokens, images)
-        data["stream_options"] = {"include_usage": True}
-        return data
-
-
-class TogetherProvider(OpenAIProvider):
-    def get_url(self):
-        assert not self.parsed_options.chat, "Chat is not supported"
-        return "/"
-
-    def format_payload(self, prompt, max_tokens, images):
-        data = super().format_payload(prompt, max_tokens, images)
-        data["ignore_eos"] = True
-        data["stream_tokens"] = data.pop("stream")
-        return data
-
-    def parse_output_json(self, data, prompt):
-        if not self.parsed_options.stream:
-            data = data["output"]
-        return super().parse_output_json(data, prompt)
-
-
-class TritonInferProvider(BaseProvider):
-    DEFAULT_MODEL_NAME = "ensemble"
-
-    def get_url(self):
-        assert not self.parsed_options.chat, "Chat is not supported"
-        assert not self.parsed_options.stream, "Stream is not supported"
-        assert self.parsed_options.n == 1, "n > 1 is not supported"
-        return f"/v2/models/{self.model}/infer"
-
-    def format_payload(self, prompt, max_tokens, images):
-        assert images is None, "images are not supported"
-        # matching latest TRT-LLM example, your model configuration might be different
-        data = {
-            "inputs": [
-                {
-                    "name": "text_input",
-                    "datatype": "BYTES",
-                    "shape": [1, 1],
-                    "data": [[prompt]],
-                },
-                {
-                    "name": "max_tokens",
-                    "datatype": "UINT32",
-                    "shape": [1, 1],
-                    "data": [[max_tokens]],
-                },
-                {
-                    "name": "bad_words",
-                    "datatype": "BYTES",
-                    "shape": [1, 1],
-                    "data": [[""]],
-                },
-                {
-                    "name": "stop_words",
-                    "datatype": "BYTES",
-                    "shape": [1, 1],
-                    "data": [[""]],
-                },
-                {
-                    "name": "temperature",
-                    "datatype": "FP32",
-                    "shape": [1, 1],
-                    "data": [[self.parsed_options.temperature]],
-                },
-            ]
-        }
-        assert self.parsed_options.logprobs is None, "logprobs are not supported"
-        return data
-
-    def parse_output_json(self, data, prompt):
-        for output in data["outputs"]:
-            if output["name"] == "text_output":
-                assert output["datatype"] == "BYTES"
-                assert output["shape"] == [1]
-                text = output["data"][0]
-                # Triton returns the original prompt in the output, cut it off
-                text = text.removeprefix("<s> ")
-                if text.startswith(prompt):
-                    # HF tokenizers get confused by the leading space
-                    text = text[len(prompt) :].removeprefix(" ")
-                else:
-                    print("WARNING: prompt not found in the output")
-                return ChunkMetadata(
-                    text=text,
-                    logprob_tokens=None,
-                    usage_tokens=None,
-                    prompt_usage_tokens=None,
-                )
-        raise ValueError("text_output not found in the response")
-
-
-class TritonGenerateProvider(BaseProvider):
-    DEFAULT_MODEL_NAME = "ensemble"
-
-    def get_url(self):
-        assert not self.parsed_options.chat, "Chat is not supported"
-        stream_suffix = "_stream" if self.parsed_options.stream else ""
-        return f"/v2/models/{self.model}/generate{stream_suffix}"
-
-    def format_payload(self, prompt, max_tokens, images):
-        assert images is None, "images are not supported"
-        assert self.parsed_options.n == 1, "n > 1 is not supported"
-        data = {
-            "text_input": prompt,
-            "max_tokens": max_tokens,
-            "stream": self.parsed_options.stream,
-            "temperature": self.parsed_options.temperature,
-            # for whatever reason these has to be provided
-            "bad_words": "",
-            "stop_words": "",
-        }
-        assert self.parsed_options.logprobs is None, "logprobs are not supported"
-        return data
-
-    def parse_output_json(self, data, prompt):
-        text = data["text_output"]
-        if not self.parsed_options.stream:
-            # Triton returns the original prompt in the output, cut it off
-            text = text.removeprefix("<s> ")
-            if text.startswith(prompt):
-                # HF tokenizers get confused by the leading space
-                text = text[len(prompt) :].removeprefix(" ")
-            else:
-                print("WARNING: prompt not found in the output")
-        return ChunkMetadata(
-            text=text,
-            logprob_tokens=None,
-            usage_tokens=None,
-            prompt_usage_tokens=None,
+@events.test_start.add_listener
+def _(environment, **kw):
+    if not isinstance(environment.runner, MasterRunner) or environment.parsed_options.qps is None:
+        return
+    # every worker generates the same global arrival schedule and only takes its own share of slots,
+    # so the total rate matches --qps regardless of the number of workers
+    start_time = time.time()
+    seed = environment.parsed_options.seed
+    if seed is None:
+        seed = random.randrange(2**32)
+    clients = environment.runner.clients
+    client_ids = sorted(worker.id for worker in clients.ready + clients.spawning + clients.running)
+    for index, client_id in enumerate(client_ids):
+        environment.runner.send_message(
+            "llm_bench_schedule",
+            {"index": index, "count": len(client_ids), "start_time": start_time, "seed": seed},
+            client_id=client_id,
         )
 
 
-class TgiProvider(BaseProvider):
-    DEFAULT_MODEL_NAME = "<unused>"
-
-    def get_url(self):
-        assert self.parsed_options.n == 1, "n > 1 is not supported"
-        assert not self.parsed_options.chat, "Chat is not supported"
-        stream_suffix = "_stream" if self.parsed_options.stream else ""
-        return f"/generate{stream_suffix}"
-
-    def format_payload(self, prompt, max_tokens, images):
-        assert images is None, "images are not supported"
-        data = {
-            "inputs": prompt,
-            "parameters": {
-                "max_new_tokens": max_tokens,
-                "temperature": self.parsed_options.temperature,
-                "top_n_tokens": self.parsed_options.logprobs,
-                "details": self.parsed_options.logprobs is not None,
-            },
-        }
-        return data
-
-    def parse_output_json(self, data, prompt):
-        if "token" in data:
-            # streaming chunk
-            return ChunkMetadata(
-                text=data["token"]["text"],
-                logprob_tokens=1,
-                usage_tokens=None,
-                prompt_usage_tokens=None,
-            )
-        else:
-            # non-streaming response
-            return ChunkMetadata(
-                text=data["generated_text"],
-                logprob_tokens=(len(data["details"]["tokens"]) if "details" in data else None),
-                usage_tokens=(data["details"]["generated_tokens"] if "details" in data else None),
-                prompt_usage_tokens=None,
-            )
-
-
-PROVIDER_CLASS_MAP = {
-    "fireworks": FireworksProvider,
-    "vllm": VllmProvider,
-    "adaptive": AdaptiveProvider,
-    "sglang": VllmProvider,
-    "openai": OpenAIProvider,
-    "anyscale": OpenAIProvider,
-    "together": TogetherProvider,
-    "triton-infer": TritonInferProvider,
-    "triton-generate": TritonGenerateProvider,
-    "tgi": TgiProvider,
-}
-
-
-def _load_curl_like_data(text):
-    """
-    Either use the passed string or load from a file if the string is `@filename`
-    """
-    if text.startswith("@"):
-        try:
-            if text.endswith(".jsonl"):
-                with open(text[1:], "r") as f:
-                    return [json.loads(line) for line in f]
-            else:
-                with open(text[1:], "r") as f:
-                    return f.read()
-        except Exception as e:
-            raise ValueError(f"Failed to read file {text[1:]}") from e
-    else:
-        return text
+def _on_schedule_partition(environment, msg, **kw):
+    FixedQPSPacer.set_partition(**msg.data)
 
 
 class LLMUser(HttpUser):
@@ -560,6 +327,8 @@ class LLMUser(HttpUser):
     def on_start(self):
         try:
             self._on_start()
+        except StopUser:
+            raise
         except Exception as e:
             print(f"Failed to initialize: {repr(e)}")
             print(traceback.format_exc())
@@ -570,21 +339,10 @@ class LLMUser(HttpUser):
         self.provider = self.environment.parsed_options.provider
         # guess based on URL
         if self.provider is None:
-            if "fireworks.ai" in self.host:
-                self.provider = "fireworks"
-            elif "together" in self.host:
-                self.provider = "together"
-            elif "openai" in self.host:
-                self.provider = "openai"
-            elif "anyscale" in self.host:
-                self.provider = "anyscale"
-
-        if (
-            self.model is None
-            and self.provider is not None
-            and PROVIDER_CLASS_MAP[self.provider].DEFAULT_MODEL_NAME is not None
-        ):
-            self.model = PROVIDER_CLASS_MAP[self.provider].DEFAULT_MODEL_NAME
+            self.provider = guess_provider_from_host(self.host)
+
+        if self.model is None:
+            self.model = default_model_name(self.provider)
 
         if self.model and self.provider:
             return
@@ -597,86 +355,72 @@ class LLMUser(HttpUser):
         except Exception as e:
             raise ValueError("Argument --model or --provider was not specified and /v1/models failed") from e
 
-        models = resp["data"]
-        assert len(models) > 0, "No models found in /v1/models"
-        owned_by = None
-        # pick the first model
-        for m in models:
-            if self.model is None or m["id"] == self.model:
-                self.model = m["id"]
-                owned_by = m["owned_by"]
-                break
-        if self.provider is None:
-            if not owned_by:
-                raise ValueError(f"Model {self.model} not found in /v1/models. Specify --provider explicitly")
-            if owned_by in PROVIDER_CLASS_MAP:
-                self.provider = owned_by
-            else:
-                raise ValueError(f"Can't detect provider, specify it explicitly with --provider, owned_by={owned_by}")
+        self.model, self.provider = pick_model(resp["data"], self.model, self.provider)
 
     def _on_start(self):
-        self.client.headers["Content-Type"] = "application/json"
-        if self.environment.parsed_options.api_key:
-            self.client.headers["Authorization"] = "Bearer " + self.environment.parsed_options.api_key
-        if self.environment.parsed_options.header:
-            for header in self.environment.parsed_options.header:
-                key, val = header.split(":", 1)
-                self.client.headers[key] = val
+        self.client.headers.update(request_headers(self.environment.parsed_options))
+        # every user has its own session, hence its own connection
+        adapter = TimedAdapter()
+        self.client.mount("http://", adapter)
+        self.client.mount("https://", adapter)
+        if self.environment.parsed_options.connection_policy == "fresh":
+            self.client.headers["Connection"] = "close"
         self._guess_provider()
         print(f" Provider {self.provider} using model {self.model} ".center(80, "*"))
         self.provider_formatter = PROVIDER_CLASS_MAP[self.provider](self.model, self.environment.parsed_options)
 
         self.stream = self.environment.parsed_options.stream
-        prompt_chars = self.environment.parsed_options.prompt_chars
-        if self.environment.parsed_options.prompt_text:
-            self.input = _load_curl_like_data(self.environment.parsed_options.prompt_text)
-        elif prompt_chars:
-            self.input = (PROMPT_PREFIX_TOKEN * (prompt_chars // len(PROMPT_PREFIX_TOKEN) + 1) + PROMPT_SUFFIX)[
-                :prompt_chars
-            ]
-        else:
-            assert (
-                self.environment.parsed_options.prompt_tokens >= PROMPT_SUFFIX_TOKENS
-            ), f"Minimal prompt length is {PROMPT_SUFFIX_TOKENS}"
-            self.input = (
-                PROMPT_PREFIX_TOKEN * (self.environment.parsed_options.prompt_tokens - PROMPT_SUFFIX_TOKENS)
-                + PROMPT_SUFFIX
-            )
-        self.max_tokens_sampler = LengthSampler(
-            distribution=self.environment.parsed_options.max_tokens_distribution,
-            mean=self.environment.parsed_options.max_tokens,
-            cap=self.environment.parsed_options.max_tokens_cap,
-            alpha=self.environment.parsed_options.max_tokens_range,
+        # fake requests per metric are expensive, only fire them when something consumes Locust stats
+        self.report_to_locust = self.environment.parsed_options.locust_metrics or getattr(
+            self.environment.parsed_options, "timescale", False
         )
+        self.tokenizer = InitTracker.load_tokenizer(self.environment.parsed_options.tokenizer)
+        self.prompt_source = PromptSource(self.environment.parsed_options, self.tokenizer)
+        if self.environment.parsed_options.session_turns:
+            self.chat_session = ChatSession(
+                self.prompt_source, self.environment.parsed_options.chat, self.environment.parsed_options.turn_tokens
+            )
+        else:
+            self.chat_session = None
+        self.max_tokens_sampler = LengthSampler.from_options(self.environment.parsed_options)
         self.temperature = self.environment.parsed_options.temperature
 
-        logging_params = {
-            # TODO: add some server info with git version
+        logging_params = make_logging_params(
+            self.provider, self.model, self.environment.parsed_options, self.max_tokens_sampler
+        )
+        InitTracker.notify_init(self.environment, logging_params)
+        if self.environment.parsed_options.qps is not None:
+            concurrency = f"{self.environment.parsed_options.qps}"
+        else:
+            concurrency = str(self.environment.parsed_options.num_users)
+        self.record_fields = {
+            "run_label": self.environment.parsed_options.run_label,
             "provider": self.provider,
             "model": self.model,
-            "prompt_tokens": self.environment.parsed_options.prompt_tokens,  # might be overwritten based on metric
-            "generation_tokens": str(self.max_tokens_sampler),
-            "stream": self.stream,
-            "temperature": self.temperature,
-            "logprobs": self.environment.parsed_options.logprobs,
+            "concurrency": concurrency,
         }
-        InitTracker.notify_init(self.environment, logging_params)
+        if InitTracker.live_metrics:
+            InitTracker.live_metrics.labels = {
+                "provider": self.provider,
+                "model": self.model,
+                "run_label": self.environment.parsed_options.run_label,
+            }
+        # greenlets of one process, no lock needed
+        self.trace_track = InitTracker.num_tracks
+        InitTracker.num_tracks += 1
 
-        self.tokenizer = InitTracker.load_tokenizer(self.environment.parsed_options.tokenizer)
         if self.tokenizer:
-            self.prompt_tokenizer_tokens = len(self.tokenizer.encode(self._get_input()[0]))
+            self.prompt_tokenizer_tokens = len(self.tokenizer.encode(self.prompt_source.peek()))
         else:
             self.prompt_tokenizer_tokens = None
 
         if self.environment.parsed_options.qps is not None:
             if self.environment.parsed_options.burst:
                 raise ValueError("Burst and QPS modes are mutually exclusive")
-            pacer = FixedQPSPacer.instance(
-                self.environment.parsed_options.qps,
-                self.environment.parsed_options.qps_distribution,
-            )
+            self.pacer = FixedQPSPacer.instance(self.environment.parsed_options)
+            self.scheduled_time = None
             # it will be called by Locust after each task
-            self.wait_time = pacer.wait_time_till_next
+            self.wait_time = self._qps_wait_time
             self.wait()
         elif self.environment.parsed_options.burst:
             self.wait_time = partial(constant_pacing(self.environment.parsed_options.burst), self)
@@ -686,376 +430,263 @@ class LLMUser(HttpUser):
 
         self.first_done = False
 
-    def _get_input(self):
-        def _maybe_randomize(prompt):
-            if not self.environment.parsed_options.prompt_randomize:
-                return prompt
-
-            # single letters are single tokens
-            num_random_tokens = (len(prompt) - len(PROMPT_SUFFIX)) // len(PROMPT_PREFIX_TOKEN)
-            return (
-                " ".join(chr(ord("a") + random.randint(0, 25)) for _ in range(num_random_tokens))
-                + " "
-                + prompt[-len(PROMPT_SUFFIX) :]
-            )
-
-        if isinstance(self.input, str):
-            return _maybe_randomize(self.input), None
-        else:
-            item = self.input[random.randint(0, len(self.input) - 1)]
-            assert "prompt" in item
-            return _maybe_randomize(item["prompt"]), item.get("images", None)
+    def _qps_wait_time(self):
+        self.scheduled_time = self.pacer.next_arrival()
+        if self.scheduled_time is None:
+            # the replayed trace is over
+            raise StopUser()
+        return self.pacer.wait_time_till(self.scheduled_time)
 
     @task
     def generate_text(self):
+        if self.environment.parsed_options.qps is not None:
+            # users may fall behind the schedule, latency has to count from when the request was due
+            schedule_lag = max(0.0, time.time() - self.scheduled_time)
+        else:
+            schedule_lag = None
+        if self.chat_session is None:
+            prompt, images, reused_prefix_tokens = self.prompt_source.get()
+            self._send_request(prompt, images, reused_prefix_tokens, schedule_lag=schedule_lag)
+            return
+
+        # a task is a whole conversation, only its first turn follows the schedule
+        for turn in range(self.environment.parsed_options.session_turns):
+            if turn > 0:
+                time.sleep(self.environment.parsed_options.think_time)
+            prompt, images, reused_prefix_tokens, history = self.chat_session.next_turn(turn)
+            text = self._send_request(
+                prompt, images, reused_prefix_tokens, history, turn, schedule_lag if turn == 0 else None
+            )
+            if text is None:
+                return
+            self.chat_session.add_response(text)
+
+    def _send_request(self, prompt, images, reused_prefix_tokens, history=None, turn=None, schedule_lag=None):
+        """
+        Returns the text of the response (empty unless it's collected) or None if it failed
+        """
         max_tokens = self.max_tokens_sampler.sample()
-        prompt, images = self._get_input()
-        data = self.provider_formatter.format_payload(prompt, max_tokens, images)
+        data = self.provider_formatter.format_payload(prompt, max_tokens, images, history)
         t_start = time.perf_counter()
 
         request_id = str(uuid4())
-        with self.client.post(
-            self.provider_formatter.get_url(), data=json.dumps(data), stream=True, catch_response=True, timeout=120
-        ) as response:
-            RequestTracker.add_request(request_id)
-
-            sseclient = SSEClient(response)
-            combined_text = ""
-            done = False
-            prompt_usage_tokens = self.prompt_tokenizer_tokens
-            total_usage_tokens = None
-            total_logprob_tokens = None
-            try:
-                response.raise_for_status()
-            except Exception as e:
-                raise RuntimeError(f"Error in response: {response.text}") from e
-            t_first_token = None
-            # for chunk in response.iter_lines(delimiter=b"\n\n"):
-            for chunk in sseclient.events():
-                # print(f"{id}:{chunk.data}")
-
-                
-                # if len(chunk) == 0:
-                # continue  # come providers send empty lines between data chunks
-                if done:
-                    if chunk.data != "[DONE]":
-                        print(f"WARNING: Received more chunks after [DONE]: {chunk.data}")
+        acc = None
+        if InitTracker.live_metrics:
+            InitTracker.live_metrics.request_started()
+        trace = InitTracker.tracer is not None and InitTracker.tracer.sample()
+        phases = {}
+        t_end = None
+        error = None
+        try:
+            with self.client.post(
+                self.provider_formatter.get_url(), data=json.dumps(data), stream=True, catch_response=True, timeout=120
+            ) as response:
+                # with stream=True requests returns once the headers are in
+                t_headers = time.perf_counter()
+                phases.update(request_phases(response, t_start), headers=t_headers)
+                RequestTracker.add_request(request_id)
+
+                acc = ResponseAccumulator(
+                    self.provider_formatter,
+                    prompt,
+                    self.stream,
+                    # only the first turn of a session has the prompt the tokenizer counted
+                    self.prompt_tokenizer_tokens if not turn else None,
+                    collect_text=self.tokenizer is not None
+                    or self.environment.parsed_options.show_response
+                    or self.chat_session is not None,
+                    reused_prefix_tokens=reused_prefix_tokens,
+                    turn=turn,
+                    verbose=not self.environment.parsed_options.quiet,
+                )
                 try:
-                    now = time.perf_counter()
-                    if self.stream:
-                        # assert chunk.data.startswith(b"data:"), f"Unexpected chunk not starting with 'data': {chunk}"
-                        # chunk = chunk[len(b"data:") :]
-                        if chunk.data.strip() == "[DONE]":
-                            done = True
-                            continue
-                    
-                    # ignore telemetry data
-                    if chunk.data.startswith('{"TTFT":{"') or chunk.data.startswith('{"TotalRequestDuration":{"'):
-                        continue
-
-                    data = orjson.loads(chunk.data)
-                    out = self.provider_formatter.parse_output_json(data, prompt)
-                    if out.usage_tokens:
-                        total_usage_tokens = (total_usage_tokens or 0) + out.usage_tokens
-                    if out.prompt_usage_tokens:
-                        prompt_usage_tokens = out.prompt_usage_tokens
-                    combined_text += out.text
-
-                    # some providers (SGLang) send an empty chunk first skewing the TTFT
-                    if combined_text and t_first_token is None:
-                        t_first_token = now
-                        RequestTracker.mark_first_chunk(request_id)
-
-                    if out.logprob_tokens:
-                        total_logprob_tokens = (total_logprob_tokens or 0) + out.logprob_tokens
+                    response.raise_for_status()
                 except Exception as e:
-                    print(f"Failed to parse response: {chunk} with error {repr(e)}", flush=True)
-                    response.failure(e)
-                    return
-            assert t_first_token is not None, "empty response received"
-            RequestTracker.mark_last_chunk(request_id)
-            if (
-                (total_logprob_tokens is not None)
-                and (total_usage_tokens is not None)
-                and total_logprob_tokens != total_usage_tokens
-            ):
-                print(f"WARNING: usage_tokens {total_usage_tokens} != logprob_tokens {total_logprob_tokens}")
-            if total_logprob_tokens is not None:
-                num_tokens = total_logprob_tokens
-            else:
-                num_tokens = total_usage_tokens
-            if self.tokenizer:
-                num_tokenizer_tokens = len(self.tokenizer.encode(combined_text))
-                if num_tokens is None:
-                    num_tokens = num_tokenizer_tokens
-                elif num_tokens != num_tokenizer_tokens:
-                    print(f"WARNING: tokenizer token count {num_tokenizer_tokens} != {num_tokens} received from server")
-                    if self.provider == "adaptive":
-                        num_tokens = num_tokenizer_tokens
-            num_tokens = num_tokens or 0
-            num_chars = len(combined_text)
-            now = time.perf_counter()
-            dur_total = now - t_start
-            dur_generation = now - t_first_token
-            dur_first_token = t_first_token - t_start
-            print(
-                f"Response received: total {dur_total*1000:.2f} ms, first token {dur_first_token*1000:.2f} ms, {num_chars} chars, {num_tokens} tokens"
-            )
-            if self.environment.parsed_options.show_response:
-                print("---")
-                print(combined_text)
-                print("---")
-            if num_chars:
-                add_custom_metric("latency_per_char", dur_generation / num_chars * 1000, num_chars)
-            if self.stream:
-                add_custom_metric("time_to_first_token", dur_first_token * 1000)
-            add_custom_metric("total_latency", dur_total * 1000)
-            if num_tokens:
-                if num_tokens != max_tokens:
-                    print(f"WARNING: wrong number of tokens: {num_tokens}, expected {max_tokens}")
-                add_custom_metric("num_tokens", num_tokens)
-                add_custom_metric("latency_per_token", dur_generation / num_tokens * 1000, num_tokens)
-                add_custom_metric(
-                    "overall_latency_per_token",
-                    dur_total / num_tokens * 1000,
-                    num_tokens,
-                )
-            if (
-                prompt_usage_tokens is not None
-                and self.prompt_tokenizer_tokens is not None
-                and prompt_usage_tokens != self.prompt_tokenizer_tokens
-            ):
-                print(
-                    f"WARNING: prompt usage tokens {prompt_usage_tokens} != {self.prompt_tokenizer_tokens} derived from local tokenizer"
+                    raise RuntimeError(f"Error in response: {response.text}") from e
+                if self.stream:
+                    # with chunked transfer encoding (what SSE servers use) urllib3 hands over every chunk as soon as it
+                    # arrives, otherwise small reads keep a partially filled buffer from delaying the chunks
+                    payloads = iter_sse_data(response.iter_content(chunk_size=None if response.raw.chunked else 128))
+                else:
+                    payloads = [response.content]
+                for payload in payloads:
+                    try:
+                        if acc.add_chunk(payload, time.perf_counter()):
+                            RequestTracker.mark_first_chunk(request_id)
+                    except Exception as e:
+                        print(f"Failed to parse response: {payload!r} with error {repr(e)}", flush=True)
+                        response.failure(e)
+                        self._add_error_record(request_id, turn, t_start, max_tokens, schedule_lag, acc, e, phases)
+                        error = e
+                        return None
+                assert acc.t_first_token is not None, "empty response received"
+                RequestTracker.mark_last_chunk(request_id)
+                t_end = time.perf_counter()
+                if self.environment.parsed_options.show_response:
+                    print("---")
+                    print(acc.combined_text)
+                    print("---")
+                record = partial(
+                    self._record_metrics,
+                    acc,
+                    request_id,
+                    turn,
+                    t_start,
+                    t_end,
+                    max_tokens,
+                    schedule_lag,
+                    phases,
+                    metrics_registry.start_time,
                 )
-            prompt_tokens = prompt_usage_tokens or self.prompt_tokenizer_tokens
-            if self.provider == "adaptive":
-                prompt_tokens = self.prompt_tokenizer_tokens
-
-            if prompt_tokens:
-                add_custom_metric("prompt_tokens", prompt_tokens)
+                if self.tokenizer:
+                    # the greenlet moves on right away, metrics are recorded once the tokenizer pool gets to it
+                    InitTracker.token_counter.count(acc.combined_text, record)
+                else:
+                    record(None)
 
-            if not self.first_done:
-                self.first_done = True
-                InitTracker.notify_first_request()
+                if not self.first_done:
+                    self.first_done = True
+                    InitTracker.notify_first_request()
+                return acc.combined_text
+        except Exception as e:
+            self._add_error_record(request_id, turn, t_start, max_tokens, schedule_lag, acc, e, phases)
+            error = e
+            raise
+        finally:
+            if InitTracker.live_metrics:
+                InitTracker.live_metrics.request_finished(error is not None)
+            if trace:
+                InitTracker.tracer.add_request(
+                    InitTracker.trace_pid,
+                    self.trace_track,
+                    f"user {self.trace_track}",
+                    t_start,
+                    t_end,
+                    acc,
+                    schedule_lag,
+                    phases,
+                    error,
+                    request_id=request_id,
+                    turn=turn,
+                    max_tokens=max_tokens,
+                )
 
+    def _add_error_record(self, request_id, turn, t_start, max_tokens, schedule_lag, acc, error, phases):
+        if InitTracker.records:
+            InitTracker.records.add(
+                request_record(
+                    request_id,
+                    t_start,
+                    max_tokens,
+                    schedule_lag,
+                    acc,
+                    error=error,
+                    phases=phases,
+                    turn=turn,
+                    **self.record_fields,
+                )
+            )
 
-@events.init_command_line_parser.add_listener
-def init_parser(parser):
-    parser.add_argument(
-        "--provider",
-        choices=list(PROVIDER_CLASS_MAP.keys()),
-        type=str,
-        help="Which flavor of API to use. If not specified, we'll try to guess based on the URL and /v1/models output",
-    )
-    parser.add_argument(
-        "-m",
-        "--model",
-        env_var="MODEL",
-        type=str,
-        help="The model to use for generating text. If not specified we will pick the first model from the service as returned by /v1/models",
-    )
-    parser.add_argument(
-        "--chat",
-        action=argparse.BooleanOptionalAction,
-        default=False,
-        help="Use /v1/chat/completions API",
-    )
-    parser.add_argument(
-        "-p",
-        "--prompt-tokens",
-        env_var="PROMPT_TOKENS",
-        type=int,
-        default=512,
-        help="Length of the prompt in tokens. Default 512",
-    )
-    parser.add_argument(
-        "--prompt-chars",
-        env_var="PROMPT_CHARS",
-        type=int,
-        help="Length of the prompt in characters.",
-    )
-    parser.add_argument(
-        "--prompt-text",
-        env_var="PROMPT_TEXT",
-        type=str,
-        help="Prompt text to use instead of generating one. It can be a file reference starting with an ampersand, e.g. `@prompt.txt`",
-    )
-    parser.add_argument(
-        "--prompt-randomize",
-        action=argparse.BooleanOptionalAction,
-        default=False,
-        help="Include a few random numbers in the generated prompt to avoid caching",
-    )
-    parser.add_argument(
-        "-o",
-        "--max-tokens",
-        env_var="MAX_TOKENS",
-        type=int,
-        default=64,
-        help="Max number of tokens to generate. If --max-tokens-distribution is non-constant this is going to be the mean. Defaults to 64",
-    )
-    parser.add_argument(
-        "--max-tokens-cap",
-        env_var="MAX_TOKENS_CAP",
-        type=int,
-        help="If --max-tokens-distribution is non-constant, this truncates the distribition at the specified limit",
-    )
-    parser.add_argument(
-        "--max-tokens-distribution",
-        env_var="MAX_TOKENS_DISTRIBUTION",
-        type=str,
-        choices=["constant", "uniform", "exponential", "normal"],
-        default="constant",
-        help="How to sample `max-tokens` on each request",
-    )
-    parser.add_argument(
-        "--max-tokens-range",
-        env_var="MAX_TOKENS_RANGE",
-        type=float,
-        default=0.3,
-        help="Specifies the width of the distribution. Specified value `alpha` is relative to `max-tokens`. For uniform distribution we'd sample from [max_tokens - max_tokens * alpha, max_tokens + max_tokens * alpha]. For normal distribution we'd sample from `N(max_tokens, max_tokens * alpha)`. Defaults to 0.3",
-    )
-    parser.add_argument(
-        "--stream",
-        dest="stream",
-        action=argparse.BooleanOptionalAction,
-        default=True,
-        help="Use the streaming API",
-    )
-    parser.add_argument(
-        "-k",
-        "--api-key",
-        env_var="API_KEY",
-        help="Auth for the API",
-    )
-    parser.add_argument(
-        "--temperature",
-        env_var="TEMPERATURE",
-        type=float,
-        default=1.0,
-        help="Temperature parameter for the API",
-    )
-    parser.add_argument(
-        "--logprobs",
-        type=int,
-        default=None,
-        help="Whether to ask for logprobs, it makes things slower for some providers but is necessary for token count in streaming (unless it's Fireworks API that returns usage in streaming mode)",
-    )
-    parser.add_argument(
-        "--summary-file",
-        type=str,
-        help="Append the line with the summary to the specified CSV file. Useful for generating a spreadsheet with perf sweep results. If the file doesn't exist, writes out the header first",
-    )
-    parser.add_argument(
-        "--qps",
-        type=float,
-        default=None,
-        help="Enabled 'fixed QPS' mode where requests are issues at the specified rate regardless of how long the processing takes. In this case --users and --spawn-rate need to be set to a sufficiently high value (e.g. 100)",
-    )
-    parser.add_argument(
-        "--qps-distribution",
-        type=str,
-        choices=["constant", "uniform", "exponential"],
-        default="constant",
-        help="Must be used with --qps. Specifies how to space out requests: equally ('constant') or by sampling wait times from a distribution ('uniform' or 'exponential'). Expected QPS is going to match --qps",
-    )
-    parser.add_argument(
-        "--burst",
-        type=float,
-        default=None,
-        help="Makes requests to arrive in bursts every specified number of seconds. Note that burst duration has to be longer than maximum time of the response. Size of the burst is controlled by --users. The spawn rate -r is best set to a high value",
-    )
-    parser.add_argument(
-        "--tokenizer",
-        type=str,
-        help="Specify HF tokenizer to use for validating the output of the model. It's optional, we're going to rely on 'usage' or 'logprobs' field to get token count information",
-    )
-    parser.add_argument(
-        "--show-response",
-        action=argparse.BooleanOptionalAction,
-        default=False,
-        help="Print the result of each generation",
-    )
-    parser.add_argument(
-        "-pcml",
-        "--prompt-cache-max-len",
-        env_var="PROMPT_CACHE_MAX_LEN",
-        type=int,
-        default=0,
-        help="Maximum length of the prompt cache to use. Defaults to 0 (no caching).",
-    )
-    parser.add_argument(
-        "--header",
-        action="append",
-        default=[],
-        help="Arbitrary headers to add to the inference request. Can be used multiple times. For example, --header header1:value1 --header header2:value2",
-    )
-    parser.add_argument(
-        "-n",
-        "--n",
-        default=1,
-        type=int,
-        help="How many sequences to generate (makes sense to use with non-zero temperature).",
-    )
+    def _record_metrics(
+        self,
+        acc,
+        request_id,
+        turn,
+        t_start,
+        t_end,
+        max_tokens,
+        schedule_lag,
+        phases,
+        stats_start_time,
+        num_tokenizer_tokens,
+    ):
+        # stats may have been reset while the response was waiting for the tokenizer
+        measured = metrics_registry.start_time == stats_start_time
+        if not measured and not InitTracker.records:
+            return
+        num_tokens = acc.count_tokens(self.provider, num_tokenizer_tokens)
+        prompt_tokens = acc.count_prompt_tokens(self.provider)
+        if InitTracker.records:
+            record = request_record(
+                request_id,
+                t_start,
+                max_tokens,
+                schedule_lag,
+                acc,
+                t_end,
+                phases=phases,
+                turn=turn,
+                **self.record_fields,
+            )
+            # the request resetting the stats completes before the reset, so the stats start time alone isn't enough
+            record.update(
+                prompt_tokens=prompt_tokens, output_tokens=num_tokens, measured=measured and InitTracker.warmed_up
+            )
+            InitTracker.records.add(record)
+            if not measured:
+                return
+        metrics = acc.metrics(t_start, t_end, num_tokens, max_tokens, prompt_tokens, schedule_lag, phases)
+        evaluate_slo(metrics, self.environment.parsed_options.slo_ttft, self.environment.parsed_options.slo_tpot)
+        if InitTracker.live_metrics:
+            InitTracker.live_metrics.observe(metrics)
+        for name, (value, length) in metrics.items():
+            metrics_registry.record(name, value)
+            if self.report_to_locust:
+                add_custom_metric(name, value, length)
+        for name, samples in acc.chunk_samples(num_tokens).items():
+            for value, count in samples:
+                metrics_registry.record(name, value, count)
+        clock_offset = time.time() - time.perf_counter()
+        for name, samples in acc.throughput_samples(num_tokens, prompt_tokens).items():
+            for t, tokens in samples:
+                metrics_registry.record_series(name, t + clock_offset, tokens)
+        InitTracker.observe_request(metrics["total_latency"][0])
+
+
+events.init_command_line_parser.add_listener(add_arguments)
+
+
+@events.test_stop.add_listener
+def _(environment, **kw):
+    # token counts of the last responses may still be computed, they have to make it into the summary (on workers
+    # into the final report to the master)
+    InitTracker.drain_token_counter()
 
 
 @events.quitting.add_listener
 def _(environment, **kw):
-    total_latency = environment.stats.entries[("total_latency", "METRIC")]
-    if environment.stats.total.num_failures > 0 or total_latency.num_requests == 0:
+    close_sinks()
+    stop_exporter()
+    close_tracers()
+    if isinstance(environment.runner, WorkerRunner):
+        # the master writes the summary
+        return
+    if environment.stats.total.num_failures > 0 or metrics_registry.num_requests("total_latency") == 0:
         print("Test failed due to failed requests")
         environment.process_exit_code = 1
         return
 
-    entries = copy.copy(InitTracker.logging_params)
     if environment.parsed_options.qps is not None:
-        entries["concurrency"] = f"{environment.parsed_options.qps}"
+        concurrency = f"{environment.parsed_options.qps}"
     else:
-        entries["concurrency"] = InitTracker.users
-    for metric_name in [
-        "time_to_first_token",
-        "latency_per_token",
-        "num_tokens",
-        "total_latency",
-        "prompt_tokens",  # might overwrite the static value based on server side tokenization
-    ]:
-        entries[metric_name] = environment.stats.entries[(metric_name, "METRIC")].avg_response_time
-    if not environment.parsed_options.stream:
-        # if there's no streaming these metrics are meaningless
-        entries["time_to_first_token"] = ""
-        entries["latency_per_token"] = ""
-    entries["num_requests"] = total_latency.num_requests
-    entries["qps"] = total_latency.total_rps
-    percentile_to_report = [50, 90, 99, 99.9]
-    percentile_metrics = ["time_to_first_token", "total_latency", "latency_per_token"]
-    for percentile_metric in percentile_metrics:
-        metrics = environment.stats.entries[percentile_metric, "METRIC"]
-        for percentile in percentile_to_report:
-            name = f"P{percentile}_{percentile_metric}"
-            entries[name] = metrics.get_response_time_percentile(percentile / 100)
-
-    initiated_reqs, first_chunk_only_reqs = RequestTracker.get_counts()
-    entries["total_requests"] = len(RequestTracker.requests)
-    entries["incomplete_requests_nofirstchunk"] = initiated_reqs
-    entries["incomplete_requests_nolastchunk"] = first_chunk_only_reqs
-    entries["incomplete_requests"] = initiated_reqs + first_chunk_only_reqs
-
-    pretty_name = lambda s: " ".join([w.capitalize() for w in s.split("_")])
-    entries = {pretty_name(k): v for k, v in entries.items()}
+        concurrency = InitTracker.users
+    entries = build_summary(
+        InitTracker.logging_params,
+        concurrency,
+        metrics_registry,
+        RequestTracker.get_totals(),
+        environment.parsed_options.stream,
+        environment.parsed_options.qps is not None,
+        InitTracker.convergence,
+    )
+    if environment.parsed_options.throughput_series_file:
+        append_throughput_series(
+            environment.parsed_options.throughput_series_file, InitTracker.logging_params, concurrency, metrics_registry
+        )
 
     # print in the final event handler to make sure our output is the last one
     @events.quit.add_listener
     def exit_printer(**kw):
-        max_width = max(len(k) for k in entries.keys())
-        print(" Summary ".center(80, "="))
-        for k, v in entries.items():
-            print(f"{k:<{max_width}}: {v}")
-        print("=" * 80)
-
+        print_summary(entries)
         if environment.parsed_options.summary_file:
-            with open(environment.parsed_options.summary_file, "a") as f:
-                writer = csv.DictWriter(f, fieldnames=entries.keys())
-                if f.tell() == 0:
-                    writer.writeheader()
-                writer.writerow(entries)
+            append_summary(environment.parsed_options.summary_file, entries)
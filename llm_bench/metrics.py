@@ -0,0 +1,243 @@
+import math
+import threading
+import time
+
+
+# values are stored as integers in these units, latencies are recorded in ms and kept with microsecond resolution
+DEFAULT_SCALE = 1000
+METRIC_SCALES = {
+    "num_tokens": 1,
+    "prompt_tokens": 1,
+    "good_tokens": 1,
+}
+
+
+class HdrHistogram:
+    """
+    Log-linear histogram with the bucketing of HdrHistogram: values below `2 ** sub_bucket_bits` are exact, larger
+    ones keep a relative precision of `2 ** -(sub_bucket_bits - 1)` (~0.1% by default). Buckets are stored sparsely,
+    so memory is bounded by the dynamic range of the values and not by their count. Count, sum, min and max are exact
+    """
+
+    def __init__(self, scale=DEFAULT_SCALE, sub_bucket_bits=11):
+        self.scale = scale
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _key(self, value):
+        v = max(0, int(value * self.scale))
+        shift = max(0, v.bit_length() - self.sub_bucket_bits)
+        return (shift << self.sub_bucket_bits) | (v >> shift)
+
+    def _value(self, key):
+        shift = key >> self.sub_bucket_bits
+        lowest = (key & ((1 << self.sub_bucket_bits) - 1)) << shift
+        return (lowest + ((1 << shift) - 1) / 2) / self.scale
+
+    def record(self, value, count=1):
+        key = self._key(value)
+        self.counts[key] = self.counts.get(key, 0) + count
+        self.count += count
+        self.sum += value * count
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0
+        rank = max(1, math.ceil(fraction * self.count))
+        seen = 0
+        for key in sorted(self.counts):
+            seen += self.counts[key]
+            if seen >= rank:
+                return min(max(self._value(key), self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        # pairs rather than a dict with int keys, so that it survives msgpack/json round trips
+        return {
+            "scale": self.scale,
+            "sub_bucket_bits": self.sub_bucket_bits,
+            "counts": [[k, c] for k, c in self.counts.items()],
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        hist = cls(data["scale"], data["sub_bucket_bits"])
+        hist.counts = {k: c for k, c in data["counts"]}
+        hist.count = data["count"]
+        hist.sum = data["sum"]
+        if hist.count:
+            hist.min = data["min"]
+            hist.max = data["max"]
+        return hist
+
+
+class TimeSeries:
+    """
+    Values summed into buckets of one second of wall clock time, keyed by the epoch second so that series recorded
+    by different processes line up when merged
+    """
+
+    def __init__(self):
+        self.buckets = {}
+
+    def add(self, t, value):
+        second = int(t)
+        self.buckets[second] = self.buckets.get(second, 0) + value
+
+    def merge(self, other):
+        for second, value in other.buckets.items():
+            self.buckets[second] = self.buckets.get(second, 0) + value
+
+    def values(self, start, end):
+        """
+        Values of the whole seconds between `start` and `end`, zero for seconds without any
+        """
+        return [self.buckets.get(second, 0) for second in range(math.ceil(start), math.floor(end))]
+
+    def to_dict(self):
+        return [[second, value] for second, value in self.buckets.items()]
+
+    @classmethod
+    def from_dict(cls, data):
+        series = cls()
+        series.buckets = {second: value for second, value in data}
+        return series
+
+
+class MetricsRegistry:
+    """
+    Histograms of the custom metrics. Every thread records into its own shard, so recording doesn't take a lock,
+    shards are merged when the summary is computed. In distributed mode the master also merges the latest snapshots
+    reported by workers
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # replaced rather than cleared, a thread that is recording right now keeps writing into the old shard
+            self.shards = {}
+            self.series_shards = {}
+            self.remote = {}
+            self.start_time = time.time()
+            self.last_request_time = None
+
+    def _shard(self):
+        thread_id = threading.get_native_id()
+        shard = self.shards.get(thread_id)
+        if shard is None:
+            with self.lock:
+                shard = self.shards.setdefault(thread_id, {})
+        return shard
+
+    def record(self, name, value, count=1):
+        shard = self._shard()
+        hist = shard.get(name)
+        if hist is None:
+            hist = shard[name] = HdrHistogram(METRIC_SCALES.get(name, DEFAULT_SCALE))
+        hist.record(value, count)
+        self.last_request_time = time.time()
+
+    def record_series(self, name, t, value):
+        """
+        Adds `value` to the per second series `name` at the wall clock time `t`, values from before the last reset
+        are dropped
+        """
+        if t < self.start_time:
+            return
+        thread_id = threading.get_native_id()
+        shard = self.series_shards.get(thread_id)
+        if shard is None:
+            with self.lock:
+                shard = self.series_shards.setdefault(thread_id, {})
+        series = shard.get(name)
+        if series is None:
+            series = shard[name] = TimeSeries()
+        series.add(t, value)
+
+    def _local_series(self):
+        merged = {}
+        for shard in list(self.series_shards.values()):
+            for name, series in list(shard.items()):
+                merged.setdefault(name, TimeSeries()).merge(series)
+        return merged
+
+    def series(self, name):
+        series = self._local_series().get(name) or TimeSeries()
+        for snapshot in list(self.remote.values()):
+            if name in snapshot.get("series", {}):
+                series.merge(TimeSeries.from_dict(snapshot["series"][name]))
+        return series
+
+    def end_time(self):
+        """
+        Time of the last recorded request across all processes
+        """
+        return max([self.last_request_time or 0] + [s["last_request_time"] or 0 for s in list(self.remote.values())])
+
+    def _local(self):
+        merged = {}
+        for shard in list(self.shards.values()):
+            for name, hist in list(shard.items()):
+                merged.setdefault(name, HdrHistogram(hist.scale, hist.sub_bucket_bits)).merge(hist)
+        return merged
+
+    def histogram(self, name):
+        hist = self._local().get(name) or HdrHistogram(METRIC_SCALES.get(name, DEFAULT_SCALE))
+        for snapshot in list(self.remote.values()):
+            if name in snapshot["histograms"]:
+                hist.merge(HdrHistogram.from_dict(snapshot["histograms"][name]))
+        return hist
+
+    def serialize(self):
+        return {
+            "histograms": {name: hist.to_dict() for name, hist in self._local().items()},
+            "series": {name: series.to_dict() for name, series in self._local_series().items()},
+            "last_request_time": self.last_request_time,
+        }
+
+    def update_remote(self, client_id, snapshot):
+        with self.lock:
+            self.remote[client_id] = snapshot
+
+    # the interface `build_summary` expects
+
+    def avg(self, name):
+        return self.histogram(name).mean()
+
+    def percentile(self, name, fraction):
+        return self.histogram(name).percentile(fraction)
+
+    def num_requests(self, name):
+        return self.histogram(name).count
+
+    def rps(self, name):
+        last_request_time = self.end_time()
+        if last_request_time <= self.start_time:
+            return 0
+        return self.num_requests(name) / (last_request_time - self.start_time)
@@ -0,0 +1,295 @@
+"""
+Deterministic stand-in for an LLM server speaking the OpenAI-compatible protocols the benchmark sends, to measure the
+load generator itself (its overhead and the highest load it can drive) and to try features without a GPU.
+
+It serves `/v1/completions`, `/v1/chat/completions`, their `/api/v1/...` variants (`--provider adaptive`) and
+`/v1/models`, streaming or not. Requests are run by a simulated continuous batching engine: up to `--max-batch-size`
+requests decode at once and up to `--queue-size` more wait for a slot, the others get a 429. A request waits
+`--ttft` ms plus `--prefill-per-token` ms per prompt token for its first token, then `--tpot` ms per token, both slowed
+down by `--batch-slowdown` for every other request in the batch. It always generates `max_tokens` tokens, each one a
+common English word (one token for the usual tokenizers). Prompt tokens are counted as words. e.g.:
+
+    python mock_server.py --port 8000 --ttft 200 --tpot 20 --max-batch-size 64 --batch-slowdown 0.01 --telemetry
+    python async_engine.py -H http://localhost:8000 -m mock --provider adaptive -o 128 --chat --stream --qps 10
+"""
+
+import argparse
+import asyncio
+import contextlib
+import itertools
+import time
+
+import orjson
+from aiohttp import web
+
+
+WORDS = [" the", " of", " and", " to", " in", " is", " that", " it"]
+SSE_HEADERS = {"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Engine:
+    """
+    Continuous batching: `running` requests share the decoder, each step takes longer the more of them there are
+    """
+
+    def __init__(self, ttft, prefill_per_token, tpot, batch_slowdown, max_batch_size=None, queue_size=None):
+        self.ttft = ttft / 1000
+        self.prefill_per_token = prefill_per_token / 1000
+        self.tpot = tpot / 1000
+        self.batch_slowdown = batch_slowdown
+        self.max_batch_size = max_batch_size
+        self.queue_size = queue_size
+        self.slots = asyncio.Semaphore(max_batch_size) if max_batch_size else None
+        self.running = 0
+        self.queued = 0
+
+    def slowdown(self):
+        return 1 + self.batch_slowdown * max(0, self.running - 1)
+
+    def first_token_delay(self, prompt_tokens):
+        return (self.ttft + self.prefill_per_token * prompt_tokens) * self.slowdown()
+
+    def token_delay(self):
+        return self.tpot * self.slowdown()
+
+    def check_capacity(self):
+        """
+        Raises `QueueFull` if a new request would have to wait and the queue is full
+        """
+        full_batch = self.slots is not None and self.running + self.queued >= self.max_batch_size
+        if full_batch and self.queue_size is not None and self.queued >= self.queue_size:
+            raise QueueFull()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        if self.slots is not None:
+            self.queued += 1
+            try:
+                await self.slots.acquire()
+            finally:
+                self.queued -= 1
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            if self.slots is not None:
+                self.slots.release()
+
+
+def count_prompt_tokens(body):
+    if "messages" in body:
+        texts = []
+        for message in body["messages"]:
+            content = message.get("content") or ""
+            if isinstance(content, list):
+                texts += [part.get("text", "") for part in content if part.get("type") == "text"]
+            else:
+                texts.append(content)
+    else:
+        texts = [body.get("prompt", "")]
+    return sum(len(text.split()) for text in texts)
+
+
+def duration_frame(name, seconds):
+    # serialized Rust `Duration`, as sent by Adaptive
+    secs = int(seconds)
+    return orjson.dumps({name: {"secs": secs, "nanos": int((seconds - secs) * 1e9)}})
+
+
+class MockServer:
+    def __init__(self, engine, model="mock", owned_by="openai", usage="always", telemetry=False, tokens_per_chunk=1):
+        self.engine = engine
+        self.model = model
+        self.owned_by = owned_by
+        self.usage = usage
+        self.telemetry = telemetry
+        self.tokens_per_chunk = tokens_per_chunk
+        self.ids = itertools.count()
+
+    def make_app(self):
+        app = web.Application()
+        for prefix in ("/v1", "/api/v1"):
+            app.router.add_post(f"{prefix}/completions", self.completions)
+            app.router.add_post(f"{prefix}/chat/completions", self.completions)
+            app.router.add_get(f"{prefix}/models", self.models)
+        return app
+
+    async def models(self, request):
+        return web.json_response(
+            {"object": "list", "data": [{"id": self.model, "object": "model", "owned_by": self.owned_by}]}
+        )
+
+    def _choice(self, chat, stream, text, logprobs, num_tokens, finish_reason=None):
+        if not chat:
+            choice = {"index": 0, "text": text}
+        elif stream:
+            choice = {"index": 0, "delta": {"content": text}}
+        else:
+            choice = {"index": 0, "message": {"role": "assistant", "content": text}}
+        if logprobs:
+            # what the providers count tokens from
+            choice["logprobs"] = {"tokens": [""] * num_tokens}
+        choice["finish_reason"] = finish_reason
+        return choice
+
+    async def completions(self, request):
+        t_arrival = time.perf_counter()
+        body = await request.json()
+        if body.get("n", 1) != 1:
+            return web.json_response({"error": {"message": "n > 1 is not supported"}}, status=400)
+        max_tokens = body.get("max_tokens")
+        max_tokens = 16 if max_tokens is None else max_tokens
+        if not isinstance(max_tokens, int) or max_tokens < 1:
+            return web.json_response({"error": {"message": "max_tokens must be a positive integer"}}, status=400)
+        try:
+            self.engine.check_capacity()
+        except QueueFull:
+            return web.json_response({"error": {"message": "queue is full", "type": "overloaded"}}, status=429)
+
+        chat = request.path.endswith("/chat/completions")
+        stream = bool(body.get("stream"))
+        prompt_tokens = count_prompt_tokens(body)
+        logprobs = body.get("logprobs") not in (None, False)
+        header = {
+            "id": f"cmpl-{next(self.ids)}",
+            "object": "chat.completion.chunk" if chat else "text_completion",
+            "created": int(time.time()),
+            "model": body.get("model", self.model),
+        }
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": max_tokens,
+            "total_tokens": prompt_tokens + max_tokens,
+        }
+        if not stream:
+            async with self.engine.slot():
+                deadline = time.perf_counter() + self.engine.first_token_delay(prompt_tokens)
+                await asyncio.sleep(max(0.0, deadline - time.perf_counter()))
+                for _ in range(max_tokens - 1):
+                    deadline += self.engine.token_delay()
+                    await asyncio.sleep(max(0.0, deadline - time.perf_counter()))
+            text = "".join(WORDS[i % len(WORDS)] for i in range(max_tokens))
+            header["object"] = "chat.completion" if chat else "text_completion"
+            choice = self._choice(chat, False, text, logprobs, max_tokens, "length")
+            return web.Response(
+                body=orjson.dumps({**header, "choices": [choice], "usage": usage}), content_type="application/json"
+            )
+
+        # headers go out right away, queueing shows up in the time to first token as with vLLM
+        response = web.StreamResponse(headers=SSE_HEADERS)
+        await response.prepare(request)
+        send = lambda data: response.write(b"data: " + orjson.dumps(data) + b"\n\n")
+        try:
+            async with self.engine.slot():
+                if chat:
+                    await send({**header, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}}]})
+                deadline = time.perf_counter() + self.engine.first_token_delay(prompt_tokens)
+                t_first_token = None
+                for start in range(0, max_tokens, self.tokens_per_chunk):
+                    # from the schedule rather than the last wake up, so that event loop delays don't accumulate
+                    await asyncio.sleep(max(0.0, deadline - time.perf_counter()))
+                    t_first_token = t_first_token or time.perf_counter()
+                    num_tokens = min(self.tokens_per_chunk, max_tokens - start)
+                    text = "".join(WORDS[i % len(WORDS)] for i in range(start, start + num_tokens))
+                    last = start + num_tokens >= max_tokens
+                    choice = self._choice(chat, True, text, logprobs, num_tokens, "length" if last else None)
+                    await send({**header, "choices": [choice]})
+                    deadline += self.engine.token_delay() * min(self.tokens_per_chunk, max_tokens - start - num_tokens)
+            if self.telemetry:
+                await response.write(b"data: " + duration_frame("TTFT", t_first_token - t_arrival) + b"\n\n")
+                duration = duration_frame("TotalRequestDuration", time.perf_counter() - t_arrival)
+                await response.write(b"data: " + duration + b"\n\n")
+            include_usage = (body.get("stream_options") or {}).get("include_usage")
+            if self.usage == "always" or (self.usage == "requested" and include_usage):
+                await send({**header, "choices": [], "usage": usage})
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            # the client went away, e.g. cancelled at the end of a run
+            pass
+        return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", type=str, default="0.0.0.0", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument("--model", type=str, default="mock", help="Model name listed in /v1/models")
+    parser.add_argument(
+        "--owned-by",
+        type=str,
+        default="openai",
+        help="owned_by of the model in /v1/models, which the benchmark detects the provider from",
+    )
+    parser.add_argument("--ttft", type=float, default=50, help="Time to first token in ms of an empty prompt")
+    parser.add_argument(
+        "--prefill-per-token", type=float, default=0, help="Additional ms to first token per prompt token"
+    )
+    parser.add_argument("--tpot", type=float, default=10, help="Time per output token in ms of a batch of one request")
+    parser.add_argument(
+        "--batch-slowdown",
+        type=float,
+        default=0,
+        help="Relative slowdown of the prefill and every decode step per other request in the batch, e.g. 0.01 makes "
+        "a batch of 101 requests twice slower than a single one",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=None,
+        help="Requests running at once, the others wait for a slot. Unlimited by default",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=None,
+        help="Requests waiting for a slot beyond which requests are rejected with 429. Unlimited by default",
+    )
+    parser.add_argument(
+        "--tokens-per-chunk",
+        type=int,
+        default=1,
+        help="Tokens sent in every streamed chunk, more makes the server cheaper at high token rates",
+    )
+    parser.add_argument(
+        "--usage",
+        choices=["always", "requested", "never"],
+        default="always",
+        help="When streamed responses end with a usage chunk: always (like Fireworks), when requested with "
+        "stream_options.include_usage (like OpenAI and vLLM) or never. Non streamed responses always have it",
+    )
+    parser.add_argument(
+        "--telemetry",
+        action="store_true",
+        default=False,
+        help="End streams with the TTFT and TotalRequestDuration events of Adaptive, measured from the arrival of the "
+        "request on the server",
+    )
+    args = parser.parse_args()
+    assert args.tokens_per_chunk >= 1, "--tokens-per-chunk must be at least 1"
+    try:
+        import uvloop
+
+        uvloop.install()
+    except ImportError:
+        pass
+
+    async def make_app():
+        # the engine's semaphore belongs to the server's event loop
+        engine = Engine(
+            args.ttft, args.prefill_per_token, args.tpot, args.batch_slowdown, args.max_batch_size, args.queue_size
+        )
+        server = MockServer(engine, args.model, args.owned_by, args.usage, args.telemetry, args.tokens_per_chunk)
+        return server.make_app()
+
+    print(f"Mock server listening on http://{args.host}:{args.port}")
+    web.run_app(make_app(), host=args.host, port=args.port, print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+import argparse
+import os
+import re
+
+from providers import PROVIDER_CLASS_MAP
+
+
+def add_arguments(parser):
+    """
+    Registers options shared by the Locust and asyncio engines. `parser` is either Locust's parser or a `configargparse` one, both support `env_var`
+    """
+    parser.add_argument(
+        "--provider",
+        choices=list(PROVIDER_CLASS_MAP.keys()),
+        type=str,
+        help="Which flavor of API to use. If not specified, we'll try to guess based on the URL and /v1/models output",
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        env_var="MODEL",
+        type=str,
+        help="The model to use for generating text. If not specified we will pick the first model from the service as returned by /v1/models",
+    )
+    parser.add_argument(
+        "--chat",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Use /v1/chat/completions API",
+    )
+    parser.add_argument(
+        "-p",
+        "--prompt-tokens",
+        env_var="PROMPT_TOKENS",
+        type=int,
+        default=512,
+        help="Length of the prompt in tokens. Default 512",
+    )
+    parser.add_argument(
+        "--prompt-chars",
+        env_var="PROMPT_CHARS",
+        type=int,
+        help="Length of the prompt in characters.",
+    )
+    parser.add_argument(
+        "--prompt-text",
+        env_var="PROMPT_TEXT",
+        type=str,
+        help="Prompt text to use instead of generating one. It can be a file reference starting with an ampersand, e.g. `@prompt.txt`",
+    )
+    parser.add_argument(
+        "--prompt-randomize",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Include a few random numbers in the generated prompt to avoid caching",
+    )
+    parser.add_argument(
+        "--prompt-pool-size",
+        env_var="PROMPT_POOL_SIZE",
+        type=int,
+        default=None,
+        help="Number of distinct prompts generated upfront with --prompt-randomize. Prompts repeat after this many requests. Defaults to as many as needed for 4M tokens, more than a prefix cache of a server holds",
+    )
+    parser.add_argument(
+        "--prompt-pool-dir",
+        env_var="PROMPT_POOL_DIR",
+        type=str,
+        default=os.path.join("~", ".cache", "llm_bench"),
+        help="Directory caching the generated prompts (keyed by tokenizer, length and seed) so that runs of a sweep share them. Empty string disables the cache. Defaults to ~/.cache/llm_bench",
+    )
+    parser.add_argument(
+        "--prefix-hit-ratio",
+        env_var="PREFIX_HIT_RATIO",
+        type=float,
+        default=None,
+        help="Fraction of requests starting with one of --num-system-prompts shared prefixes (the rest get a unique one), which controls the prefix cache hit ratio. The rest of the prompt is always random",
+    )
+    parser.add_argument(
+        "--shared-prefix-tokens",
+        env_var="SHARED_PREFIX_TOKENS",
+        type=int,
+        default=None,
+        help="Length of the shared prefix with --prefix-hit-ratio, it's part of the --prompt-tokens. Defaults to half of the prompt",
+    )
+    parser.add_argument(
+        "--num-system-prompts",
+        env_var="NUM_SYSTEM_PROMPTS",
+        type=int,
+        default=1,
+        help="Number of distinct shared prefixes with --prefix-hit-ratio. Defaults to 1",
+    )
+    parser.add_argument(
+        "--session-turns",
+        env_var="SESSION_TURNS",
+        type=int,
+        default=None,
+        help="Chat session mode: every user holds a conversation of this many turns, each turn sends the previous turns along with a new message. With --qps the rate is of conversations rather than requests",
+    )
+    parser.add_argument(
+        "--think-time",
+        env_var="THINK_TIME",
+        type=float,
+        default=0,
+        help="Seconds between receiving a response and sending the next turn of a chat session. Defaults to 0",
+    )
+    parser.add_argument(
+        "--turn-tokens",
+        env_var="TURN_TOKENS",
+        type=int,
+        default=64,
+        help="Approximate length in tokens of the user message of every turn but the first, which is -p long. Together with the responses it controls how fast the context grows. Defaults to 64",
+    )
+    parser.add_argument(
+        "-o",
+        "--max-tokens",
+        env_var="MAX_TOKENS",
+        type=int,
+        default=64,
+        help="Max number of tokens to generate. If --max-tokens-distribution is non-constant this is going to be the mean. Defaults to 64",
+    )
+    parser.add_argument(
+        "--max-tokens-cap",
+        env_var="MAX_TOKENS_CAP",
+        type=int,
+        help="If --max-tokens-distribution is non-constant, this truncates the distribition at the specified limit",
+    )
+    parser.add_argument(
+        "--max-tokens-distribution",
+        env_var="MAX_TOKENS_DISTRIBUTION",
+        type=str,
+        choices=["constant", "uniform", "exponential", "normal"],
+        default="constant",
+        help="How to sample `max-tokens` on each request",
+    )
+    parser.add_argument(
+        "--max-tokens-range",
+        env_var="MAX_TOKENS_RANGE",
+        type=float,
+        default=0.3,
+        help="Specifies the width of the distribution. Specified value `alpha` is relative to `max-tokens`. For uniform distribution we'd sample from [max_tokens - max_tokens * alpha, max_tokens + max_tokens * alpha]. For normal distribution we'd sample from `N(max_tokens, max_tokens * alpha)`. Defaults to 0.3",
+    )
+    parser.add_argument(
+        "--stream",
+        dest="stream",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Use the streaming API",
+    )
+    parser.add_argument(
+        "-k",
+        "--api-key",
+        env_var="API_KEY",
+        help="Auth for the API",
+    )
+    parser.add_argument(
+        "--temperature",
+        env_var="TEMPERATURE",
+        type=float,
+        default=1.0,
+        help="Temperature parameter for the API",
+    )
+    parser.add_argument(
+        "--logprobs",
+        type=int,
+        default=None,
+        help="Whether to ask for logprobs, it makes things slower for some providers but is necessary for token count in streaming (unless it's Fireworks API that returns usage in streaming mode)",
+    )
+    parser.add_argument(
+        "--summary-file",
+        type=str,
+        help="Append the line with the summary to the specified CSV file. Useful for generating a spreadsheet with perf sweep results. If the file doesn't exist, writes out the header first",
+    )
+    parser.add_argument(
+        "--throughput-series-file",
+        type=str,
+        default=None,
+        help="Append the prompt and output tokens delivered in every second of the run to the specified CSV file",
+    )
+    parser.add_argument(
+        "--records-file",
+        type=str,
+        default=None,
+        help="Write one record per request (timestamps, token counts, status, chunk stats) to the specified Parquet (.parquet) or Arrow IPC (any other extension) file for offline analysis. Requires pyarrow. In distributed mode every worker writes its own file suffixed with its id",
+    )
+    parser.add_argument(
+        "--run-label",
+        type=str,
+        default=None,
+        help="Label of the run in the per request records, sweep.py sets it to the point of the grid",
+    )
+    parser.add_argument(
+        "--quiet",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Don't print a line per request, printing from every user is a measurable overhead at high QPS",
+    )
+    parser.add_argument(
+        "--qps",
+        type=float,
+        default=None,
+        help="Enabled 'fixed QPS' mode where requests are issues at the specified rate regardless of how long the processing takes. In this case --users and --spawn-rate need to be set to a sufficiently high value (e.g. 100)",
+    )
+    parser.add_argument(
+        "--qps-distribution",
+        type=str,
+        choices=["constant", "uniform", "exponential"],
+        default="constant",
+        help="Must be used with --qps. Specifies how to space out requests: equally ('constant') or by sampling wait times from a distribution ('uniform' or 'exponential'). Expected QPS is going to match --qps",
+    )
+    parser.add_argument(
+        "--qps-trace",
+        type=str,
+        default=None,
+        help="Replay arrival times from a file instead of generating them: timestamps in seconds in the first column of a text/CSV file or a .npy array. Enables 'fixed QPS' mode, --qps defaults to the average rate of the trace",
+    )
+    parser.add_argument(
+        "--qps-trace-speedup",
+        type=float,
+        default=1.0,
+        help="Must be used with --qps-trace. Compresses the time of the trace by the given factor, e.g. 2 replays it twice as fast",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Random seed for the arrival schedule in 'fixed QPS' mode and the prompt pool, makes the request timing reproducible between runs",
+    )
+    parser.add_argument(
+        "--burst",
+        type=float,
+        default=None,
+        help="Makes requests to arrive in bursts every specified number of seconds. Note that burst duration has to be longer than maximum time of the response. Size of the burst is controlled by --users. The spawn rate -r is best set to a high value",
+    )
+    parser.add_argument(
+        "--slo-ttft",
+        type=float,
+        default=None,
+        help="SLO on the time to first token of a request in ms. A request counts towards goodput if it meets all the given SLOs. Without streaming the first token arrives with the whole response",
+    )
+    parser.add_argument(
+        "--slo-tpot",
+        type=float,
+        default=None,
+        help="SLO on the time per output token of a request in ms (latency per token after the first one)",
+    )
+    parser.add_argument(
+        "--adaptive-duration",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Stop the run as soon as the P50 and P90 latencies are known within --ci-target, -t becomes the maximum duration. Stats are reset once the warm-up is detected from rolling windows of latency and throughput rather than after the first response",
+    )
+    parser.add_argument(
+        "--ci-target",
+        type=float,
+        default=0.05,
+        help="Must be used with --adaptive-duration. Half width of the 95%% confidence interval of the percentiles relative to their value at which the run stops",
+    )
+    parser.add_argument(
+        "--ci-min-requests",
+        type=int,
+        default=50,
+        help="Must be used with --adaptive-duration. Minimum number of requests measured after the warm-up",
+    )
+    parser.add_argument(
+        "--warmup-window",
+        type=float,
+        default=10.0,
+        help="Must be used with --adaptive-duration. Length in seconds of the windows compared to detect the end of the warm-up, a window is extended until it has at least 5 requests",
+    )
+    parser.add_argument(
+        "--tokenizer",
+        type=str,
+        help="Specify HF tokenizer to use for validating the output of the model. It's optional, we're going to rely on 'usage' or 'logprobs' field to get token count information",
+    )
+    parser.add_argument(
+        "--show-response",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Print the result of each generation",
+    )
+    parser.add_argument(
+        "--locust-metrics",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Also report every custom metric as a fake Locust request so that it shows up in Locust stats, web UI and Grafana. Always on with --timescale. The summary doesn't need it",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve live metrics (latency quantiles over a rolling window, tokens/s, requests in flight) in the OpenMetrics text format on http://<host>:<port>/metrics for Prometheus, without the Postgres setup of Grafana mode. In distributed mode workers that can't bind the port use a free one",
+    )
+    parser.add_argument(
+        "--metrics-snapshot-file",
+        type=str,
+        default=None,
+        help="Write the live metrics to the specified file every --metrics-snapshot-interval seconds, replacing it atomically (e.g. for the textfile collector of the Prometheus node exporter). In distributed mode every worker writes its own file suffixed with its id",
+    )
+    parser.add_argument(
+        "--metrics-snapshot-interval",
+        type=float,
+        default=10,
+        help="Seconds between two writes of --metrics-snapshot-file",
+    )
+    parser.add_argument(
+        "--metrics-window",
+        type=float,
+        default=60,
+        help="Seconds covered by the rolling quantiles and tokens/s of the live metrics",
+    )
+    parser.add_argument(
+        "--connection-policy",
+        choices=["keep-alive", "fresh"],
+        default="keep-alive",
+        help="keep-alive: reuse connections between requests (the default). fresh: open a new connection for every request (Connection: close), to measure the cost of connection churn",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=None,
+        help="Maximum size of the connection pool of the asyncio engine, requests beyond it wait for a free connection (reported as Connection Wait). Unlimited by default. Locust users always have one connection each",
+    )
+    parser.add_argument(
+        "--trace-file",
+        type=str,
+        default=None,
+        help="Write a timeline of the requests (one track per user, spans for the schedule lag, connection, headers, first token and streaming, an instant per chunk) in the Chrome trace event format, to open in https://ui.perfetto.dev. Gzipped if the name ends with .gz. In distributed mode every worker writes its own file suffixed with its id",
+    )
+    parser.add_argument(
+        "--trace-sample-rate",
+        type=float,
+        default=1.0,
+        help="Fraction of the requests in --trace-file",
+    )
+    parser.add_argument(
+        "--trace-max-events",
+        type=int,
+        default=500_000,
+        help="Stop adding requests to --trace-file after this many events, to bound its memory and size",
+    )
+    parser.add_argument(
+        "-pcml",
+        "--prompt-cache-max-len",
+        env_var="PROMPT_CACHE_MAX_LEN",
+        type=int,
+        default=0,
+        help="Maximum length of the prompt cache to use. Defaults to 0 (no caching).",
+    )
+    parser.add_argument(
+        "--header",
+        action="append",
+        default=[],
+        help="Arbitrary headers to add to the inference request. Can be used multiple times. For example, --header header1:value1 --header header2:value2",
+    )
+    parser.add_argument(
+        "-n",
+        "--n",
+        default=1,
+        type=int,
+        help="How many sequences to generate (makes sense to use with non-zero temperature).",
+    )
+
+
+def parse_timespan(time_str):
+    """
+    Parses durations like `60`, `90s`, `5min` or `1h30m` into seconds, same as Locust's `-t`
+    """
+    if not time_str:
+        raise ValueError("Invalid time span format")
+    if re.match(r"^\d+$", time_str):
+        return int(time_str)
+    timespan_regex = re.compile(r"((?P<hours>\d+?)h)?((?P<minutes>\d+?)m(in)?)?((?P<seconds>\d+?)s)?")
+    parts = timespan_regex.fullmatch(time_str)
+    if not parts:
+        raise ValueError("Invalid time span format. Valid formats: 20, 20s, 3m, 2h, 1h20m, 3h30m10s, etc.")
+    parts = parts.groupdict()
+    return int(parts["hours"] or 0) * 3600 + int(parts["minutes"] or 0) * 60 + int(parts["seconds"] or 0)
@@ -4,18 +4,129 @@ import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import os
 
+from results_store import ResultsStore
 
-def main(args):
-    # Read the CSV data
+
+# the only columns of the summary files the report reads
+REPORT_COLUMNS = [
+    "Provider",
+    "Concurrency",
+    "Prompt Tokens",
+    "Incomplete Requests",
+    "Total Requests",
+    "P90 Time To First Token",
+    "P90 Latency Per Token",
+    "P90 Total Latency",
+    "Goodput",
+    "P90 Inter Token Latency",
+    "P99 Max Stall",
+    "Tokens Per Chunk",
+    "Prompt Token Reuse",
+]
+# sections rendered with a results store are cached, bump when the figures change
+FRAGMENT_VERSION = 1
+
+
+def prefix_reuse_figure(df):
+    panels = [
+        ("P90 Time to First Token vs. Prompt Token Reuse", "TTFT (ms)", "P90 Time To First Token"),
+        ("P90 Total Latency vs. Prompt Token Reuse", "Total latency(ms)", "P90 Total Latency"),
+    ]
+    fig = make_subplots(rows=len(panels), cols=1, subplot_titles=[title for title, _, _ in panels])
+    df = df.assign(**{"Prompt Token Reuse": pd.to_numeric(df["Prompt Token Reuse"])})
+    for (provider, concurrency), group in df.groupby(["Provider", "Concurrency"]):
+        group = group.sort_values("Prompt Token Reuse")
+        for row, (_, _, column) in enumerate(panels, start=1):
+            fig.add_trace(
+                go.Scatter(
+                    x=group["Prompt Token Reuse"] * 100,
+                    y=group[column],
+                    name=f"{provider} @ {concurrency}",
+                    legendgroup=f"{provider} @ {concurrency}",
+                    showlegend=row == 1,
+                ),
+                row=row,
+                col=1,
+            )
+    for row, (_, y_title, _) in enumerate(panels, start=1):
+        fig.update_xaxes(title_text="Prompt token reuse (%)", row=row, col=1)
+        fig.update_yaxes(title_text=y_title, row=row, col=1)
+    fig.update_layout(height=250 * len(panels), width=1000, showlegend=True)
+    return fig
+
+
+def throughput_series_figure(series_df):
+    panels = [
+        ("Output Tokens per Second over Time", "Output tokens/s", "Output Tokens Per Second"),
+        ("Prompt Tokens per Second over Time", "Prompt tokens/s", "Prompt Tokens Per Second"),
+    ]
+    fig = make_subplots(rows=len(panels), cols=1, subplot_titles=[title for title, _, _ in panels])
+    # one line per run, a run being identified by its start time
+    for (provider, concurrency, _), run in series_df.groupby(["Provider", "Concurrency", "Run Start"]):
+        for row, (_, _, column) in enumerate(panels, start=1):
+            fig.add_trace(
+                go.Scatter(
+                    x=run["Second"],
+                    y=run[column],
+                    name=f"{provider} @ {concurrency}",
+                    legendgroup=f"{provider} @ {concurrency}",
+                    showlegend=row == 1,
+                ),
+                row=row,
+                col=1,
+            )
+    for row, (_, y_title, _) in enumerate(panels, start=1):
+        fig.update_xaxes(title_text="Time since the start of the run (s)", row=row, col=1)
+        fig.update_yaxes(title_text=y_title, row=row, col=1)
+    fig.update_layout(height=250 * len(panels), width=1000, showlegend=True)
+    return fig
+
+
+def read_results(input_files, provider_suffixes):
     dfs = []
-    for idx, f in enumerate(args.input_files):
-        this_df = pd.read_csv(f)
-        if args.provider_suffixes:
-            suffix = args.provider_suffixes[idx]
+    for idx, f in enumerate(input_files):
+        this_df = pd.read_csv(f, usecols=lambda column: column in REPORT_COLUMNS)
+        if provider_suffixes:
+            suffix = provider_suffixes[idx]
             this_df["Provider"] = this_df["Provider"].astype(str) + f"-{suffix}"
         dfs.append(this_df)
+    return pd.concat(dfs, axis=0)
 
-    df = pd.concat(dfs, axis=0)
+
+def query_results(store, args):
+    """
+    Ingests the input files into the store (unchanged ones are skipped) and adds the `--history` runs, returns the
+    summary rows and the runs they come from
+    """
+    suffixes = args.provider_suffixes or [None] * len(args.input_files or [])
+    run_ids = [
+        store.ingest(f, label=suffix, workload=args.workload) for f, suffix in zip(args.input_files or [], suffixes)
+    ]
+    input_ids = set(run_ids)
+    if args.history:
+        history = store.find_runs(workload=args.workload, since=args.since, last=args.history)
+        run_ids += [run["id"] for run in history if run["id"] not in run_ids]
+    runs = store.runs(run_ids)
+    df = store.load(run_ids, REPORT_COLUMNS)
+    # runs are told apart by their label, historical runs without one by their date
+    suffixes = {run["id"]: run["label"] or (None if run["id"] in input_ids else run["date"]) for run in runs}
+    df["Provider"] = [
+        f"{provider}-{suffixes[run_id]}" if suffixes[run_id] else str(provider)
+        for provider, run_id in zip(df["Provider"], df["Run Id"])
+    ]
+    return df, runs
+
+
+def main(args):
+    store = None
+    if args.results_db:
+        store = ResultsStore(args.results_db)
+        df, runs = query_results(store, args)
+    else:
+        df, runs = read_results(args.input_files, args.provider_suffixes), []
+    series_df = None
+    if args.throughput_series:
+        series_df = pd.concat([pd.read_csv(f) for f in args.throughput_series], axis=0)
 
     # Create the HTML file
     html_output = []
@@ -51,9 +162,6 @@ def main(args):
         html_output.append(f"<h1>{args.extra_header}</h1>")
     # html_output.append("")
 
-    # Get unique prompt token values
-    prompt_tokens = sorted(df["Prompt Tokens"].unique())
-
     line_and_fill_colors = [
         ("blue", "135, 206, 250, 0.4"),
         ("red", "255, 182, 193, 0.4"),
@@ -61,114 +169,108 @@ def main(args):
         ("pink", "255, 192, 203, 0.4"),
         ("green", "144, 238, 144, 0.4"),
     ]
-    # Create plots for each prompt token value
-    for token_value in prompt_tokens:
-        # Filter data for current prompt token value
-        token_df = df[df["Prompt Tokens"] == token_value]
+    # (subplot title, y axis title, function computing the y values from the provider's rows)
+    panels = [
+        (
+            "% incomplete requests/total requests vs. Concurrency",
+            "% incomplete requests/total requests",
+            lambda d: round((d["Incomplete Requests"] / d["Total Requests"]) * 100, 2),
+        ),
+        ("P90 Time to First Token vs. Concurrency", "TTFT (ms)", lambda d: d["P90 Time To First Token"]),
+        ("P90 Time per Output Token vs. Concurrency", "TPOT(ms)", lambda d: d["P90 Latency Per Token"]),
+        ("P90 Total Latency vs. Concurrency", "Total latency(ms)", lambda d: d["P90 Total Latency"]),
+    ]
+    # goodput against the offered load, only for runs with --slo-ttft/--slo-tpot
+    if "Goodput" in df.columns and pd.to_numeric(df["Goodput"], errors="coerce").notna().any():
+        panels.append(
+            (
+                "Goodput (requests meeting all SLOs) vs. Concurrency",
+                "Goodput (req/s)",
+                lambda d: pd.to_numeric(d["Goodput"], errors="coerce"),
+            )
+        )
+    # older result files don't have the chunk level metrics
+    if "P90 Inter Token Latency" in df.columns:
+        panels += [
+            ("P90 Inter Token Latency vs. Concurrency", "ITL (ms)", lambda d: d["P90 Inter Token Latency"]),
+            ("P99 Max Stall per Request vs. Concurrency", "Max stall (ms)", lambda d: d["P99 Max Stall"]),
+            ("Average Tokens per Chunk vs. Concurrency", "Tokens per chunk", lambda d: d["Tokens Per Chunk"]),
+        ]
+
+    # colors follow the order of the inputs, the same provider gets the same color in every section
+    providers = list(df["Provider"].unique())
 
-        # Create figure with two subplots
+    def render_section(token_df):
         fig = make_subplots(
-            rows=4,
+            rows=len(panels),
             cols=1,
-            subplot_titles=(
-                "% incomplete requests/total requests vs. Concurrency",
-                "P90 Time to First Token vs. Concurrency",
-                "P90 Time per Output Token vs. Concurrency",
-                "P90 Total Latency vs. Concurrency",
-            ),
-            vertical_spacing=0.1,
+            subplot_titles=[title for title, _, _ in panels],
+            vertical_spacing=0.4 / len(panels),
         )
 
         # Plot data for each provider
-        # for provider in ["vllm", "adaptive"]:
-        for idx, provider in enumerate(df["Provider"].unique()):
-            provider_df = token_df[token_df["Provider"] == provider]
-
-            # Incomplete requests/total requests
-            ratio = round((provider_df["Incomplete Requests"] / provider_df["Total Requests"]) * 100, 2)
-            fig.add_trace(
-                go.Scatter(
-                    x=provider_df["Concurrency"],
-                    y=ratio,
-                    name=f"{provider}",
-                    fill="tozeroy",
-                    fillcolor=f"rgba({line_and_fill_colors[idx][1]})",
-                    line=dict(color=line_and_fill_colors[idx][0]),
-                    showlegend=True,
-                ),
-                row=1,
-                col=1,
-            )
-
-            # P90 Time to First Token
-            fig.add_trace(
-                go.Scatter(
-                    x=provider_df["Concurrency"],
-                    y=provider_df["P90 Time To First Token"],
-                    name=f"{provider}",
-                    fill="tozeroy",
-                    fillcolor=f"rgba({line_and_fill_colors[idx][1]})",
-                    line=dict(color=line_and_fill_colors[idx][0]),
-                    showlegend=False,
-                ),
-                row=2,
-                col=1,
-            )
-
-            # P90 Latency per Token
-            fig.add_trace(
-                go.Scatter(
-                    x=provider_df["Concurrency"],
-                    y=provider_df["P90 Latency Per Token"],
-                    name=f"{provider}",
-                    fill="tozeroy",
-                    fillcolor=f"rgba({line_and_fill_colors[idx][1]})",
-                    line=dict(color=line_and_fill_colors[idx][0]),
-                    showlegend=False,
-                ),
-                row=3,
-                col=1,
-            )
-
-            # P90 Total Latency
-            fig.add_trace(
-                go.Scatter(
-                    x=provider_df["Concurrency"],
-                    y=provider_df["P90 Total Latency"],
-                    name=f"{provider}",
-                    fill="tozeroy",
-                    fillcolor=f"rgba({line_and_fill_colors[idx][1]})",
-                    line=dict(color=line_and_fill_colors[idx][0]),
-                    showlegend=False,
-                ),
-                row=4,
-                col=1,
-            )
+        for provider, provider_df in token_df.groupby("Provider", sort=False):
+            line_color, fill_color = line_and_fill_colors[providers.index(provider) % len(line_and_fill_colors)]
+            for row, (_, _, values) in enumerate(panels, start=1):
+                fig.add_trace(
+                    go.Scatter(
+                        x=provider_df["Concurrency"],
+                        y=values(provider_df),
+                        name=f"{provider}",
+                        fill="tozeroy",
+                        fillcolor=f"rgba({fill_color})",
+                        line=dict(color=line_color),
+                        showlegend=row == 1,
+                    ),
+                    row=row,
+                    col=1,
+                )
 
         # Update layout
         fig.update_layout(
             # title_text=f"Input Tokens: {int(token_value)}",
-            height=1000,
+            height=250 * len(panels),
             width=1000,
             showlegend=True,
             legend=dict(yanchor="top", y=0.99, xanchor="left", x=0.01),
         )
 
         # Update axes
-        fig.update_xaxes(title_text="Concurrency (QPS)", row=1, col=1)
-        fig.update_xaxes(title_text="Concurrency (QPS)", row=2, col=1)
-        fig.update_xaxes(title_text="Concurrency (QPS)", row=3, col=1)
-        fig.update_xaxes(title_text="Concurrency (QPS)", row=4, col=1)
-        fig.update_yaxes(title_text="% incomplete requests/total requests", row=1, col=1)
-        fig.update_yaxes(title_text="TTFT (ms)", row=2, col=1)
-        fig.update_yaxes(title_text="TPOT(ms)", row=3, col=1)
-        fig.update_yaxes(title_text="Total latency(ms)", row=4, col=1)
-
-        # Add to HTML output
+        for row, (_, y_title, _) in enumerate(panels, start=1):
+            fig.update_xaxes(title_text="Concurrency (QPS)", row=row, col=1)
+            fig.update_yaxes(title_text=y_title, row=row, col=1)
+
+        section = ['<div class="plot-container">', fig.to_html(full_html=False, include_plotlyjs="cdn"), "</div>"]
+
+        # runs of the prefix cache workload (--prefix-hit-ratio), latency against the realized prompt token reuse
+        if "Prompt Token Reuse" in token_df.columns:
+            reuse_df = token_df[pd.to_numeric(token_df["Prompt Token Reuse"], errors="coerce").notna()]
+            if len(reuse_df):
+                section.append('<div class="plot-container">')
+                section.append(prefix_reuse_figure(reuse_df).to_html(full_html=False, include_plotlyjs="cdn"))
+                section.append("</div>")
+        return "\n".join(section)
+
+    # Create plots for each prompt token value, in a single grouped pass over the results
+    run_keys = [(run["id"], run["revision"]) for run in runs]
+    for token_value, token_df in df.groupby("Prompt Tokens"):
         html_output.append(f"<h2>Input Tokens: {int(token_value)}</h2>")
-        html_output.append('<div class="plot-container">')
-        html_output.append(fig.to_html(full_html=False, include_plotlyjs="cdn"))
-        html_output.append("</div>")
+        if store is not None:
+            # reports over the same runs share their sections, e.g. with the previous nightly
+            key = (FRAGMENT_VERSION, run_keys, providers, [title for title, _, _ in panels], token_value)
+            html_output.append(store.fragment(lambda: render_section(token_df), *key))
+        else:
+            html_output.append(render_section(token_df))
+
+    # tokens/s over time written with --throughput-series-file. The prompt length there is the configured one, the
+    # summary may have the one measured by the server instead
+    if series_df is not None:
+        for token_value, token_series_df in series_df.groupby("Prompt Tokens"):
+            html_output.append(f"<h2>Throughput over time, input tokens: {int(token_value)}</h2>")
+            html_output.append('<div class="plot-container">')
+            fig = throughput_series_figure(token_series_df)
+            html_output.append(fig.to_html(full_html=False, include_plotlyjs="cdn"))
+            html_output.append("</div>")
 
     # Close HTML file
     html_output.append("</body></html>")
@@ -177,6 +279,8 @@ def main(args):
     print("Writing HTML")
     with open(args.output_file, "w") as f:
         f.write("\n".join(html_output))
+    if store is not None:
+        store.close()
 
 
 if __name__ == "__main__":
@@ -187,8 +291,8 @@ if __name__ == "__main__":
         "--input-files",  # Name of the argument
         nargs="+",
         type=str,
-        help="Provide 2 results files to plot",
-        required=True,
+        help="Results files to plot",
+        required=False,
     )
     parser.add_argument(
         "--provider-suffixes",  # Name of the argument
@@ -201,9 +305,38 @@ if __name__ == "__main__":
         "--output-file", type=str, required=False, default="results.html", help="Number of output tokens"
     )
     parser.add_argument("--extra-header", type=str, required=False, help="Add an h1 header to top of page")
+    parser.add_argument(
+        "--throughput-series",
+        nargs="+",
+        type=str,
+        required=False,
+        help="Files written with --throughput-series-file to chart tokens/s over time",
+    )
+
+    parser.add_argument(
+        "--results-db",
+        type=str,
+        required=False,
+        help="SQLite results store: the input files are indexed into it (once) and the report reads only the runs and "
+        "columns it needs from it. Sections already rendered for the same runs are reused",
+    )
+    parser.add_argument(
+        "--workload",
+        type=str,
+        required=False,
+        help="Workload (e.g. cache setup) of the input files in the results store, and of the --history runs",
+    )
+    parser.add_argument(
+        "--history",
+        type=int,
+        required=False,
+        help="Also plot the N most recent runs of --workload from the results store",
+    )
+    parser.add_argument("--since", type=str, required=False, help="Only take --history runs from this (ISO) date on")
 
     args = parser.parse_args()
-    assert len(args.input_files) <= 5, "Can only compare 5 result files at a time"
+    assert args.input_files or (args.results_db and args.history), "Pass --input-files or --results-db with --history"
+    assert not args.history or args.results_db, "--history requires --results-db"
     if args.provider_suffixes:
         assert len(args.input_files) == len(
             args.provider_suffixes
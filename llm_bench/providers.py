@@ -0,0 +1,367 @@
+import abc
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class ChunkMetadata:
+    text: str
+    logprob_tokens: Optional[int]
+    usage_tokens: Optional[int]
+    prompt_usage_tokens: Optional[int]
+
+
+class BaseProvider(abc.ABC):
+    DEFAULT_MODEL_NAME = None
+
+    def __init__(self, model, parsed_options):
+        self.model = model
+        self.parsed_options = parsed_options
+
+    @abc.abstractmethod
+    def get_url(self) -> str: ...
+
+    @abc.abstractmethod
+    def format_payload(self, prompt, max_tokens, images, history=None) -> dict:
+        """
+        `history` is the list of previous `(user, assistant)` turns of a chat session
+        """
+
+    @abc.abstractmethod
+    def parse_output_json(self, json, prompt): ...
+
+
+class OpenAIProvider(BaseProvider):
+    def get_url(self) -> str:
+        if self.parsed_options.chat:
+            return "/v1/chat/completions"
+        else:
+            return "/v1/completions"
+
+    def format_payload(self, prompt, max_tokens, images, history=None):
+        data = {
+            "model": self.model,
+            "max_tokens": max_tokens,
+            "stream": self.parsed_options.stream,
+            "temperature": self.parsed_options.temperature,
+            "n": self.parsed_options.n,
+        }
+        if self.parsed_options.chat:
+            data["messages"] = []
+            for user, assistant in history or []:
+                data["messages"].append({"role": "user", "content": user})
+                data["messages"].append({"role": "assistant", "content": assistant})
+            if images is None:
+                data["messages"].append({"role": "user", "content": prompt})
+            else:
+                image_urls = []
+                for image in images:
+                    image_urls.append({"type": "image_url", "image_url": {"url": image}})
+                data["messages"].append(
+                    {
+                        "role": "user",
+                        "content": [{"type": "text", "text": prompt}, *image_urls],
+                    }
+                )
+        else:
+            assert not history, "chat history requires --chat"
+            data["prompt"] = prompt
+            if images is not None:
+                data["images"] = images
+        if self.parsed_options.logprobs is not None:
+            data["logprobs"] = self.parsed_options.logprobs
+        return data
+
+    def parse_output_json(self, data, prompt):
+        usage = data.get("usage", None)
+
+        assert len(data["choices"]) == 1 or len(data["choices"]) == 0, f"Too many choices {len(data['choices'])}"
+
+        if len(data["choices"]) == 1:
+            choice = data["choices"][0]
+            if self.parsed_options.chat:
+                if self.parsed_options.stream:
+                    text = choice["delta"].get("content", "")
+                else:
+                    text = choice["message"]["content"]
+            else:
+                text = choice["text"]
+
+            logprobs = choice.get("logprobs", None)
+        else:
+            text = ""
+            logprobs = None
+
+        return ChunkMetadata(
+            text=text,
+            logprob_tokens=len(logprobs["tokens"]) if logprobs else None,
+            usage_tokens=usage["completion_tokens"] if usage else None,
+            prompt_usage_tokens=usage.get("prompt_tokens", None) if usage else None,
+        )
+
+
+class FireworksProvider(OpenAIProvider):
+    def format_payload(self, prompt, max_tokens, images, history=None):
+        data = super().format_payload(prompt, max_tokens, images, history)
+        data["min_tokens"] = max_tokens
+        data["prompt_cache_max_len"] = self.parsed_options.prompt_cache_max_len
+        return data
+
+
+class VllmProvider(OpenAIProvider):
+    def format_payload(self, prompt, max_tokens, images, history=None):
+        data = super().format_payload(prompt, max_tokens, images, history)
+        data["ignore_eos"] = True
+        return data
+
+
+class AdaptiveProvider(OpenAIProvider):
+
+    def get_url(self):
+        if self.parsed_options.chat:
+            return "/api/v1/chat/completions"
+        else:
+            return "/api/v1/completions"
+
+    def format_payload(self, prompt, max_tokens, images, history=None):
+        data = super().format_payload(prompt, max_tokens, images, history)
+        data["stream_options"] = {"include_usage": True}
+        return data
+
+
+class TogetherProvider(OpenAIProvider):
+    def get_url(self):
+        assert not self.parsed_options.chat, "Chat is not supported"
+        return "/"
+
+    def format_payload(self, prompt, max_tokens, images, history=None):
+        data = super().format_payload(prompt, max_tokens, images, history)
+        data["ignore_eos"] = True
+        data["stream_tokens"] = data.pop("stream")
+        return data
+
+    def parse_output_json(self, data, prompt):
+        if not self.parsed_options.stream:
+            data = data["output"]
+        return super().parse_output_json(data, prompt)
+
+
+class TritonInferProvider(BaseProvider):
+    DEFAULT_MODEL_NAME = "ensemble"
+
+    def get_url(self):
+        assert not self.parsed_options.chat, "Chat is not supported"
+        assert not self.parsed_options.stream, "Stream is not supported"
+        assert self.parsed_options.n == 1, "n > 1 is not supported"
+        return f"/v2/models/{self.model}/infer"
+
+    def format_payload(self, prompt, max_tokens, images, history=None):
+        assert images is None, "images are not supported"
+        assert not history, "chat history is not supported"
+        # matching latest TRT-LLM example, your model configuration might be different
+        data = {
+            "inputs": [
+                {
+                    "name": "text_input",
+                    "datatype": "BYTES",
+                    "shape": [1, 1],
+                    "data": [[prompt]],
+                },
+                {
+                    "name": "max_tokens",
+                    "datatype": "UINT32",
+                    "shape": [1, 1],
+                    "data": [[max_tokens]],
+                },
+                {
+                    "name": "bad_words",
+                    "datatype": "BYTES",
+                    "shape": [1, 1],
+                    "data": [[""]],
+                },
+                {
+                    "name": "stop_words",
+                    "datatype": "BYTES",
+                    "shape": [1, 1],
+                    "data": [[""]],
+                },
+                {
+                    "name": "temperature",
+                    "datatype": "FP32",
+                    "shape": [1, 1],
+                    "data": [[self.parsed_options.temperature]],
+                },
+            ]
+        }
+        assert self.parsed_options.logprobs is None, "logprobs are not supported"
+        return data
+
+    def parse_output_json(self, data, prompt):
+        for output in data["outputs"]:
+            if output["name"] == "text_output":
+                assert output["datatype"] == "BYTES"
+                assert output["shape"] == [1]
+                text = output["data"][0]
+                # Triton returns the original prompt in the output, cut it off
+                text = text.removeprefix("<s> ")
+                if text.startswith(prompt):
+                    # HF tokenizers get confused by the leading space
+                    text = text[len(prompt) :].removeprefix(" ")
+                else:
+                    print("WARNING: prompt not found in the output")
+                return ChunkMetadata(
+                    text=text,
+                    logprob_tokens=None,
+                    usage_tokens=None,
+                    prompt_usage_tokens=None,
+                )
+        raise ValueError("text_output not found in the response")
+
+
+class TritonGenerateProvider(BaseProvider):
+    DEFAULT_MODEL_NAME = "ensemble"
+
+    def get_url(self):
+        assert not self.parsed_options.chat, "Chat is not supported"
+        stream_suffix = "_stream" if self.parsed_options.stream else ""
+        return f"/v2/models/{self.model}/generate{stream_suffix}"
+
+    def format_payload(self, prompt, max_tokens, images, history=None):
+        assert images is None, "images are not supported"
+        assert not history, "chat history is not supported"
+        assert self.parsed_options.n == 1, "n > 1 is not supported"
+        data = {
+            "text_input": prompt,
+            "max_tokens": max_tokens,
+            "stream": self.parsed_options.stream,
+            "temperature": self.parsed_options.temperature,
+            # for whatever reason these has to be provided
+            "bad_words": "",
+            "stop_words": "",
+        }
+        assert self.parsed_options.logprobs is None, "logprobs are not supported"
+        return data
+
+    def parse_output_json(self, data, prompt):
+        text = data["text_output"]
+        if not self.parsed_options.stream:
+            # Triton returns the original prompt in the output, cut it off
+            text = text.removeprefix("<s> ")
+            if text.startswith(prompt):
+                # HF tokenizers get confused by the leading space
+                text = text[len(prompt) :].removeprefix(" ")
+            else:
+                print("WARNING: prompt not found in the output")
+        return ChunkMetadata(
+            text=text,
+            logprob_tokens=None,
+            usage_tokens=None,
+            prompt_usage_tokens=None,
+        )
+
+
+class TgiProvider(BaseProvider):
+    DEFAULT_MODEL_NAME = "<unused>"
+
+    def get_url(self):
+        assert self.parsed_options.n == 1, "n > 1 is not supported"
+        assert not self.parsed_options.chat, "Chat is not supported"
+        stream_suffix = "_stream" if self.parsed_options.stream else ""
+        return f"/generate{stream_suffix}"
+
+    def format_payload(self, prompt, max_tokens, images, history=None):
+        assert images is None, "images are not supported"
+        assert not history, "chat history is not supported"
+        data = {
+            "inputs": prompt,
+            "parameters": {
+                "max_new_tokens": max_tokens,
+                "temperature": self.parsed_options.temperature,
+                "top_n_tokens": self.parsed_options.logprobs,
+                "details": self.parsed_options.logprobs is not None,
+            },
+        }
+        return data
+
+    def parse_output_json(self, data, prompt):
+        if "token" in data:
+            # streaming chunk
+            return ChunkMetadata(
+                text=data["token"]["text"],
+                logprob_tokens=1,
+                usage_tokens=None,
+                prompt_usage_tokens=None,
+            )
+        else:
+            # non-streaming response
+            return ChunkMetadata(
+                text=data["generated_text"],
+                logprob_tokens=(len(data["details"]["tokens"]) if "details" in data else None),
+                usage_tokens=(data["details"]["generated_tokens"] if "details" in data else None),
+                prompt_usage_tokens=None,
+            )
+
+
+PROVIDER_CLASS_MAP = {
+    "fireworks": FireworksProvider,
+    "vllm": VllmProvider,
+    "adaptive": AdaptiveProvider,
+    "sglang": VllmProvider,
+    "openai": OpenAIProvider,
+    "anyscale": OpenAIProvider,
+    "together": TogetherProvider,
+    "triton-infer": TritonInferProvider,
+    "triton-generate": TritonGenerateProvider,
+    "tgi": TgiProvider,
+}
+
+
+def guess_provider_from_host(host):
+    if "fireworks.ai" in host:
+        return "fireworks"
+    elif "together" in host:
+        return "together"
+    elif "openai" in host:
+        return "openai"
+    elif "anyscale" in host:
+        return "anyscale"
+    return None
+
+
+def default_model_name(provider):
+    if provider is None:
+        return None
+    return PROVIDER_CLASS_MAP[provider].DEFAULT_MODEL_NAME
+
+
+def pick_model(models, model, provider):
+    """
+    Resolves model and provider from the `data` list of a /v1/models response
+    """
+    assert len(models) > 0, "No models found in /v1/models"
+    owned_by = None
+    # pick the first model
+    for m in models:
+        if model is None or m["id"] == model:
+            model = m["id"]
+            owned_by = m["owned_by"]
+            break
+    if provider is None:
+        if not owned_by:
+            raise ValueError(f"Model {model} not found in /v1/models. Specify --provider explicitly")
+        if owned_by in PROVIDER_CLASS_MAP:
+            provider = owned_by
+        else:
+            raise ValueError(f"Can't detect provider, specify it explicitly with --provider, owned_by={owned_by}")
+    return model, provider
+
+
+def request_headers(parsed_options):
+    headers = {"Content-Type": "application/json"}
+    if parsed_options.api_key:
+        headers["Authorization"] = "Bearer " + parsed_options.api_key
+    if parsed_options.header:
+        for header in parsed_options.header:
+            key, val = header.split(":", 1)
+            headers[key] = val
+    return headers
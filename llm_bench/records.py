@@ -0,0 +1,186 @@
+import atexit
+import concurrent.futures
+import os
+import time
+
+
+# (name, arrow type name) of the columns, times are epoch seconds
+RECORD_FIELDS = [
+    ("request_id", "string"),
+    ("run_label", "string"),
+    ("provider", "string"),
+    ("model", "string"),
+    ("concurrency", "string"),
+    ("turn", "int32"),
+    ("status", "string"),
+    ("error", "string"),
+    ("measured", "bool"),
+    ("scheduled_time", "float64"),
+    ("sent_time", "float64"),
+    ("first_token_time", "float64"),
+    ("last_token_time", "float64"),
+    ("prompt_tokens", "int64"),
+    ("output_tokens", "int64"),
+    ("max_tokens", "int64"),
+    ("num_chunks", "int32"),
+    ("max_stall_ms", "float64"),
+    ("server_ttft_ms", "float64"),
+    ("server_total_latency_ms", "float64"),
+    ("new_connection", "bool"),
+    ("connect_ms", "float64"),
+    ("headers_time", "float64"),
+]
+FIELD_NAMES = [name for name, _ in RECORD_FIELDS]
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow as pa
+    except ImportError as e:
+        raise ImportError("Per request records require pyarrow, install it with `pip install pyarrow`") from e
+    return pa
+
+
+def _open_writer(path):
+    pa = _import_pyarrow()
+    schema = pa.schema([(name, pa.type_for_alias(type_name)) for name, type_name in RECORD_FIELDS])
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        return schema, pq.ParquetWriter(path, schema)
+    return schema, pa.ipc.new_file(path, schema)
+
+
+def _report_failure(future):
+    if future.exception() is not None:
+        print(f"WARNING: failed to write per request records: {repr(future.exception())}", flush=True)
+
+
+def _write_batch(writer, schema, rows):
+    import pyarrow as pa
+
+    columns = list(zip(*rows))
+    batch = pa.RecordBatch.from_arrays([pa.array(c, type=t) for c, t in zip(columns, schema.types)], schema=schema)
+    writer.write_batch(batch)
+
+
+class RecordSink:
+    """
+    Streams one record per request to a columnar file: Parquet if the path ends with `.parquet`, Arrow IPC otherwise.
+
+    `add` only appends a tuple to a buffer. Full buffers (or ones older than `flush_interval` when the next record
+    comes) are converted and written by `submit`, which runs them on a single pool thread in order (gevent's
+    `ThreadPoolExecutor.submit` under Locust, a `concurrent.futures` one otherwise), so the event loop never waits
+    for the disk
+    """
+
+    def __init__(self, path, submit=None, batch_size=4096, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        if submit is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(1)
+            submit = self.executor.submit
+        else:
+            self.executor = None
+        self.submit = submit
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.schema, self.writer = _open_writer(path)
+        self.rows = []
+        self.last_flush = time.monotonic()
+        self.closed = False
+
+    def add(self, record):
+        """
+        `record` maps the names of `RECORD_FIELDS` to values, missing ones are null
+        """
+        self.rows.append(tuple(record.get(name) for name in FIELD_NAMES))
+        if len(self.rows) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.rows:
+            return
+        rows, self.rows = self.rows, []
+        self.submit(_write_batch, self.writer, self.schema, rows).add_done_callback(_report_failure)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        # the pool runs tasks in order, the writer is closed after the last batch
+        self.submit(self.writer.close).result()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def request_record(
+    request_id, t_start, max_tokens, schedule_lag=None, acc=None, t_end=None, error=None, phases=None, **fields
+):
+    """
+    Record of a request from its `perf_counter` timestamps, `ResponseAccumulator` (None if it failed before the
+    response) and connection phases (see `ResponseAccumulator.metrics`), `fields` are the other columns
+    """
+    clock_offset = time.time() - time.perf_counter()
+    sent_time = t_start + clock_offset
+    record = {
+        "request_id": request_id,
+        "status": "ok" if error is None else "error",
+        "error": repr(error) if error is not None else None,
+        "scheduled_time": sent_time - schedule_lag if schedule_lag is not None else None,
+        "sent_time": sent_time,
+        "max_tokens": max_tokens,
+        **fields,
+    }
+    if acc is not None:
+        if acc.t_first_token is not None:
+            record["first_token_time"] = acc.t_first_token + clock_offset
+        if t_end is not None:
+            record["last_token_time"] = t_end + clock_offset
+        record["num_chunks"] = len(acc.chunk_times)
+        if acc.stream and len(acc.chunk_times) > 1:
+            record["max_stall_ms"] = acc.max_stall * 1000
+        if acc.server_ttft is not None:
+            record["server_ttft_ms"] = acc.server_ttft * 1000
+        if acc.server_total is not None:
+            record["server_total_latency_ms"] = acc.server_total * 1000
+    if phases:
+        record["new_connection"] = phases.get("connect_start") is not None
+        if phases.get("connect_end") is not None and phases.get("connect_start") is not None:
+            record["connect_ms"] = (phases["connect_end"] - phases["connect_start"]) * 1000
+        if phases.get("headers") is not None:
+            record["headers_time"] = phases["headers"] + clock_offset
+    return record
+
+
+def read_records(path):
+    """
+    Reads a file written by `RecordSink` into a DataFrame
+    """
+    pa = _import_pyarrow()
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path)
+    else:
+        table = pa.ipc.open_file(path).read_all()
+    return table.to_pandas()
+
+
+# path -> sink, so that the runs of a sweep append to the same file
+_sinks = {}
+
+
+def open_sink(path, submit=None):
+    if path not in _sinks:
+        _sinks[path] = RecordSink(path, submit)
+    return _sinks[path]
+
+
+@atexit.register
+def close_sinks():
+    for sink in _sinks.values():
+        sink.close()
+    _sinks.clear()
@@ -0,0 +1,314 @@
+import math
+from array import array
+
+import orjson
+
+
+# server side timings sent as extra events by Adaptive
+TELEMETRY_PREFIXES = (b'{"TTFT":', b'{"TotalRequestDuration":')
+# timestamps of chunks beyond this are not kept, so that a runaway response can't eat memory
+MAX_TRACKED_CHUNKS = 16384
+
+
+def parse_duration(value):
+    """
+    Seconds of a serialized Rust `Duration` (`{"secs": 1, "nanos": 500}`) or of a plain number of seconds
+    """
+    if isinstance(value, dict):
+        return value["secs"] + value.get("nanos", 0) / 1e9
+    return float(value)
+
+
+def _phase_metrics(t_start, phases):
+    # where the time before the response goes, connection churn shows up as new connections and their connect time
+    result = {}
+    connect_start, connect_end = phases.get("connect_start"), phases.get("connect_end")
+    result["new_connection"] = (1 if connect_start is not None else 0, 0)
+    if connect_start is not None and connect_end is not None:
+        result["connect_time"] = ((connect_end - connect_start) * 1000, 0)
+        if phases.get("tls_start") is not None:
+            result["tls_time"] = ((connect_end - phases["tls_start"]) * 1000, 0)
+    if phases.get("queued_end") is not None:
+        result["connection_wait"] = ((phases["queued_end"] - phases["queued_start"]) * 1000, 0)
+    elif phases.get("pool_limit"):
+        result["connection_wait"] = (0.0, 0)
+    if phases.get("request_sent") is not None:
+        result["request_sent_time"] = ((phases["request_sent"] - t_start) * 1000, 0)
+    if phases.get("headers") is not None:
+        result["time_to_headers"] = ((phases["headers"] - t_start) * 1000, 0)
+    return result
+
+
+class ResponseAccumulator:
+    """
+    Accumulates the chunks of a single (possibly streamed) response and turns them into per-request metrics.
+    It doesn't do any IO so both the Locust and the asyncio engines can drive it
+    """
+
+    def __init__(
+        self,
+        provider_formatter,
+        prompt,
+        stream,
+        prompt_tokenizer_tokens,
+        collect_text=True,
+        reused_prefix_tokens=None,
+        turn=None,
+        verbose=True,
+    ):
+        self.provider_formatter = provider_formatter
+        self.prompt = prompt
+        self.stream = stream
+        self.prompt_tokenizer_tokens = prompt_tokenizer_tokens
+        self.reused_prefix_tokens = reused_prefix_tokens
+        # index of the turn in a chat session
+        self.turn = turn
+        # whether to print a line per request
+        self.verbose = verbose
+        # the text is only kept if something reads it (tokenizer, --show-response), otherwise only its length is
+        self.texts = [] if collect_text else None
+        self.num_chars = 0
+        self.done = False
+        self.prompt_usage_tokens = prompt_tokenizer_tokens
+        self.total_usage_tokens = None
+        self.total_logprob_tokens = None
+        self.t_first_token = None
+        # first event of the body, whether or not it carries text
+        self.t_first_byte = None
+        # arrival time of every chunk carrying text and the number of tokens in it if the provider exposes it
+        self.chunk_times = array("d")
+        self.chunk_tokens = array("I")
+        self.last_chunk_time = None
+        self.max_stall = 0.0
+        # as reported by the server in telemetry events, in seconds
+        self.server_ttft = None
+        self.server_total = None
+
+    @property
+    def combined_text(self):
+        return "".join(self.texts) if self.texts is not None else ""
+
+    def add_chunk(self, data, now):
+        """
+        Processes the payload (bytes) of one event. Returns True if it's the first chunk carrying text
+        """
+        if self.t_first_byte is None:
+            self.t_first_byte = now
+        if self.stream and len(data) < 16 and data.strip() == b"[DONE]":
+            self.done = True
+            return False
+        if data.startswith(TELEMETRY_PREFIXES):
+            self._add_telemetry(data)
+            return False
+        if self.done:
+            print(f"WARNING: Received more chunks after [DONE]: {data!r}")
+
+        out = self.provider_formatter.parse_output_json(orjson.loads(data), self.prompt)
+        if out.usage_tokens:
+            self.total_usage_tokens = (self.total_usage_tokens or 0) + out.usage_tokens
+        if out.prompt_usage_tokens:
+            self.prompt_usage_tokens = out.prompt_usage_tokens
+        if out.logprob_tokens:
+            self.total_logprob_tokens = (self.total_logprob_tokens or 0) + out.logprob_tokens
+        if not out.text:
+            # some providers (SGLang) send an empty chunk first skewing the TTFT
+            return False
+        self.num_chars += len(out.text)
+        if self.texts is not None:
+            self.texts.append(out.text)
+        self._add_chunk_time(now, out.logprob_tokens)
+
+        if self.t_first_token is None:
+            self.t_first_token = now
+            return True
+        return False
+
+    def _add_telemetry(self, data):
+        # telemetry isn't part of the response, a malformed event doesn't fail the request
+        try:
+            frame = orjson.loads(data)
+            if "TTFT" in frame:
+                self.server_ttft = parse_duration(frame["TTFT"])
+            if "TotalRequestDuration" in frame:
+                self.server_total = parse_duration(frame["TotalRequestDuration"])
+        except (ValueError, TypeError, KeyError) as e:
+            if self.verbose:
+                print(f"WARNING: Failed to parse telemetry: {data!r} with error {repr(e)}")
+
+    def _add_chunk_time(self, now, num_tokens):
+        if len(self.chunk_times) < MAX_TRACKED_CHUNKS:
+            self.chunk_times.append(now)
+            if self.chunk_tokens is not None:
+                if num_tokens:
+                    self.chunk_tokens.append(num_tokens)
+                else:
+                    # per chunk token counts are only useful if all chunks have them
+                    self.chunk_tokens = None
+        if self.last_chunk_time is not None:
+            self.max_stall = max(self.max_stall, now - self.last_chunk_time)
+        self.last_chunk_time = now
+
+    def count_tokens(self, provider, num_tokenizer_tokens=None):
+        """
+        `num_tokenizer_tokens` is the length of the text encoded by the local tokenizer, if there is one
+        """
+        if (
+            (self.total_logprob_tokens is not None)
+            and (self.total_usage_tokens is not None)
+            and self.total_logprob_tokens != self.total_usage_tokens
+        ):
+            print(f"WARNING: usage_tokens {self.total_usage_tokens} != logprob_tokens {self.total_logprob_tokens}")
+        if self.total_logprob_tokens is not None:
+            num_tokens = self.total_logprob_tokens
+        else:
+            num_tokens = self.total_usage_tokens
+        if num_tokenizer_tokens is not None:
+            if num_tokens is None:
+                num_tokens = num_tokenizer_tokens
+            elif num_tokens != num_tokenizer_tokens:
+                print(f"WARNING: tokenizer token count {num_tokenizer_tokens} != {num_tokens} received from server")
+                if provider == "adaptive":
+                    num_tokens = num_tokenizer_tokens
+        return num_tokens or 0
+
+    def count_prompt_tokens(self, provider):
+        if (
+            self.prompt_usage_tokens is not None
+            and self.prompt_tokenizer_tokens is not None
+            and self.prompt_usage_tokens != self.prompt_tokenizer_tokens
+        ):
+            print(
+                f"WARNING: prompt usage tokens {self.prompt_usage_tokens} != {self.prompt_tokenizer_tokens} derived from local tokenizer"
+            )
+        prompt_tokens = self.prompt_usage_tokens or self.prompt_tokenizer_tokens
+        if provider == "adaptive":
+            prompt_tokens = self.prompt_tokenizer_tokens
+        return prompt_tokens
+
+    def metrics(self, t_start, now, num_tokens, max_tokens, prompt_tokens, schedule_lag=None, phases=None):
+        """
+        Returns `{metric_name: (value, length)}` in the units reported in the summary (ms).
+        `schedule_lag` is how late (in seconds) the request was sent compared to the fixed QPS schedule. `phases` are
+        the `perf_counter` times recorded by the connection pool of the engine: `queued_start`/`queued_end` (waited
+        for a free connection), `connect_start`, `tls_start`, `connect_end` (opened a connection), `request_sent` and
+        `headers`, and `pool_limit` set if requests may wait for a connection
+        """
+        num_chars = self.num_chars
+        dur_total = now - t_start
+        dur_generation = now - self.t_first_token
+        dur_first_token = self.t_first_token - t_start
+        if self.verbose:
+            print(
+                f"Response received: total {dur_total*1000:.2f} ms, first token {dur_first_token*1000:.2f} ms, {num_chars} chars, {num_tokens} tokens"
+            )
+        result = {}
+        if num_chars:
+            result["latency_per_char"] = (dur_generation / num_chars * 1000, num_chars)
+        if self.stream:
+            result["time_to_first_token"] = (dur_first_token * 1000, 0)
+        result["total_latency"] = (dur_total * 1000, 0)
+        if num_tokens:
+            if num_tokens != max_tokens and self.verbose:
+                print(f"WARNING: wrong number of tokens: {num_tokens}, expected {max_tokens}")
+            result["num_tokens"] = (num_tokens, 0)
+            result["latency_per_token"] = (dur_generation / num_tokens * 1000, num_tokens)
+            result["overall_latency_per_token"] = (dur_total / num_tokens * 1000, num_tokens)
+        if prompt_tokens:
+            result["prompt_tokens"] = (prompt_tokens, 0)
+        if self.turn is not None:
+            if self.stream:
+                result[f"time_to_first_token_turn_{self.turn + 1}"] = (dur_first_token * 1000, 0)
+            if prompt_tokens:
+                result[f"prompt_tokens_turn_{self.turn + 1}"] = (prompt_tokens, 0)
+        if self.reused_prefix_tokens is not None:
+            # prefix sharing as generated by the client, whether the server cache hits depends on its eviction
+            result["prefix_reuse"] = (1 if self.reused_prefix_tokens else 0, 0)
+            if prompt_tokens:
+                result["prompt_token_reuse"] = (min(1.0, self.reused_prefix_tokens / prompt_tokens), 0)
+        if self.stream and len(self.chunk_times) > 1:
+            result["max_stall"] = (self.max_stall * 1000, 0)
+        # the gap between what the client sees and what the server reports is network, queueing in front of the
+        # server and proxies
+        if self.server_ttft is not None:
+            result["server_time_to_first_token"] = (self.server_ttft * 1000, 0)
+            if self.stream:
+                result["time_to_first_token_gap"] = ((dur_first_token - self.server_ttft) * 1000, 0)
+        if self.server_total is not None:
+            result["server_total_latency"] = (self.server_total * 1000, 0)
+            result["total_latency_gap"] = ((dur_total - self.server_total) * 1000, 0)
+        if phases is not None:
+            result.update(_phase_metrics(t_start, phases))
+        if self.stream and self.t_first_byte is not None:
+            result["time_to_first_byte"] = ((self.t_first_byte - t_start) * 1000, 0)
+        if schedule_lag is not None:
+            # latency as seen by a client that wanted to send the request on schedule (no coordinated omission)
+            result["schedule_lag"] = (schedule_lag * 1000, 0)
+            if self.stream:
+                result["corrected_time_to_first_token"] = ((dur_first_token + schedule_lag) * 1000, 0)
+            result["corrected_total_latency"] = ((dur_total + schedule_lag) * 1000, 0)
+        return result
+
+    def throughput_samples(self, num_tokens, prompt_tokens):
+        """
+        Returns `{series_name: [(time, tokens), ...]}` with the times (`perf_counter`) at which tokens were delivered:
+        the prompt is processed once the first token arrives, output tokens arrive with their chunks
+        """
+        result = {}
+        if prompt_tokens:
+            result["prompt_tokens_per_second"] = [(self.t_first_token, prompt_tokens)]
+        times = self.chunk_times
+        if num_tokens and len(times):
+            if self.chunk_tokens is not None and len(self.chunk_tokens) == len(times):
+                tokens = list(self.chunk_tokens)
+            else:
+                tokens = [num_tokens / len(times)] * len(times)
+            # tokens of chunks past MAX_TRACKED_CHUNKS or missing from per chunk counts go with the last chunk
+            tokens[-1] += max(0, num_tokens - sum(tokens))
+            result["output_tokens_per_second"] = list(zip(times, tokens))
+        return result
+
+    def chunk_samples(self, num_tokens):
+        """
+        Returns `{metric_name: [(value, count), ...]}` with the per chunk distributions. Inter-token latency of a chunk
+        is the gap since the previous chunk spread over the tokens it carries. If the provider doesn't report tokens
+        per chunk, the average over the response is used
+        """
+        times = self.chunk_times
+        if not self.stream or len(times) < 2:
+            return {}
+        if self.chunk_tokens is not None and len(self.chunk_tokens) == len(times):
+            tokens = self.chunk_tokens
+        elif num_tokens:
+            tokens = [num_tokens / len(times)] * len(times)
+        else:
+            return {}
+        inter_token_latency = [
+            ((times[i] - times[i - 1]) * 1000 / tokens[i], max(1, round(tokens[i]))) for i in range(1, len(times))
+        ]
+        return {
+            "inter_token_latency": inter_token_latency,
+            "tokens_per_chunk": [(k, 1) for k in tokens],
+        }
+
+
+def evaluate_slo(metrics, slo_ttft, slo_tpot):
+    """
+    Adds whether the request met each SLO (ms, None if not set) and all of them at once to the output of
+    `ResponseAccumulator.metrics`, with the tokens it contributes to goodput
+    """
+    if slo_ttft is None and slo_tpot is None:
+        return
+    met = True
+    if slo_ttft is not None:
+        # without streaming the user sees the first token with the whole response
+        ttft, _ = metrics.get("time_to_first_token", metrics["total_latency"])
+        metrics["ttft_slo_met"] = (int(ttft <= slo_ttft), 0)
+        met = met and ttft <= slo_ttft
+    if slo_tpot is not None:
+        # unknown if the token count is unknown, such requests don't count as good
+        tpot, _ = metrics.get("latency_per_token", (math.inf, 0))
+        metrics["tpot_slo_met"] = (int(tpot <= slo_tpot), 0)
+        met = met and tpot <= slo_tpot
+    metrics["slo_met"] = (int(met), 0)
+    num_tokens, _ = metrics.get("num_tokens", (0, 0))
+    metrics["good_tokens"] = (num_tokens if met else 0, 0)
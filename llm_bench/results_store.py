@@ -0,0 +1,183 @@
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+
+import pandas as pd
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL UNIQUE,
+    date TEXT NOT NULL,
+    provider TEXT,
+    model TEXT,
+    label TEXT,
+    workload TEXT,
+    source_mtime REAL,
+    source_size INTEGER,
+    revision INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS runs_by_provider ON runs (provider, label, date);
+CREATE INDEX IF NOT EXISTS runs_by_workload ON runs (workload, date);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    value,
+    PRIMARY KEY (run_id, name, row)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS fragments (
+    key TEXT PRIMARY KEY,
+    html TEXT NOT NULL
+);
+"""
+RUN_COLUMNS = ["id", "source", "date", "provider", "model", "label", "workload", "revision"]
+
+
+class ResultsStore:
+    """
+    SQLite index of summary CSV files, so that reports over many (nightly) runs query only the runs and columns they
+    plot instead of reading every file.
+
+    A run is one summary file, identified by its path, with its metadata (date, provider, model, label such as the
+    version, workload such as the cache setup). Summary rows are kept in long format (run, column, row, value): files
+    written by different versions of the benchmark have different columns and still mix. `revision` changes whenever
+    a run is re-ingested or relabelled, rendered report sections cached with `fragment` are keyed by it
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def ingest(self, csv_path, label=None, workload=None, date=None):
+        """
+        Adds a summary file and returns its run id. Unchanged files (same size and modification time) aren't read
+        again, only the given metadata is updated. `date` defaults to the modification time of the file
+        """
+        source = os.path.abspath(csv_path)
+        stat = os.stat(source)
+        existing = self.db.execute(
+            "SELECT id, source_mtime, source_size, label, workload, date FROM runs WHERE source = ?", (source,)
+        ).fetchone()
+        if existing is not None:
+            run_id, mtime, size, *metadata = existing
+            new_metadata = [new if new is not None else old for new, old in zip((label, workload, date), metadata)]
+            if (mtime, size) == (stat.st_mtime, stat.st_size):
+                if new_metadata != metadata:
+                    with self.db:
+                        self.db.execute(
+                            "UPDATE runs SET label = ?, workload = ?, date = ?, revision = revision + 1 WHERE id = ?",
+                            (*new_metadata, run_id),
+                        )
+                return run_id
+            label, workload, date = new_metadata
+
+        df = pd.read_csv(source)
+        df = df.astype(object).where(df.notna(), None)
+        if date is None:
+            date = datetime.datetime.fromtimestamp(stat.st_mtime).isoformat(timespec="seconds")
+        provider = ",".join(str(p) for p in df["Provider"].unique()) if "Provider" in df.columns else None
+        model = ",".join(str(m) for m in df["Model"].unique()) if "Model" in df.columns else None
+        with self.db:
+            if existing is None:
+                run_id = self.db.execute(
+                    "INSERT INTO runs (source, date, provider, model, label, workload, source_mtime, source_size)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (source, date, provider, model, label, workload, stat.st_mtime, stat.st_size),
+                ).lastrowid
+            else:
+                self.db.execute("DELETE FROM results WHERE run_id = ?", (run_id,))
+                self.db.execute(
+                    "UPDATE runs SET date = ?, provider = ?, model = ?, label = ?, workload = ?, source_mtime = ?,"
+                    " source_size = ?, revision = revision + 1 WHERE id = ?",
+                    (date, provider, model, label, workload, stat.st_mtime, stat.st_size, run_id),
+                )
+            self.db.executemany(
+                "INSERT INTO results (run_id, name, row, value) VALUES (?, ?, ?, ?)",
+                (
+                    (run_id, name, row, value)
+                    for name in df.columns
+                    for row, value in enumerate(df[name].tolist())
+                    if value is not None
+                ),
+            )
+        return run_id
+
+    def find_runs(self, provider=None, label=None, workload=None, since=None, until=None, last=None):
+        """
+        Runs matching all the given filters, oldest first. `since`/`until` are ISO dates or prefixes of them, both
+        inclusive (`until="2025-03-01"` keeps the runs of that day), `last` keeps only the most recent ones
+        """
+        if until is not None:
+            # stored dates are full timestamps which sort after their prefix
+            until += "\uffff"
+        conditions, params = [], []
+        for column, op, value in (
+            ("provider", "=", provider),
+            ("label", "=", label),
+            ("workload", "=", workload),
+            ("date", ">=", since),
+            ("date", "<=", until),
+        ):
+            if value is not None:
+                conditions.append(f"{column} {op} ?")
+                params.append(value)
+        query = f"SELECT {', '.join(RUN_COLUMNS)} FROM runs"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY date DESC, id DESC"
+        if last is not None:
+            query += " LIMIT ?"
+            params.append(last)
+        runs = [dict(zip(RUN_COLUMNS, row)) for row in self.db.execute(query, params)]
+        return runs[::-1]
+
+    def runs(self, run_ids):
+        if not run_ids:
+            return []
+        placeholders = ", ".join("?" * len(run_ids))
+        rows = self.db.execute(f"SELECT {', '.join(RUN_COLUMNS)} FROM runs WHERE id IN ({placeholders})", run_ids)
+        by_id = {row[0]: dict(zip(RUN_COLUMNS, row)) for row in rows}
+        return [by_id[run_id] for run_id in run_ids if run_id in by_id]
+
+    def load(self, run_ids, columns=None):
+        """
+        Summary rows of the runs as a DataFrame with a `Run Id` column, in the order of `run_ids`. Only `columns` are
+        read if given, the ones no run has are missing from the result
+        """
+        if not run_ids:
+            return pd.DataFrame(columns=["Run Id"])
+        placeholders = ", ".join("?" * len(run_ids))
+        query = f"SELECT run_id, row, name, value FROM results WHERE run_id IN ({placeholders})"
+        params = list(run_ids)
+        if columns is not None:
+            query += f" AND name IN ({', '.join('?' * len(columns))})"
+            params += list(columns)
+        # pivot back to one dict per summary row in a single pass
+        records = {}
+        for run_id, row, name, value in self.db.execute(query, params):
+            records.setdefault((run_id, row), {"Run Id": run_id})[name] = value
+        order = {run_id: i for i, run_id in enumerate(run_ids)}
+        keys = sorted(records, key=lambda key: (order[key[0]], key[1]))
+        return pd.DataFrame([records[key] for key in keys])
+
+    def fragment(self, render, *key):
+        """
+        Returns the HTML rendered by `render()` for `key`, from the cache if it was rendered before. The key has to
+        identify the content, e.g. include the ids and revisions of the runs it shows
+        """
+        digest = hashlib.sha1(json.dumps(key, default=str).encode()).hexdigest()
+        row = self.db.execute("SELECT html FROM fragments WHERE key = ?", (digest,)).fetchone()
+        if row is not None:
+            return row[0]
+        html = render()
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO fragments (key, html) VALUES (?, ?)", (digest, html))
+        return html
@@ -0,0 +1,180 @@
+import functools
+import itertools
+import threading
+import time
+
+import numpy as np
+
+
+class ArrivalSchedule:
+    """
+    Arrival times in seconds relative to the start of the test.
+
+    Synthetic schedules are generated with numpy from a seeded generator, so runs are reproducible. They cover
+    `duration` upfront and get extended block by block if the test runs longer than that
+    """
+
+    BLOCK_SECONDS = 60
+
+    def __init__(self, offsets, qps, distribution=None, rng=None):
+        self.offsets = offsets
+        self.qps = qps
+        self.distribution = distribution
+        self.rng = rng
+        self.lock = threading.Lock()
+
+    @classmethod
+    def synthetic(cls, qps, distribution, seed=None, duration=None):
+        schedule = cls(np.empty(0), qps, distribution, np.random.default_rng(seed))
+        schedule._extend(duration or cls.BLOCK_SECONDS)
+        return schedule
+
+    @classmethod
+    def from_trace(cls, path, speedup=1.0):
+        timestamps = load_trace(path)
+        offsets = (timestamps - timestamps[0]) / speedup
+        span = offsets[-1] if len(offsets) > 1 and offsets[-1] > 0 else 1.0
+        return cls(offsets, round(len(offsets) / span, 3))
+
+    def _waits(self, n):
+        mean_wait = 1 / self.qps
+        if self.distribution == "exponential":
+            return self.rng.exponential(mean_wait, n)
+        elif self.distribution == "uniform":
+            return self.rng.uniform(0, 2 * mean_wait, n)
+        elif self.distribution == "constant":
+            return np.full(n, mean_wait)
+        else:
+            raise ValueError(f"Unknown distribution {self.distribution}")
+
+    def _extend(self, seconds):
+        offsets = self.offsets
+        end = (offsets[-1] if len(offsets) else 0.0) + seconds
+        n = max(16, int(seconds * self.qps * 1.1) + 1)
+        while len(offsets) == len(self.offsets) or offsets[-1] < end:
+            last = offsets[-1] if len(offsets) else 0.0
+            offsets = np.concatenate([offsets, last + np.cumsum(self._waits(n))])
+        # readers access the array without the lock, so it's replaced and never modified in place
+        self.offsets = offsets
+
+    def get(self, slot):
+        """
+        Returns the offset of the slot or None if the trace is exhausted
+        """
+        offsets = self.offsets
+        if slot < len(offsets):
+            return float(offsets[slot])
+        if self.rng is None:
+            return None
+        with self.lock:
+            while slot >= len(self.offsets):
+                self._extend(self.BLOCK_SECONDS)
+            return float(self.offsets[slot])
+
+
+@functools.lru_cache(maxsize=None)
+def load_trace(path):
+    """
+    Reads arrival timestamps in seconds from the first column of a text/CSV file (a header is allowed) or a .npy array
+    """
+    if path.endswith(".npy"):
+        timestamps = np.load(path).astype(float).ravel()
+    else:
+        timestamps = np.genfromtxt(path, delimiter=",", usecols=0, ndmin=1)
+        timestamps = timestamps[~np.isnan(timestamps)]
+    if len(timestamps) == 0:
+        raise ValueError(f"No timestamps found in {path}")
+    return np.sort(timestamps)
+
+
+def apply_trace_qps(parsed_options):
+    """
+    Derives --qps from --qps-trace if it's not set explicitly, so that fixed QPS mode kicks in and the summary has it
+    """
+    if parsed_options.qps_trace and parsed_options.qps is None:
+        parsed_options.qps = ArrivalSchedule.from_trace(
+            parsed_options.qps_trace, parsed_options.qps_trace_speedup
+        ).qps
+
+
+class FixedQPSPacer:
+    _instance = None
+    _lock = threading.Lock()
+    # set in distributed mode, so that workers split one global arrival schedule between them
+    _partition = None
+    WARNING_INTERVAL = 1.0
+
+    def __init__(self, schedule, index=0, count=1, start_time=None):
+        self.schedule = schedule
+        self.qps = schedule.qps
+        self.distribution = schedule.distribution
+        self.start_time = time.time() if start_time is None else start_time
+        # every `count`-th slot of the global schedule belongs to this process.
+        # next() on itertools.count is atomic, so users claim slots without taking a lock
+        self.slots = itertools.count(index, count)
+        self.late_requests = 0
+        self.max_delay = 0.0
+        self.last_warning = time.time()
+
+    @classmethod
+    def from_options(cls, parsed_options, index=0, count=1, start_time=None, seed=None):
+        if parsed_options.qps_trace:
+            schedule = ArrivalSchedule.from_trace(parsed_options.qps_trace, parsed_options.qps_trace_speedup)
+        else:
+            schedule = ArrivalSchedule.synthetic(
+                parsed_options.qps,
+                parsed_options.qps_distribution,
+                parsed_options.seed if seed is None else seed,
+                getattr(parsed_options, "run_time", None),
+            )
+        return cls(schedule, index, count, start_time)
+
+    @classmethod
+    def instance(cls, parsed_options):
+        """
+        The pacer shared by all Locust users of the process
+        """
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls.from_options(parsed_options, **(cls._partition or {}))
+            elif not parsed_options.qps_trace:
+                assert cls._instance.qps == parsed_options.qps
+                assert cls._instance.distribution == parsed_options.qps_distribution
+            return cls._instance
+
+    @classmethod
+    def set_partition(cls, index, count, start_time, seed):
+        """
+        Makes this process generate only slots `index, index + count, ...` of the schedule starting at `start_time`
+        """
+        with cls._lock:
+            cls._partition = {"index": index, "count": count, "start_time": start_time, "seed": seed}
+            cls._instance = None
+
+    def next_arrival(self):
+        """
+        Claims the next slot and returns its absolute time or None if the trace is exhausted
+        """
+        offset = self.schedule.get(next(self.slots))
+        if offset is None:
+            return None
+        return self.start_time + offset
+
+    def wait_time_till(self, t):
+        now = time.time()
+        if now > t:
+            self._report_delay(now, now - t)
+            return 0
+        return t - now
+
+    def _report_delay(self, now, delay):
+        # aggregate the warnings, printing one for every late request slows down the load generator even more
+        self.late_requests += 1
+        self.max_delay = max(self.max_delay, delay)
+        if now - self.last_warning >= self.WARNING_INTERVAL:
+            print(
+                f"WARNING: {self.late_requests} requests sent late in the last {now - self.last_warning:.1f}s, max delay {self.max_delay:.3f}s. Either the number of users is too low or the load generator or the server is overloaded"
+            )
+            self.late_requests = 0
+            self.max_delay = 0.0
+            self.last_warning = now
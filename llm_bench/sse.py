@@ -0,0 +1,53 @@
+class SSEParser:
+    """
+    Incremental parser of a server-sent events stream working directly on the received bytes.
+
+    Line boundaries are found with `bytes.find` (memchr), nothing is decoded: the data of every event is returned as
+    a bytes slice that can be passed to `orjson.loads` as is. Only `data:` fields are kept, other fields and comments
+    are skipped
+    """
+
+    def __init__(self):
+        self.pending = b""
+        self.data_lines = []
+
+    def feed(self, chunk):
+        """
+        Returns the data of the events completed by `chunk`
+        """
+        buf = self.pending + chunk if self.pending else chunk
+        events = []
+        pos = 0
+        while True:
+            end = buf.find(b"\n", pos)
+            if end == -1:
+                break
+            line_end = end - 1 if end > pos and buf[end - 1] == 13 else end  # \r\n line endings
+            if line_end == pos:
+                # blank line dispatches the event
+                if self.data_lines:
+                    events.append(self.data_lines[0] if len(self.data_lines) == 1 else b"\n".join(self.data_lines))
+                    self.data_lines = []
+            elif buf.startswith(b"data:", pos):
+                start = pos + 5
+                if start < line_end and buf[start] == 32:  # single leading space is not part of the data
+                    start += 1
+                self.data_lines.append(buf[start:line_end])
+            pos = end + 1
+        self.pending = buf[pos:]
+        return events
+
+    def close(self):
+        """
+        Returns the data of the last event if the stream ended without a blank line
+        """
+        events = self.feed(b"\n\n") if self.pending or self.data_lines else []
+        self.pending = b""
+        return events
+
+
+def iter_sse_data(byte_chunks):
+    parser = SSEParser()
+    for chunk in byte_chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
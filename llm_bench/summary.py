@@ -0,0 +1,209 @@
+import copy
+import csv
+import math
+import statistics
+
+from convergence import confidence_interval
+
+
+AVERAGE_METRICS = [
+    "time_to_first_token",
+    "latency_per_token",
+    "num_tokens",
+    "total_latency",
+    "prompt_tokens",  # might overwrite the static value based on server side tokenization
+]
+PERCENTILES_TO_REPORT = [50, 90, 99, 99.9]
+PERCENTILE_METRICS = ["time_to_first_token", "total_latency", "latency_per_token"]
+# only recorded in fixed QPS mode, measured from the scheduled send time rather than the actual one
+CORRECTED_PERCENTILE_METRICS = ["corrected_time_to_first_token", "corrected_total_latency", "schedule_lag"]
+# computed from the arrival times of individual chunks, only meaningful when streaming
+CHUNK_PERCENTILE_METRICS = ["inter_token_latency", "max_stall", "tokens_per_chunk"]
+# reported by the server in telemetry events and the client side latency on top of it, only for servers sending them
+SERVER_PERCENTILE_METRICS = [
+    "server_time_to_first_token",
+    "time_to_first_token_gap",
+    "server_total_latency",
+    "total_latency_gap",
+]
+# phases of the requests as seen by the connection pool of the engine: connect and TLS times are over the requests
+# which opened a connection, connection wait over all of them when the pool is limited
+CONNECTION_PERCENTILE_METRICS = [
+    "connection_wait",
+    "connect_time",
+    "tls_time",
+    "request_sent_time",
+    "time_to_headers",
+    "time_to_first_byte",
+]
+# 95% confidence interval reported for the P90 of these
+CI_METRICS = ["time_to_first_token", "total_latency"]
+# tokens delivered by the server per second of wall clock time
+THROUGHPUT_SERIES = ["prompt_tokens_per_second", "output_tokens_per_second"]
+
+
+def make_logging_params(provider, model, parsed_options, max_tokens_sampler):
+    return {
+        # TODO: add some server info with git version
+        "provider": provider,
+        "model": model,
+        "prompt_tokens": parsed_options.prompt_tokens,  # might be overwritten based on metric
+        "generation_tokens": str(max_tokens_sampler),
+        "stream": parsed_options.stream,
+        "temperature": parsed_options.temperature,
+        "logprobs": parsed_options.logprobs,
+        "prefix_hit_ratio": parsed_options.prefix_hit_ratio if parsed_options.prefix_hit_ratio is not None else "",
+        "session_turns": parsed_options.session_turns or "",
+        "slo_ttft": parsed_options.slo_ttft if parsed_options.slo_ttft is not None else "",
+        "slo_tpot": parsed_options.slo_tpot if parsed_options.slo_tpot is not None else "",
+    }
+
+
+def build_summary(logging_params, concurrency, stats, request_counts, stream, fixed_qps, convergence=None):
+    """
+    Builds the summary row. `stats` provides `avg(name)`, `percentile(name, fraction)`, `num_requests(name)` and
+    `rps(name)` for the recorded metrics, `series(name)`, `start_time` and `end_time()` for the per second series.
+    `request_counts` is `(total, initiated, first_chunk_only)`. `convergence` is the `ConvergenceMonitor` of runs with
+    an adaptive duration
+    """
+    entries = copy.copy(logging_params)
+    entries["concurrency"] = concurrency
+    for metric_name in AVERAGE_METRICS:
+        entries[metric_name] = stats.avg(metric_name)
+    if not stream:
+        # if there's no streaming these metrics are meaningless
+        entries["time_to_first_token"] = ""
+        entries["latency_per_token"] = ""
+    entries["num_requests"] = stats.num_requests("total_latency")
+    entries["qps"] = stats.rps("total_latency")
+    for percentile_metric in PERCENTILE_METRICS:
+        for percentile in PERCENTILES_TO_REPORT:
+            name = f"P{percentile}_{percentile_metric}"
+            entries[name] = stats.percentile(percentile_metric, percentile / 100)
+    for metric in CI_METRICS:
+        meaningful = stream or metric != "time_to_first_token"
+        low, high = confidence_interval(stats, metric, 0.9) if meaningful else ("", "")
+        entries[f"P90_{metric}_ci_low"] = low
+        entries[f"P90_{metric}_ci_high"] = high
+    # columns are always present so that rows from different modes can be appended to the same file
+    entries["schedule_lag"] = stats.avg("schedule_lag") if fixed_qps else ""
+    for percentile_metric in CORRECTED_PERCENTILE_METRICS:
+        for percentile in PERCENTILES_TO_REPORT:
+            name = f"P{percentile}_{percentile_metric}"
+            meaningful = fixed_qps and (stream or percentile_metric != "corrected_time_to_first_token")
+            entries[name] = stats.percentile(percentile_metric, percentile / 100) if meaningful else ""
+    entries["tokens_per_chunk"] = stats.avg("tokens_per_chunk") if stream else ""
+    for percentile_metric in CHUNK_PERCENTILE_METRICS:
+        for percentile in PERCENTILES_TO_REPORT:
+            name = f"P{percentile}_{percentile_metric}"
+            entries[name] = stats.percentile(percentile_metric, percentile / 100) if stream else ""
+    for percentile_metric in SERVER_PERCENTILE_METRICS:
+        telemetry = stats.num_requests(percentile_metric) > 0
+        for percentile in PERCENTILES_TO_REPORT:
+            name = f"P{percentile}_{percentile_metric}"
+            entries[name] = stats.percentile(percentile_metric, percentile / 100) if telemetry else ""
+    for percentile_metric in CONNECTION_PERCENTILE_METRICS:
+        recorded = stats.num_requests(percentile_metric) > 0
+        for percentile in PERCENTILES_TO_REPORT:
+            name = f"P{percentile}_{percentile_metric}"
+            entries[name] = stats.percentile(percentile_metric, percentile / 100) if recorded else ""
+    entries["new_connection_ratio"] = stats.avg("new_connection") if stats.num_requests("new_connection") else ""
+
+    # fraction of the completed requests meeting each SLO and all of them, goodput only counts the latter
+    ttft_slo, tpot_slo = logging_params["slo_ttft"] != "", logging_params["slo_tpot"] != ""
+    entries["ttft_slo_attainment"] = stats.avg("ttft_slo_met") if ttft_slo else ""
+    entries["tpot_slo_attainment"] = stats.avg("tpot_slo_met") if tpot_slo else ""
+    entries["slo_attainment"] = stats.avg("slo_met") if ttft_slo or tpot_slo else ""
+    entries["goodput"] = stats.avg("slo_met") * stats.rps("total_latency") if ttft_slo or tpot_slo else ""
+    entries["goodput_tokens"] = stats.avg("good_tokens") * stats.rps("total_latency") if ttft_slo or tpot_slo else ""
+
+    # per second over the whole seconds of the run: sustained is the median second, a server collapsing under
+    # overload shows up as a sustained throughput well below the peak. Blank rather than 0 when the tokens were never
+    # counted (e.g. no usage and no tokenizer), a zero is a server that stopped delivering
+    for name in THROUGHPUT_SERIES:
+        series = stats.series(name)
+        values = series.values(stats.start_time, stats.end_time()) if series.buckets else []
+        entries[f"sustained_{name}"] = statistics.median(values) if values else ""
+        entries[f"peak_{name}"] = max(values) if values else ""
+
+    # realized prefix sharing: fraction of requests with a shared prefix sent before and of their prompt tokens
+    prefix_workload = logging_params["prefix_hit_ratio"] != ""
+    entries["prefix_reuse"] = stats.avg("prefix_reuse") if prefix_workload else ""
+    entries["prompt_token_reuse"] = stats.avg("prompt_token_reuse") if prefix_workload else ""
+
+    # chat sessions: one value per turn index separated by ';', the context grows with every turn
+    turns = range(1, (logging_params["session_turns"] or 0) + 1)
+    by_turn = lambda values: ";".join(f"{v:.3f}" for v in values) if turns else ""
+    entries["time_to_first_token_by_turn"] = by_turn(stats.avg(f"time_to_first_token_turn_{t}") for t in turns)
+    entries["P90_time_to_first_token_by_turn"] = by_turn(
+        stats.percentile(f"time_to_first_token_turn_{t}", 0.9) for t in turns
+    )
+    entries["prompt_tokens_by_turn"] = by_turn(stats.avg(f"prompt_tokens_turn_{t}") for t in turns)
+    if not stream:
+        entries["time_to_first_token_by_turn"] = ""
+        entries["P90_time_to_first_token_by_turn"] = ""
+
+    # seconds from the start until the warm-up was detected, whether the percentiles converged before the time limit
+    warmup_time = convergence.warmup_time if convergence is not None else None
+    entries["warmup_time"] = warmup_time if warmup_time is not None else ""
+    entries["converged"] = convergence.converged_at is not None if convergence is not None else ""
+
+    total_reqs, initiated_reqs, first_chunk_only_reqs = request_counts
+    entries["total_requests"] = total_reqs
+    entries["incomplete_requests_nofirstchunk"] = initiated_reqs
+    entries["incomplete_requests_nolastchunk"] = first_chunk_only_reqs
+    entries["incomplete_requests"] = initiated_reqs + first_chunk_only_reqs
+
+    pretty_name = lambda s: " ".join([w.capitalize() for w in s.split("_")])
+    return {pretty_name(k): v for k, v in entries.items()}
+
+
+def print_summary(entries):
+    max_width = max(len(k) for k in entries.keys())
+    print(" Summary ".center(80, "="))
+    for k, v in entries.items():
+        print(f"{k:<{max_width}}: {v}")
+    print("=" * 80)
+
+
+def append_throughput_series(series_file, logging_params, concurrency, stats):
+    """
+    Appends one row per second of the run with the tokens delivered in it, runs are told apart by their start time
+    """
+    start = math.ceil(stats.start_time)
+    end = stats.end_time()
+    num_seconds = max(0, math.floor(end) - start)
+    series = {}
+    for name in THROUGHPUT_SERIES:
+        per_second = stats.series(name)
+        series[name] = per_second.values(stats.start_time, end) if per_second.buckets else None
+    with open(series_file, "a") as f:
+        writer = csv.writer(f)
+        if f.tell() == 0:
+            writer.writerow(
+                ["Provider", "Model", "Prompt Tokens", "Generation Tokens", "Concurrency", "Run Start", "Second"]
+                + [" ".join(w.capitalize() for w in name.split("_")) for name in THROUGHPUT_SERIES]
+            )
+        for i in range(num_seconds):
+            # blank for the series that were never counted, like in the summary
+            values = ["" if v is None else v[i] for v in series.values()]
+            writer.writerow(
+                [
+                    logging_params["provider"],
+                    logging_params["model"],
+                    logging_params["prompt_tokens"],
+                    logging_params["generation_tokens"],
+                    concurrency,
+                    start,
+                    i,
+                    *values,
+                ]
+            )
+
+
+def append_summary(summary_file, entries):
+    with open(summary_file, "a") as f:
+        writer = csv.DictWriter(f, fieldnames=entries.keys())
+        if f.tell() == 0:
+            writer.writeheader()
+        writer.writerow(entries)
@@ -0,0 +1,429 @@
+"""
+In-process sweep over a grid of benchmark configurations with the asyncio engine.
+
+Every point of the grid runs on the same event loop one after the other, so the tokenizer, the prompt pools and the
+HTTP connections to the server are set up once instead of once per point as with a new locust process per point.
+The summary of every point is appended to `--summary-file` in the same format as single runs, e.g.:
+
+    python sweep.py -H http://localhost:8000 -m model --chat -o 128 -t 60 --summary-file results.csv \\
+        --grid prompt_tokens=128,512,2048 --grid qps=1,2,4,8
+
+From Python (e.g. a notebook), `run_benchmark` takes the options as a dict where list values are swept:
+
+    run_benchmark({"host": "http://localhost:8000", "chat": True, "prompt_tokens": [128, 512], "qps": [1, 2, 4]})
+
+With `--search-capacity` the QPS isn't swept on a fixed list but searched for every point: the highest QPS at which
+the given SLOs hold is found by doubling the rate until they break and then bisecting, see `find_capacity`.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import copy
+import csv
+import itertools
+import sys
+import traceback
+
+from async_engine import AsyncEngine, create_parser, create_session, session_key
+from exporter import stop_exporter
+from records import close_sinks
+from summary import append_summary, print_summary
+from tracer import close_tracers
+
+
+def expand_grid(config):
+    """
+    Returns one dict per point of the cartesian product of the list values of `config`, the first swept key varies
+    the slowest
+    """
+    swept = [k for k, v in config.items() if isinstance(v, (list, tuple))]
+    points = []
+    for values in itertools.product(*(config[k] for k in swept)):
+        point = dict(config)
+        point.update(zip(swept, values))
+        points.append(point)
+    return points
+
+
+def _is_flag(action):
+    # --stream/--no-stream and store_true/store_false options
+    return isinstance(action, argparse.BooleanOptionalAction) or isinstance(action.const, bool)
+
+
+def convert_option(action, value):
+    """
+    Converts the string `value` of an option like on the command line, flags take true/false/1/0. Raises
+    `ValueError` for a value the command line would reject
+    """
+    name = action.dest
+    if isinstance(value, str):
+        if _is_flag(action):
+            if value.lower() not in ("true", "false", "1", "0"):
+                raise ValueError(f"Invalid value {value!r} of {name}, expected true/false/1/0")
+            value = value.lower() in ("true", "1")
+        elif action.type is not None:
+            try:
+                value = action.type(value)
+            except (ValueError, argparse.ArgumentTypeError) as e:
+                raise ValueError(f"Invalid value {value!r} of {name}: {e}") from e
+    if action.choices is not None and value is not None and value not in action.choices:
+        choices = ", ".join(map(str, action.choices))
+        raise ValueError(f"Invalid value {value!r} of {name}, expected one of {choices}")
+    return value
+
+
+def make_options(point, base=None, parser=None):
+    """
+    Parsed options of a point: the defaults of the command line (or `base`) updated with the point's values. Strings
+    are converted like on the command line, e.g. `run_time="5min"` or `stream="false"`
+    """
+    parser = parser or create_parser()
+    options = copy.copy(base) if base is not None else parser.parse_args([])
+    actions = {action.dest: action for action in parser._actions}
+    for name, value in point.items():
+        if name not in actions or name == "help":
+            raise ValueError(f"Unknown option {name}")
+        setattr(options, name, convert_option(actions[name], value))
+    return options
+
+
+def _describe(point):
+    return ", ".join(f"{k}={v}" for k, v in point.items())
+
+
+def _make_point(point, base=None, parser=None, description=None):
+    description = description or _describe(point)
+    options = make_options(point, base, parser)
+    if options.run_label is None:
+        # tells the points apart in the per request records
+        options.run_label = description
+    return description, options
+
+
+def _run_and_close(coro):
+    try:
+        return _run(coro)
+    finally:
+        close_sinks()
+        stop_exporter()
+        close_tracers()
+
+
+async def run_point(session, options):
+    """
+    Returns the summary entries of one run, also appended to the summary file, or None if the run failed
+    """
+    try:
+        entries = await AsyncEngine(options).run(session)
+    except Exception as e:
+        print(f"Failed to run: {repr(e)}")
+        print(traceback.format_exc())
+        return None
+    if entries is not None:
+        print_summary(entries)
+        if options.summary_file:
+            append_summary(options.summary_file, entries)
+    return entries
+
+
+class _Sessions:
+    """
+    HTTP sessions of a sweep, one per connection pool setup (e.g. when sweeping --connection-policy)
+    """
+
+    def __init__(self):
+        self.sessions = {}
+
+    def get(self, options):
+        key = session_key(options)
+        if key not in self.sessions:
+            self.sessions[key] = create_session(options)
+        return self.sessions[key]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for session in self.sessions.values():
+            await session.close()
+
+
+async def run_points(points, cooldown=0):
+    """
+    Runs `[(description, parsed_options)]` one after the other sharing HTTP sessions. Returns the summary entries
+    of every point, None for the failed ones
+    """
+    results = []
+    async with _Sessions() as sessions:
+        for i, (description, options) in enumerate(points):
+            if i > 0 and cooldown:
+                await asyncio.sleep(cooldown)
+            print(f" Point {i + 1}/{len(points)}: {description} ".center(80, "#"), flush=True)
+            results.append(await run_point(sessions.get(options), options))
+    return results
+
+
+# SLO name -> summary column holding the value it bounds, the incomplete request ratio is derived separately
+SLO_COLUMNS = {
+    "max_p90_ttft": "P90 Time To First Token",
+    "max_p90_tpot": "P90 Latency Per Token",
+}
+
+
+def slo_violations(entries, slo):
+    """
+    Returns the descriptions of the SLOs `entries` violates, `slo` maps `max_p90_ttft`, `max_p90_tpot` (ms) and
+    `max_incomplete_ratio` to their bound or None
+    """
+    if entries is None:
+        return ["run failed"]
+    violations = []
+    for name, column in SLO_COLUMNS.items():
+        if slo.get(name) is not None and entries[column] > slo[name]:
+            violations.append(f"{column} {entries[column]:.1f} > {slo[name]}")
+    if slo.get("max_incomplete_ratio") is not None:
+        ratio = entries["Incomplete Requests"] / max(entries["Total Requests"], 1)
+        if ratio > slo["max_incomplete_ratio"]:
+            violations.append(f"incomplete ratio {ratio:.3f} > {slo['max_incomplete_ratio']}")
+    return violations
+
+
+async def search_capacity(session, options, slo, qps_min, qps_max, tolerance, max_probes, cooldown=0):
+    """
+    Searches the highest QPS in [qps_min, qps_max] at which the SLOs hold: the rate is doubled from `qps_min` until
+    they break, then the interval between the last passing and the first failing rate is bisected until it's
+    narrower than `tolerance` relative to the passing rate. Every probe is a full run appended to the summary file.
+    Returns `(capacity, probes)` where capacity is None if the SLOs don't hold at `qps_min`
+    """
+    passed, failed = None, None
+    probes = []
+    qps = qps_min
+    while len(probes) < max_probes:
+        if probes and cooldown:
+            await asyncio.sleep(cooldown)
+        probe_options = copy.copy(options)
+        probe_options.qps = round(qps, 3)
+        print(f" Probe {len(probes) + 1}: qps={probe_options.qps} ".center(80, "-"), flush=True)
+        violations = slo_violations(await run_point(session, probe_options), slo)
+        print(f"qps={probe_options.qps}: " + ("; ".join(violations) if violations else "SLOs met"), flush=True)
+        probes.append((probe_options.qps, violations))
+        if violations:
+            failed = qps
+        else:
+            passed = qps
+        if passed is None or (failed is None and qps >= qps_max):
+            break
+        if failed is None:
+            qps = min(qps * 2, qps_max)
+        elif failed - passed > tolerance * passed:
+            qps = (passed + failed) / 2
+        else:
+            break
+    return (round(passed, 3) if passed is not None else None), probes
+
+
+def _write_capacity(capacity_file, rows):
+    with open(capacity_file, "a") as f:
+        writer = csv.DictWriter(f, fieldnames=rows[0].keys())
+        if f.tell() == 0:
+            writer.writeheader()
+        writer.writerows(rows)
+
+
+async def search_points(points, slo, qps_min, qps_max, tolerance, max_probes, cooldown=0, capacity_file=None):
+    """
+    Runs `search_capacity` for every `(description, parsed_options)` sharing HTTP sessions, returns one row per
+    point with its capacity, also appended to `capacity_file`
+    """
+    rows = []
+    async with _Sessions() as sessions:
+        for i, (description, options) in enumerate(points):
+            if i > 0 and cooldown:
+                await asyncio.sleep(cooldown)
+            print(f" Point {i + 1}/{len(points)}: {description} ".center(80, "#"), flush=True)
+            capacity, probes = await search_capacity(
+                sessions.get(options), options, slo, qps_min, qps_max, tolerance, max_probes, cooldown
+            )
+            row = {
+                "Point": description,
+                "Prompt Tokens": options.prompt_tokens,
+                "Max Tokens": options.max_tokens,
+                **{" ".join(w.capitalize() for w in name.split("_")): slo.get(name, "") for name in SLO_NAMES},
+                "Capacity Qps": capacity if capacity is not None else "",
+                "Probes": ";".join(f"{qps}{'' if violations else '*'}" for qps, violations in probes),
+            }
+            rows.append(row)
+            if capacity_file:
+                _write_capacity(capacity_file, [row])
+    print(" Capacity ".center(80, "="))
+    for row in rows:
+        capacity = row["Capacity Qps"]
+        print(f"{row['Point']}: " + (f"{capacity} qps" if capacity != "" else f"SLOs not met at {qps_min} qps"))
+    print("=" * 80)
+    return rows
+
+
+def _run(coro):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    # called from a running loop (e.g. Jupyter), the sweep gets a loop of its own in a thread
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+SLO_NAMES = ["max_p90_ttft", "max_p90_tpot", "max_incomplete_ratio"]
+
+
+def _check_slo(slo, stream):
+    if all(slo.get(name) is None for name in SLO_NAMES):
+        raise ValueError(f"At least one SLO is needed out of {', '.join(SLO_NAMES)}")
+    if not stream and any(slo.get(name) is not None for name in SLO_COLUMNS):
+        raise ValueError("Time to first token and time per output token SLOs require streaming")
+
+
+def run_benchmark(config, cooldown=0):
+    """
+    Runs every point of the grid described by `config`, a dict of option names as in the parsed options (e.g.
+    `prompt_tokens`, `qps`, `run_time`) where list values are swept. Returns the summary entries of every point in
+    grid order, None for the failed ones. `cooldown` is a pause in seconds between points to let the server drain
+    """
+    parser = create_parser()
+    points = [_make_point(p, parser=parser) for p in expand_grid(config)]
+    return _run_and_close(run_points(points, cooldown))
+
+
+def find_capacity(
+    config, slo, qps_min=0.125, qps_max=64, tolerance=0.1, max_probes=10, cooldown=0, capacity_file=None
+):
+    """
+    Searches the maximum sustainable QPS for every point of the grid described by `config` (as in `run_benchmark`,
+    without `qps`). `slo` maps `max_p90_ttft` and `max_p90_tpot` (ms) and `max_incomplete_ratio` to their bound.
+    Every probe run is appended to the summary file. Returns one row per point with `Capacity Qps` ("" if the SLOs
+    don't hold even at `qps_min`) and the probed rates, the passing ones marked with `*`
+    """
+    if "qps" in config:
+        raise ValueError("qps is searched, it can't be set")
+    parser = create_parser()
+    points = [_make_point(p, parser=parser) for p in expand_grid(config)]
+    _check_slo(slo, points[0][1].stream)
+    search = search_points(points, slo, qps_min, qps_max, tolerance, max_probes, cooldown, capacity_file)
+    return _run_and_close(search)
+
+
+# options of the sweep itself, not passed to the engine
+SWEEP_ARGUMENTS = [
+    "grid",
+    "cooldown",
+    "search_capacity",
+    *SLO_NAMES,
+    "qps_min",
+    "qps_max",
+    "qps_tolerance",
+    "max_probes",
+    "capacity_file",
+]
+
+
+def main():
+    parser = create_parser()
+    parser.add_argument(
+        "--grid",
+        action="append",
+        default=[],
+        metavar="NAME=V1,V2,...",
+        help="Option to sweep and its values, e.g. qps=1,2,4 or prompt_tokens=128,512. Can be repeated, every "
+        "combination is run",
+    )
+    parser.add_argument(
+        "--cooldown",
+        type=float,
+        default=0,
+        help="Pause in seconds between two points of the grid",
+    )
+    parser.add_argument(
+        "--search-capacity",
+        action="store_true",
+        default=False,
+        help="Instead of running at a given --qps, search the highest QPS meeting the --max-* SLOs for every point",
+    )
+    parser.add_argument("--max-p90-ttft", type=float, default=None, help="SLO on P90 time to first token in ms")
+    parser.add_argument("--max-p90-tpot", type=float, default=None, help="SLO on P90 time per output token in ms")
+    parser.add_argument(
+        "--max-incomplete-ratio",
+        type=float,
+        default=None,
+        help="SLO on the fraction of requests still in flight at the end of a run",
+    )
+    parser.add_argument("--qps-min", type=float, default=0.125, help="QPS the capacity search starts from")
+    parser.add_argument("--qps-max", type=float, default=64, help="Highest QPS probed by the capacity search")
+    parser.add_argument(
+        "--qps-tolerance",
+        type=float,
+        default=0.1,
+        help="Capacity search stops once the QPS is known within this fraction",
+    )
+    parser.add_argument("--max-probes", type=int, default=10, help="Maximum number of runs per capacity search")
+    parser.add_argument(
+        "--capacity-file",
+        type=str,
+        default=None,
+        help="Append the capacity found for every point to this CSV file",
+    )
+    args = parser.parse_args()
+    actions = {action.dest: action for action in parser._actions}
+    grid = {}
+    for spec in args.grid:
+        name, sep, values = spec.partition("=")
+        name = name.strip().lstrip("-").replace("-", "_")
+        if not sep or name not in actions or name in SWEEP_ARGUMENTS or name == "help":
+            parser.error(f"Invalid --grid {spec}")
+        try:
+            grid[name] = [convert_option(actions[name], v.strip()) for v in values.split(",")]
+        except ValueError as e:
+            parser.error(f"Invalid --grid {spec}: {e}")
+    base = copy.copy(args)
+    for name in SWEEP_ARGUMENTS:
+        delattr(base, name)
+
+    try:
+        import uvloop
+
+        uvloop.install()
+    except ImportError:
+        pass
+    points = [_make_point(p, base, parser, _describe(p) or "single run") for p in expand_grid(grid)]
+    if args.search_capacity:
+        if "qps" in grid:
+            parser.error("--qps is searched with --search-capacity, it can't be swept")
+        slo = {name: getattr(args, name) for name in SLO_NAMES}
+        try:
+            _check_slo(slo, args.stream)
+        except ValueError as e:
+            parser.error(str(e))
+        rows = _run_and_close(
+            search_points(
+                points,
+                slo,
+                args.qps_min,
+                args.qps_max,
+                args.qps_tolerance,
+                args.max_probes,
+                args.cooldown,
+                args.capacity_file,
+            )
+        )
+        if any(row["Capacity Qps"] == "" for row in rows):
+            sys.exit(1)
+        return
+    results = _run_and_close(run_points(points, args.cooldown))
+    failed = sum(entries is None for entries in results)
+    if failed:
+        print(f"{failed} of {len(results)} points failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
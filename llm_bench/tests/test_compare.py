@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+from compare import bootstrap_change, compare, mann_whitney, proportion_test
+
+
+def _latencies(scale=1.0, n=200):
+    rng = np.random.default_rng(1)
+    return rng.lognormal(5, 0.3, n) * scale
+
+
+def _result_set(label, scale=1.0, incomplete=0, total=200):
+    samples = {metric: _latencies(scale) for metric in ("ttft", "tpot", "total_latency")}
+    point = {"prompt_tokens": 512, "concurrency": 8, "samples": samples, "total": total, "incomplete": incomplete}
+    return {"label": label, "points": [point]}
+
+
+def test_mann_whitney_known_p_value():
+    # U = 9 out of 9, z = (9 - 4.5 - 0.5) / sqrt(3 * 3 / 12 * 7)
+    assert mann_whitney(np.array([1.0, 2, 3]), np.array([4.0, 5, 6])) == pytest.approx(0.040428, abs=1e-6)
+
+
+def test_mann_whitney_identical_samples():
+    assert mann_whitney(np.array([1.0, 2, 3]), np.array([1.0, 2, 3])) > 0.5
+    assert mann_whitney(np.array([2.0, 2, 2]), np.array([2.0, 2, 2])) == 1.0
+
+
+def test_mann_whitney_shift():
+    assert mann_whitney(_latencies(), _latencies(1.5)) < 1e-6
+    assert mann_whitney(_latencies(1.5), _latencies()) > 1 - 1e-6
+
+
+def test_bootstrap_change_identical_samples():
+    change, (low, high) = bootstrap_change(_latencies(), _latencies())
+    assert change == 0
+    assert low < 0 < high
+    assert (low, high) == pytest.approx((-0.0924, 0.0975), abs=1e-4)
+
+
+def test_bootstrap_change_shift():
+    change, (low, high) = bootstrap_change(_latencies(), _latencies(1.5))
+    assert change == pytest.approx(0.5)
+    assert 0.3 < low < 0.5 < high < 0.7
+
+
+def test_bootstrap_change_is_seeded():
+    assert bootstrap_change(_latencies(), _latencies(1.1)) == bootstrap_change(_latencies(), _latencies(1.1))
+
+
+def test_bootstrap_change_zero_baseline():
+    assert bootstrap_change(np.zeros(50), _latencies()) == (None, (None, None))
+
+
+def test_proportion_test_known_p_value():
+    # pooled 0.15, z = 0.1 / sqrt(0.15 * 0.85 * 0.02)
+    assert proportion_test(10, 100, 20, 100) == pytest.approx(0.023835, abs=1e-6)
+    assert proportion_test(20, 100, 10, 100) == pytest.approx(1 - 0.023835, abs=1e-6)
+
+
+def test_proportion_test_no_failures():
+    assert proportion_test(0, 100, 0, 100) == 1.0
+
+
+def test_compare_identical_results():
+    verdict = compare(_result_set("baseline"), [_result_set("candidate")])
+    assert not verdict["regression"]
+    assert not verdict["improvements"]
+    assert {c["verdict"] for c in verdict["comparisons"]} == {"unchanged"}
+    assert not verdict["unmatched"]
+
+
+def test_compare_latency_regression():
+    verdict = compare(_result_set("baseline"), [_result_set("candidate", scale=1.5)])
+    assert verdict["regression"]
+    assert sorted(c["metric"] for c in verdict["regressions"]) == ["total_latency", "tpot", "ttft"]
+    assert all(c["method"] == "mann-whitney+bootstrap" for c in verdict["regressions"])
+
+
+def test_compare_latency_improvement():
+    verdict = compare(_result_set("baseline", scale=1.5), [_result_set("candidate")])
+    assert not verdict["regression"]
+    assert len(verdict["improvements"]) == 3
+
+
+def test_compare_change_below_min_change():
+    # significant with 200 samples but smaller than the 10% that matters
+    verdict = compare(_result_set("baseline"), [_result_set("candidate", scale=1.05)])
+    assert not verdict["regression"]
+
+
+def test_compare_incomplete_regression():
+    verdict = compare(_result_set("baseline", incomplete=2), [_result_set("candidate", incomplete=30)])
+    assert [c["metric"] for c in verdict["regressions"]] == ["incomplete_ratio"]
+
+
+def test_compare_unmatched_point():
+    candidate = _result_set("candidate")
+    candidate["points"][0]["concurrency"] = 16
+    verdict = compare(_result_set("baseline"), [candidate])
+    assert not verdict["comparisons"]
+    assert verdict["unmatched"] == [{"candidate": "candidate", "prompt_tokens": 512, "concurrency": 16}]
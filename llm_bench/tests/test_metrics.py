@@ -0,0 +1,81 @@
+import json
+import math
+import random
+
+import pytest
+
+from metrics import HdrHistogram
+
+
+def test_small_values_are_exact():
+    hist = HdrHistogram(scale=1)
+    for value in range(1, 101):
+        hist.record(value)
+    assert hist.percentile(0.5) == 50
+    assert hist.percentile(0.9) == 90
+    assert hist.percentile(0.99) == 99
+    assert hist.percentile(1.0) == 100
+    assert hist.percentile(0) == 1
+    assert hist.mean() == pytest.approx(50.5)
+
+
+def test_percentiles_within_relative_precision():
+    values = [random.Random(0).lognormvariate(5, 1) for _ in range(10_000)]
+    hist = HdrHistogram()
+    for value in values:
+        hist.record(value)
+    values.sort()
+    for fraction in (0.5, 0.9, 0.99, 0.999):
+        expected = values[math.ceil(fraction * len(values)) - 1]
+        assert hist.percentile(fraction) == pytest.approx(expected, rel=2**-10)
+    assert hist.percentile(1.0) == values[-1]
+    assert (hist.count, hist.min, hist.max) == (len(values), values[0], values[-1])
+
+
+def test_empty():
+    hist = HdrHistogram()
+    assert hist.percentile(0.9) == 0
+    assert hist.mean() == 0
+
+
+def test_record_count():
+    hist = HdrHistogram(scale=1)
+    hist.record(10, count=9)
+    hist.record(1000)
+    assert hist.count == 10
+    assert hist.percentile(0.9) == 10
+    assert hist.percentile(0.95) == 1000
+
+
+def test_merge_matches_single_histogram():
+    rng = random.Random(1)
+    values = [rng.expovariate(0.01) for _ in range(2_000)]
+    single, first, second = HdrHistogram(), HdrHistogram(), HdrHistogram()
+    for i, value in enumerate(values):
+        single.record(value)
+        (first if i % 2 else second).record(value)
+    first.merge(second)
+    assert first.counts == single.counts
+    assert (first.count, first.min, first.max) == (single.count, single.min, single.max)
+    assert first.sum == pytest.approx(single.sum)
+    for fraction in (0.5, 0.9, 0.99):
+        assert first.percentile(fraction) == single.percentile(fraction)
+
+
+def test_merge_empty():
+    hist = HdrHistogram(scale=1)
+    hist.record(5)
+    hist.merge(HdrHistogram(scale=1))
+    assert (hist.count, hist.min, hist.max, hist.percentile(0.5)) == (1, 5, 5, 5)
+
+
+def test_dict_round_trip():
+    hist = HdrHistogram()
+    for value in (0.5, 12.25, 3000.0, 3000.0):
+        hist.record(value)
+    restored = HdrHistogram.from_dict(json.loads(json.dumps(hist.to_dict())))
+    assert restored.counts == hist.counts
+    assert restored.percentile(0.5) == hist.percentile(0.5)
+    assert (restored.count, restored.min, restored.max) == (hist.count, hist.min, hist.max)
+    empty = HdrHistogram.from_dict(json.loads(json.dumps(HdrHistogram().to_dict())))
+    assert empty.count == 0 and empty.percentile(0.5) == 0
@@ -0,0 +1,16 @@
+from results_store import ResultsStore
+
+
+def test_find_runs_date_filters(tmp_path):
+    store = ResultsStore(str(tmp_path / "results.db"))
+    for i, date in enumerate(["2026-10-16T23:59:59", "2026-10-17T04:00:00", "2026-10-18T00:00:00"]):
+        csv_path = tmp_path / f"run{i}.csv"
+        csv_path.write_text("Provider,Model,Concurrency\nopenai,mock,1\n")
+        store.ingest(str(csv_path), date=date)
+    dates = lambda **filters: [run["date"] for run in store.find_runs(**filters)]
+    assert dates(since="2026-10-17", until="2026-10-17") == ["2026-10-17T04:00:00"]
+    assert dates(until="2026-10-17") == ["2026-10-16T23:59:59", "2026-10-17T04:00:00"]
+    assert dates(since="2026-10-17") == ["2026-10-17T04:00:00", "2026-10-18T00:00:00"]
+    assert dates(until="2026-10-17T03:00:00") == ["2026-10-16T23:59:59"]
+    assert dates(until="2026-10") == dates()
+    store.close()
@@ -0,0 +1,44 @@
+from sse import SSEParser, iter_sse_data
+
+
+STREAM = (
+    b': keep-alive\n\n'
+    b'data: {"id": 1}\n\n'
+    b'event: message\r\ndata: {"id": 2}\r\n\r\n'
+    b'data:{"a":\ndata: "b"}\n\n'
+    b'data: [DONE]\n\n'
+)
+EVENTS = [b'{"id": 1}', b'{"id": 2}', b'{"a":\n"b"}', b"[DONE]"]
+
+
+def test_whole_stream():
+    assert list(iter_sse_data([STREAM])) == EVENTS
+
+
+def test_split_at_every_position():
+    for i in range(len(STREAM) + 1):
+        assert list(iter_sse_data([STREAM[:i], STREAM[i:]])) == EVENTS, i
+
+
+def test_byte_by_byte():
+    assert list(iter_sse_data(STREAM[i : i + 1] for i in range(len(STREAM)))) == EVENTS
+
+
+def test_events_returned_when_completed():
+    parser = SSEParser()
+    assert parser.feed(b'data: {"id": 1}\n') == []
+    assert parser.feed(b"\ndata: {") == [b'{"id": 1}']
+    assert parser.feed(b'"id": 2}\r') == []
+    assert parser.feed(b"\n\r\n") == [b'{"id": 2}']
+    assert parser.close() == []
+
+
+def test_close_flushes_unterminated_event():
+    parser = SSEParser()
+    assert parser.feed(b'data: {"id": 1}') == []
+    assert parser.close() == [b'{"id": 1}']
+    assert parser.close() == []
+
+
+def test_empty_data():
+    assert list(iter_sse_data([b"data:\n\ndata: \n\n"])) == [b"", b""]
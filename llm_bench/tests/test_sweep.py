@@ -0,0 +1,52 @@
+import pytest
+
+from async_engine import create_parser
+from sweep import make_options
+
+
+@pytest.fixture(scope="module")
+def parser():
+    return create_parser()
+
+
+@pytest.mark.parametrize("value, expected", [("false", False), ("0", False), ("True", True), ("1", True)])
+def test_flags(parser, value, expected):
+    options = make_options({"stream": value, "chat": value, "prompt_randomize": value}, parser=parser)
+    assert options.stream is expected
+    assert options.chat is expected
+    assert options.prompt_randomize is expected
+
+
+def test_flags_reject_other_strings(parser):
+    with pytest.raises(ValueError, match="stream"):
+        make_options({"stream": "no"}, parser=parser)
+
+
+def test_typed_values(parser):
+    options = make_options({"run_time": "5min", "prompt_tokens": "512", "qps": "2.5", "stream": True}, parser=parser)
+    assert (options.run_time, options.prompt_tokens, options.qps, options.stream) == (300, 512, 2.5, True)
+    with pytest.raises(ValueError, match="prompt_tokens"):
+        make_options({"prompt_tokens": "many"}, parser=parser)
+
+
+def test_choices(parser):
+    assert make_options({"connection_policy": "fresh"}, parser=parser).connection_policy == "fresh"
+    with pytest.raises(ValueError, match="keep-alive, fresh"):
+        make_options({"connection_policy": "close"}, parser=parser)
+    with pytest.raises(ValueError, match="qps_distribution"):
+        make_options({"qps_distribution": "poisson"}, parser=parser)
+
+
+def test_unknown_option(parser):
+    with pytest.raises(ValueError, match="Unknown option"):
+        make_options({"streaming": True}, parser=parser)
+
+
+def test_grid_errors(monkeypatch, capsys):
+    import sweep
+
+    for grid in ("stream=true,maybe", "connection_policy=keep-alive,close"):
+        monkeypatch.setattr("sys.argv", ["sweep.py", "-H", "http://localhost:1", "--grid", grid])
+        with pytest.raises(SystemExit):
+            sweep.main()
+        assert f"Invalid --grid {grid}" in capsys.readouterr().err
@@ -0,0 +1,51 @@
+def _encode_batch(tokenizer, texts):
+    return [len(ids) for ids in tokenizer(texts)["input_ids"]]
+
+
+class TokenCounter:
+    """
+    Counts tokens of completed responses with the local tokenizer off the request path.
+
+    Texts are encoded in batches on a pool thread: while one batch is being encoded, the following responses queue up
+    and go together into the next one. `submit` returns a future whose done callbacks run on the event loop (gevent's
+    `ThreadPoolExecutor.submit` or asyncio's `loop.run_in_executor`), so callbacks may touch the engine state freely.
+    All other methods must be called from the event loop too
+    """
+
+    def __init__(self, tokenizer, submit):
+        self.tokenizer = tokenizer
+        self.submit = submit
+        self.pending = []  # [(text, callback)]
+        self.in_flight = None
+
+    def count(self, text, callback):
+        """
+        Calls `callback(num_tokens)` once `text` is encoded
+        """
+        self.pending.append((text, callback))
+        if self.in_flight is None:
+            self._start_batch()
+
+    def _start_batch(self):
+        batch, self.pending = self.pending, []
+        self.in_flight = self.submit(_encode_batch, self.tokenizer, [text for text, _ in batch])
+        self.in_flight.add_done_callback(lambda future: self._batch_done(batch, future))
+
+    def _batch_done(self, batch, future):
+        self.in_flight = None
+        try:
+            counts = future.result()
+        except Exception as e:
+            print(f"WARNING: failed to count tokens of {len(batch)} responses: {repr(e)}", flush=True)
+            counts = [None] * len(batch)
+        for (_, callback), num_tokens in zip(batch, counts):
+            try:
+                callback(num_tokens)
+            except Exception as e:
+                print(f"WARNING: failed to record token metrics: {repr(e)}", flush=True)
+        if self.pending:
+            self._start_batch()
+
+    @property
+    def idle(self):
+        return self.in_flight is None and not self.pending
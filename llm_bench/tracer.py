@@ -0,0 +1,164 @@
+import atexit
+import gzip
+import json
+import os
+import random
+import threading
+import time
+
+
+class Lanes:
+    """
+    Tracks for requests that don't belong to a user (QPS mode): every request takes the lowest free lane, so the
+    number of lanes is the peak concurrency of the traced requests
+    """
+
+    def __init__(self):
+        self.free = []
+        self.count = 0
+
+    def acquire(self):
+        if self.free:
+            self.free.sort()
+            return self.free.pop(0)
+        self.count += 1
+        return self.count - 1
+
+    def release(self, lane):
+        self.free.append(lane)
+
+
+class Tracer:
+    """
+    Timeline of a sample of the requests in the Chrome trace event format, which https://ui.perfetto.dev and
+    chrome://tracing open. Every run is a process and every user (or lane) a track with one span per request:
+    the delay behind schedule, waiting for a connection, connecting, sending the request, waiting for the headers, the
+    first token and the rest of the stream, plus an instant per chunk.
+
+    Spans are built from the timestamps the engines take anyway, once the request is over, so a traced request isn't
+    slower than the others. `sample_rate` is the fraction of requests traced, the trace stops growing at `max_events`
+    events (later requests are counted as dropped) so it can stay on for whole sweeps
+    """
+
+    def __init__(self, path, sample_rate=1.0, max_events=500_000):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_events = max_events
+        # own generator, sampling must not change the prompts drawn from a seeded `random`
+        self.random = random.Random()
+        self.lock = threading.Lock()
+        self.events = []
+        self.metadata = []
+        self.track_names = set()
+        self.num_processes = 0
+        self.dropped = 0
+        # timestamps are wall clock, so that the traces of distributed workers line up
+        self.clock_offset = time.time() - time.perf_counter()
+        self.closed = False
+
+    def sample(self):
+        return self.sample_rate >= 1 or self.random.random() < self.sample_rate
+
+    def process(self, name):
+        """
+        Returns the id of a new process (one per run) named `name`
+        """
+        with self.lock:
+            self.num_processes += 1
+            pid = self.num_processes
+            self.metadata.append({"ph": "M", "name": "process_name", "pid": pid, "tid": 0, "args": {"name": name}})
+        return pid
+
+    def _ts(self, t):
+        # perf_counter seconds to epoch microseconds
+        return (t + self.clock_offset) * 1e6
+
+    def _span(self, pid, tid, name, start, end, args=None):
+        event = {"ph": "X", "name": name, "pid": pid, "tid": tid, "ts": self._ts(start), "dur": (end - start) * 1e6}
+        if args:
+            event["args"] = args
+        return event
+
+    def add_request(
+        self, pid, track, track_name, t_start, t_end=None, acc=None, schedule_lag=None, phases=None, error=None, **args
+    ):
+        """
+        Adds the spans of a request from its `perf_counter` timestamps: `phases` are the optional connection phases
+        (see `ResponseAccumulator.metrics`), `acc` is the `ResponseAccumulator` (None if the request failed before the
+        response). `args` are shown with the request span
+        """
+        t_end = time.perf_counter() if t_end is None else t_end
+        phases = phases or {}
+        events = []
+        if schedule_lag:
+            events.append(self._span(pid, track, "behind schedule", t_start - schedule_lag, t_start))
+        args = {k: v for k, v in args.items() if v is not None}
+        if error is not None:
+            args["error"] = repr(error)
+        events.append(self._span(pid, track, "request" if error is None else "failed request", t_start, t_end, args))
+        waiting_since = t_start
+        for phase in ("queued", "connect"):
+            start, end = phases.get(f"{phase}_start"), phases.get(f"{phase}_end")
+            if start is not None and end is not None:
+                name = "waiting for a connection" if phase == "queued" else "connect"
+                events.append(self._span(pid, track, name, start, end))
+                waiting_since = end
+        if phases.get("tls_start") is not None and phases.get("connect_end") is not None:
+            events.append(self._span(pid, track, "TLS handshake", phases["tls_start"], phases["connect_end"]))
+        if phases.get("request_sent") is not None:
+            events.append(self._span(pid, track, "sending request", waiting_since, phases["request_sent"]))
+            waiting_since = phases["request_sent"]
+        t_headers = phases.get("headers")
+        if t_headers is not None:
+            events.append(self._span(pid, track, "waiting for headers", waiting_since, t_headers))
+            waiting_since = t_headers
+        t_first = acc.t_first_token if acc is not None else None
+        if t_first is not None:
+            events.append(self._span(pid, track, "waiting for first token", waiting_since, t_first))
+            events.append(self._span(pid, track, "streaming", t_first, t_end))
+            for t in acc.chunk_times:
+                events.append({"ph": "i", "s": "t", "name": "chunk", "pid": pid, "tid": track, "ts": self._ts(t)})
+
+        with self.lock:
+            if len(self.events) + len(events) > self.max_events:
+                self.dropped += 1
+                return
+            self.events.extend(events)
+            if (pid, track) not in self.track_names:
+                self.track_names.add((pid, track))
+                self.metadata.append(
+                    {"ph": "M", "name": "thread_name", "pid": pid, "tid": track, "args": {"name": track_name}}
+                )
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.dropped:
+            print(f"WARNING: {self.dropped} traced requests dropped after {self.max_events} trace events")
+        trace = {
+            "traceEvents": self.metadata + self.events,
+            "displayTimeUnit": "ms",
+            "otherData": {"sample_rate": self.sample_rate, "dropped_requests": self.dropped},
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with (gzip.open if self.path.endswith(".gz") else open)(self.path, "wt") as f:
+            json.dump(trace, f)
+        print(f"Trace of {len(self.events)} events written to {self.path}")
+
+
+# path -> tracer, so that the runs of a sweep go to the same trace
+_tracers = {}
+
+
+def open_tracer(path, sample_rate=1.0, max_events=500_000):
+    if path not in _tracers:
+        _tracers[path] = Tracer(path, sample_rate, max_events)
+    return _tracers[path]
+
+
+@atexit.register
+def close_tracers():
+    for tracer in _tracers.values():
+        tracer.close()
+    _tracers.clear()
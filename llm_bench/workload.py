@@ -0,0 +1,385 @@
+import functools
+import hashlib
+import itertools
+import json
+import os
+import random
+import tempfile
+from typing import Optional
+
+import numpy as np
+
+from dataset import load_dataset
+
+
+PROMPT_PREFIX_TOKEN = "Pad "  # exactly one token
+# "Lengthy" prompt borrowed from nat.dev
+PROMPT_SUFFIX = """Generate a Django application with Authentication, JWT, Tests, DB support. Show docker-compose for python and postgres. Show the complete code for every file!"""
+PROMPT_SUFFIX_TOKENS = 35  # from Llama tokenizer tool (so we don't import it here)
+# the automatically sized prompt pool holds this many tokens, too many for a server's prefix cache to keep all prompts
+PROMPT_POOL_TOKENS = 2**22
+PROMPT_POOL_VERSION = 1
+
+
+class LengthSampler:
+    def __init__(self, distribution: str, mean: int, cap: Optional[int], alpha: float):
+        self.distribution = distribution
+        self.mean = mean
+        self.cap = cap
+        self.alpha = alpha
+
+        if self.distribution == "exponential":
+            self.sample_func = lambda: int(random.expovariate(1 / self.mean))
+        elif self.distribution == "uniform":
+            mx = self.mean + int(self.alpha * self.mean)
+            if self.cap is not None:
+                mx = min(mx, self.cap)
+            self.sample_func = lambda: random.randint(max(1, self.mean - int(self.alpha * self.mean)), mx)
+        elif self.distribution == "constant":
+            self.sample_func = lambda: self.mean
+        elif self.distribution == "normal":
+            self.sample_func = lambda: int(random.gauss(self.mean, self.mean * self.alpha))
+        else:
+            raise ValueError(f"Unknown distribution {self.distribution}")
+
+    def sample(self) -> int:
+        for _ in range(1000):
+            sample = self.sample_func()
+            if sample <= 0:
+                continue
+            if self.cap is not None and sample > self.cap:
+                continue
+            return sample
+        else:
+            raise ValueError("Can't sample a value after 1000 attempts, check distribution parameters")
+
+    def __str__(self):
+        r = int(self.mean * self.alpha)
+        if self.distribution == "constant":
+            s = str(self.mean)
+        elif self.distribution == "uniform":
+            s = f"uniform({self.mean} +/- {r})"
+        elif self.distribution == "normal":
+            s = f"normal({self.mean}, {r})"
+        elif self.distribution == "exponential":
+            s = f"exponential({self.mean})"
+        else:
+            assert False
+        if self.cap is not None:
+            s += f" capped at {self.cap}"
+        return s
+
+    @classmethod
+    def from_options(cls, parsed_options):
+        return cls(
+            distribution=parsed_options.max_tokens_distribution,
+            mean=parsed_options.max_tokens,
+            cap=parsed_options.max_tokens_cap,
+            alpha=parsed_options.max_tokens_range,
+        )
+
+
+def _load_curl_like_data(text, tokenizer=None):
+    """
+    Either use the passed string or load from a file if the string is `@filename`. JSONL files are loaded as a lazily
+    decoded dataset shared by all users of the process
+    """
+    if text.startswith("@"):
+        try:
+            if text.endswith(".jsonl"):
+                return load_dataset(text[1:], tokenizer)
+            else:
+                with open(text[1:], "r") as f:
+                    return f.read()
+        except Exception as e:
+            raise ValueError(f"Failed to read file {text[1:]}") from e
+    else:
+        return text
+
+
+@functools.lru_cache(maxsize=None)
+def load_tokenizer(dir):
+    if not dir:
+        return None
+    import transformers
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained(dir)
+    tokenizer.add_bos_token = False
+    tokenizer.add_eos_token = False
+    return tokenizer
+
+
+def _count_tokens(tokenizer, texts):
+    return [len(ids) for ids in tokenizer(texts)["input_ids"]]
+
+
+def _calibrate(make, num_prompts, target, max_words, tokenizer):
+    """
+    Finds for every prompt the number of words `make(i, words)` needs to have exactly `target` tokens. A word is
+    roughly a token, so it converges in a couple of rounds of batched encoding
+    """
+    suffix_tokens = _count_tokens(tokenizer, [PROMPT_SUFFIX])[0]
+    words = [min(max_words, max(0, target - suffix_tokens))] * num_prompts
+    todo = list(range(num_prompts))
+    for _ in range(10):
+        counts = _count_tokens(tokenizer, [make(i, words[i]) for i in todo])
+        next_todo = []
+        for i, count in zip(todo, counts):
+            fixed = min(max_words, max(0, words[i] + target - count))
+            if count != target and fixed != words[i]:
+                words[i] = fixed
+                next_todo.append(i)
+        if not next_todo:
+            break
+        todo = next_todo
+    prompts = [make(i, words[i]) for i in range(num_prompts)]
+    counts = _count_tokens(tokenizer, prompts)
+    off = [c for c in counts if c != target]
+    if off:
+        print(
+            f"WARNING: {len(off)} of {num_prompts} prompts couldn't be calibrated to {target} tokens exactly, they have {min(off)}-{max(off)} tokens"
+        )
+    return prompts
+
+
+def _random_words(rng, num_words):
+    # space separated random letters, single letters are single tokens
+    words = np.full(2 * num_words, ord(" "), dtype=np.uint8)
+    words[::2] = rng.integers(ord("a"), ord("z") + 1, size=num_words, dtype=np.uint8)
+    return words.tobytes().decode()
+
+
+def _generate_prompts(tokenizer, prompt_tokens, randomize, size, seed):
+    assert prompt_tokens >= PROMPT_SUFFIX_TOKENS, f"Minimal prompt length is {PROMPT_SUFFIX_TOKENS}"
+    if randomize:
+        rng = np.random.default_rng(seed)
+        prefixes = [_random_words(rng, prompt_tokens) for _ in range(size)]
+        make = lambda i, n: prefixes[i][: 2 * n] + PROMPT_SUFFIX
+    else:
+        make = lambda i, n: PROMPT_PREFIX_TOKEN * n + PROMPT_SUFFIX
+    if tokenizer is None:
+        return [make(i, prompt_tokens - PROMPT_SUFFIX_TOKENS) for i in range(size)]
+    return _calibrate(make, size, prompt_tokens, prompt_tokens, tokenizer)
+
+
+class PromptPool:
+    """
+    Prompts of --prompt-tokens generated once and calibrated to the exact token count with the tokenizer if there is
+    one. Requests go round-robin through the pool from a random position, so a prompt repeats only after the whole
+    pool was used. Pools are cached on disk keyed by the tokenizer, length and seed, so that the runs of a sweep share
+    them
+    """
+
+    def __init__(self, prompts, start=0):
+        self.prompts = prompts
+        # next() on itertools.count is atomic, so users share the position without a lock
+        self.positions = itertools.count(start)
+
+    def get(self):
+        return self.prompts[next(self.positions) % len(self.prompts)]
+
+    @classmethod
+    def load(cls, tokenizer, prompt_tokens, randomize, size, seed, cache_dir):
+        if not randomize:
+            size = 1
+        elif size is None:
+            size = max(1, PROMPT_POOL_TOKENS // prompt_tokens)
+        key = {
+            "version": PROMPT_POOL_VERSION,
+            "tokenizer": tokenizer.name_or_path if tokenizer is not None else None,
+            "vocab_size": len(tokenizer) if tokenizer is not None else None,
+            "prompt_tokens": prompt_tokens,
+            "randomize": randomize,
+            "size": size,
+            "seed": seed,
+        }
+        path = None
+        if cache_dir:
+            digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+            path = os.path.join(os.path.expanduser(cache_dir), f"prompts-{prompt_tokens}-{digest}.json")
+        prompts = None
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    cached = json.load(f)
+                if cached["key"] == key:
+                    prompts = cached["prompts"]
+            except Exception as e:
+                print(f"WARNING: ignoring broken prompt pool cache {path}: {repr(e)}")
+        if prompts is None:
+            print(f"Generating a pool of {size} prompts of {prompt_tokens} tokens")
+            prompts = _generate_prompts(tokenizer, prompt_tokens, randomize, size, seed)
+            if path:
+                _write_atomically(path, {"key": key, "prompts": prompts})
+        # not seeded, processes of a distributed run mustn't walk through the pool in lockstep
+        return cls(prompts, random.randrange(len(prompts)) if randomize else 0)
+
+
+def _write_atomically(path, data):
+    # several processes (Locust workers) may generate the same pool at once, readers never see a partial file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class SharedPrefixes:
+    """
+    Prompt prefixes for a controlled prefix cache hit ratio: with probability `hit_ratio` a request starts with one of
+    `num_prefixes` shared "system prompts" of `num_tokens` tokens, otherwise with a unique prefix of the same length.
+    Sharing is tracked per process: a shared prefix counts as reused once it was sent before
+    """
+
+    def __init__(self, hit_ratio, num_tokens, num_prefixes, seed):
+        assert 0 <= hit_ratio <= 1, "Prefix hit ratio must be between 0 and 1"
+        assert num_prefixes > 0, "Number of system prompts must be positive"
+        self.hit_ratio = hit_ratio
+        self.num_tokens = num_tokens
+        # all processes of a distributed run share the system prompts, but never the unique prefixes
+        rng = np.random.default_rng([1, seed])
+        self.prefixes = [_random_words(rng, num_tokens) for _ in range(num_prefixes)]
+        self.unique_rng = np.random.default_rng()
+        self.sent = set()
+
+    def sample(self):
+        """
+        Returns `(prefix, reused_tokens)`
+        """
+        if random.random() >= self.hit_ratio:
+            return _random_words(self.unique_rng, self.num_tokens), 0
+        index = random.randrange(len(self.prefixes))
+        reused = index in self.sent
+        self.sent.add(index)
+        return self.prefixes[index], self.num_tokens if reused else 0
+
+
+@functools.lru_cache(maxsize=None)
+def _shared_prefixes(hit_ratio, num_tokens, num_prefixes, seed):
+    return SharedPrefixes(hit_ratio, num_tokens, num_prefixes, seed)
+
+
+@functools.lru_cache(maxsize=None)
+def _prompt_pool(tokenizer, prompt_tokens, randomize, size, seed, cache_dir):
+    # one pool per process no matter how many users ask for it
+    return PromptPool.load(tokenizer, prompt_tokens, randomize, size, seed, cache_dir)
+
+
+class PromptSource:
+    """
+    Produces `(prompt, images, reused_prefix_tokens)` for every request based on the --prompt-* and --prefix-*
+    options. `reused_prefix_tokens` is None unless a prefix hit ratio is requested
+    """
+
+    def __init__(self, parsed_options, tokenizer=None):
+        self.randomize = parsed_options.prompt_randomize
+        self.pool = None
+        self.prefixes = None
+        prompt_chars = parsed_options.prompt_chars
+        if parsed_options.prompt_text:
+            self.input = _load_curl_like_data(parsed_options.prompt_text, tokenizer)
+        elif prompt_chars:
+            self.input = (PROMPT_PREFIX_TOKEN * (prompt_chars // len(PROMPT_PREFIX_TOKEN) + 1) + PROMPT_SUFFIX)[
+                :prompt_chars
+            ]
+        else:
+            prompt_tokens = parsed_options.prompt_tokens
+            if parsed_options.prefix_hit_ratio is not None:
+                shared_tokens = parsed_options.shared_prefix_tokens
+                if shared_tokens is None:
+                    shared_tokens = prompt_tokens // 2
+                assert (
+                    prompt_tokens - shared_tokens >= PROMPT_SUFFIX_TOKENS
+                ), f"Shared prefix has to leave at least {PROMPT_SUFFIX_TOKENS} tokens of the prompt"
+                self.prefixes = _shared_prefixes(
+                    parsed_options.prefix_hit_ratio,
+                    shared_tokens,
+                    parsed_options.num_system_prompts,
+                    parsed_options.seed or 0,
+                )
+                # the rest of the prompt must never be shared
+                prompt_tokens -= shared_tokens
+            self.pool = _prompt_pool(
+                tokenizer,
+                prompt_tokens,
+                self.randomize or self.prefixes is not None,
+                parsed_options.prompt_pool_size,
+                parsed_options.seed or 0,
+                parsed_options.prompt_pool_dir,
+            )
+
+    def _maybe_randomize(self, prompt):
+        if not self.randomize:
+            return prompt
+
+        # single letters are single tokens
+        num_random_tokens = (len(prompt) - len(PROMPT_SUFFIX)) // len(PROMPT_PREFIX_TOKEN)
+        return (
+            " ".join(chr(ord("a") + random.randint(0, 25)) for _ in range(num_random_tokens))
+            + " "
+            + prompt[-len(PROMPT_SUFFIX) :]
+        )
+
+    def get(self):
+        if self.prefixes is not None:
+            prefix, reused_tokens = self.prefixes.sample()
+            return prefix + self.pool.get(), None, reused_tokens
+        if self.pool is not None:
+            return self.pool.get(), None, None
+        if isinstance(self.input, str):
+            return self._maybe_randomize(self.input), None, None
+        else:
+            item = self.input[random.randint(0, len(self.input) - 1)]
+            assert "prompt" in item
+            return self._maybe_randomize(item["prompt"]), item.get("images", None), None
+
+    def peek(self):
+        """
+        Returns a representative prompt without counting it as sent
+        """
+        if self.pool is None:
+            return self.get()[0]
+        if self.prefixes is not None:
+            return self.prefixes.prefixes[0] + self.pool.prompts[0]
+        return self.pool.prompts[0]
+
+
+class ChatSession:
+    """
+    Conversation of a virtual user with --session-turns. The first turn takes a prompt from `prompt_source`, every
+    following one sends the whole history and a new user message of about `turn_tokens` tokens, so the context grows by
+    a response and a message per turn. Without --chat the history is flattened into the prompt
+    """
+
+    FOLLOW_UP = "Continue from where you stopped."
+
+    def __init__(self, prompt_source, chat, turn_tokens):
+        self.prompt_source = prompt_source
+        self.chat = chat
+        self.turn_tokens = turn_tokens
+        # follow-up messages are unique, only the history of the session itself can be reused from the cache
+        self.rng = np.random.default_rng()
+        self.history = []
+        self.prompt = None
+
+    def next_turn(self, turn):
+        """
+        Returns `(prompt, images, reused_prefix_tokens, history)` of the turn, turn 0 starts a new conversation
+        """
+        if turn == 0:
+            self.history = []
+            self.prompt, images, reused_prefix_tokens = self.prompt_source.get()
+        else:
+            self.prompt = _random_words(self.rng, self.turn_tokens) + self.FOLLOW_UP
+            images, reused_prefix_tokens = None, None
+        if self.chat:
+            return self.prompt, images, reused_prefix_tokens, self.history
+        flat = "".join(f"{user}\n\n{assistant}\n\n" for user, assistant in self.history)
+        return flat + self.prompt, images, reused_prefix_tokens, None
+
+    def add_response(self, text):
+        self.history.append((self.prompt, text))